@@ -0,0 +1,66 @@
+"""
+Micro-benchmark of Hit objects against the eager implementation they replaced.
+
+    python -m benchmarks.hits
+"""
+import timeit
+
+from rubber.response import Hit
+
+class EagerHit(object):
+    """
+    The eager Hit of rubber <= 0.1.8, kept here as a baseline.
+    """
+    def __init__(self, dict_response):
+        self.attributes = {}
+        for key, val in dict_response.items():
+            if isinstance(val, dict):
+                self.attributes[key] = self._hit_or_val(val)
+            elif isinstance(val, list):
+                self.attributes[key] = [self._hit_or_val(o) for o in val]
+            else:
+                self.attributes[key] = val
+
+    def _hit_or_val(self, val):
+        if isinstance(val, dict):
+            return EagerHit(val)
+        elif isinstance(val, list):
+            return EagerHit(val)
+        return val
+
+    def __getattribute__(self, name):
+        default_impl = super(EagerHit, self).__getattribute__
+        attributes = default_impl('attributes')
+        if attributes.has_key(name):
+            return attributes.get(name)
+        if not name.startswith('_') and attributes.has_key("_%s"%name):
+            return attributes.get("_%s"%name)
+        return default_impl(name)
+
+def make_hits(count, fields=50):
+    source = {}
+    for i in range(fields):
+        source['field%d' % i] = {'value': i, 'label': 'label %d' % i, 'tags': [{'name': 'tag'}, {'name': 'other'}]}
+    source['title'] = 'some title'
+    return [{'_index': 'articles', '_type': 'article', '_id': str(i), '_score': 1.0 / (i + 1), '_source': source}
+            for i in range(count)]
+
+def touch(hit_class, hits):
+    for hit_dict in hits:
+        hit = hit_class(hit_dict)
+        hit.id
+        hit.score
+        hit.source.title
+
+def run(sizes=(10, 100, 500), repeat=5):
+    results = []
+    for size in sizes:
+        hits = make_hits(size)
+        for hit_class in (EagerHit, Hit):
+            seconds = min(timeit.repeat(lambda: touch(hit_class, hits), number=10, repeat=repeat)) / 10
+            results.append({'name': 'hits.%s' % hit_class.__name__, 'size': size, 'seconds': seconds})
+    return results
+
+if __name__ == '__main__':
+    for result in run():
+        print '%(name)-16s %(size)5d hits: %(seconds).6fs' % result
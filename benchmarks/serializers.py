@@ -0,0 +1,58 @@
+"""
+Micro-benchmark of data_to_json on django models, against the serialization
+framework path it replaced.
+
+    python -m benchmarks.serializers
+"""
+import datetime
+import decimal
+import timeit
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure(DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}})
+
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+from requests.compat import json
+
+from rubber.instanceutils import data_to_json
+
+class BenchmarkArticle(models.Model):
+    title = models.CharField(max_length=255)
+    body = models.TextField()
+    count = models.IntegerField()
+    price = models.DecimalField(max_digits=8, decimal_places=2)
+    published = models.DateTimeField()
+    day = models.DateField()
+    active = models.BooleanField(default=False)
+
+    class Meta:
+        app_label = 'benchmarks'
+
+def framework_to_json(data):
+    """
+    The data_to_json of rubber <= 0.1.8 for django models.
+    """
+    return json.dumps(serializers.serialize("python", [data])[0]['fields'], cls=DjangoJSONEncoder)
+
+def make_articles(count):
+    return [BenchmarkArticle(pk=i, title='title %d' % i, body='some body ' * 50, count=i,
+                             price=decimal.Decimal('%d.50' % i),
+                             published=datetime.datetime(2012, 8, 2, 8, 30, 11, 562000),
+                             day=datetime.date(2012, 8, 2), active=bool(i % 2))
+            for i in range(count)]
+
+def run(count=1000, repeat=5):
+    articles = make_articles(count)
+    assert [framework_to_json(a) for a in articles] == [data_to_json(a) for a in articles]
+    results = []
+    for name, func in (('framework', framework_to_json), ('data_to_json', data_to_json)):
+        seconds = min(timeit.repeat(lambda: [func(a) for a in articles], number=1, repeat=repeat))
+        results.append({'name': 'serializers.%s' % name, 'size': count, 'seconds': seconds})
+    return results
+
+if __name__ == '__main__':
+    for result in run():
+        print '%(name)-26s %(size)5d models: %(seconds).6fs' % result
@@ -0,0 +1,190 @@
+"""
+An in-process HTTP server standing in for Elasticsearch, so that benchmarks
+exercise the whole HTTP path without a cluster or a network.
+
+It keeps documents in memory and answers the document, _search, _count,
+_mapping and _bulk endpoints with responses shaped like Elasticsearch's.
+Searches ignore the query and return the stored documents of the requested
+indices and types, honouring 'from' and 'size'.
+
+    with StubElasticSearch() as server:
+        es = ElasticSearch('articles', 'article', base_url=server.url)
+"""
+import socket
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import OrderedDict
+
+from requests.compat import json
+
+SHARDS = {'total': 1, 'successful': 1, 'failed': 0}
+
+class StubHandler(BaseHTTPRequestHandler):
+    # keep-alive, as rubber pools its connections
+    protocol_version = 'HTTP/1.1'
+    # one write per response, without waiting on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections.add(self.connection)
+
+    def finish(self):
+        BaseHTTPRequestHandler.finish(self)
+        with self.server.lock:
+            self.server.connections.discard(self.connection)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        url = urlparse.urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        params = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+        try:
+            status, response = self.server.handle(method, parts, params, body)
+        except ValueError, e:
+            status, response = 400, {'error': 'ElasticSearchParseException[%s]' % e, 'status': 400}
+        content = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+class StubElasticSearch(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), StubHandler)
+        self.documents = {}
+        self.mappings = {}
+        self.connections = set()
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='stub-elasticsearch')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # end the keep-alive connections the handler threads are blocked on
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def index(self, index, type, id, source):
+        with self.lock:
+            docs = self.documents.setdefault((index, type), OrderedDict())
+            version = docs[id][0] + 1 if id in docs else 1
+            docs[id] = (version, source)
+        return version
+
+    def remove(self, index, type, id):
+        with self.lock:
+            return None != self.documents.get((index, type), {}).pop(id, None)
+
+    def select(self, indices, types):
+        with self.lock:
+            hits = []
+            for (index, type), docs in self.documents.items():
+                if indices and index not in indices or types and type not in types:
+                    continue
+                for id, (version, source) in docs.items():
+                    hits.append({'_index': index, '_type': type, '_id': id, '_score': 1.0, '_source': source})
+            return hits
+
+    def handle(self, method, parts, params, body):
+        endpoint = None
+        for i, part in enumerate(parts):
+            if part.startswith('_'):
+                endpoint = part
+                parts = parts[:i]
+                break
+        indices = parts[0].split(',') if parts and parts[0] != '_all' else []
+        types = parts[1].split(',') if len(parts) > 1 else []
+
+        if '_search' == endpoint:
+            query = json.loads(body) if body else {}
+            start = int(query.get('from', params.get('from', 0)))
+            size = int(query.get('size', params.get('size', 10)))
+            hits = self.select(indices, types)
+            return 200, {'took': 1, 'timed_out': False, '_shards': SHARDS, 'hits': {
+                'total': len(hits), 'max_score': 1.0 if hits else None, 'hits': hits[start:start + size],
+            }}
+        if '_count' == endpoint:
+            return 200, {'count': len(self.select(indices, types)), '_shards': SHARDS}
+        if '_mapping' == endpoint:
+            if method in ('PUT', 'POST'):
+                self.mappings.setdefault(indices[0], {}).update(json.loads(body))
+                return 200, {'ok': True, 'acknowledged': True}
+            return 200, dict((index, mapping) for index, mapping in self.mappings.items() if not indices or index in indices)
+        if '_bulk' == endpoint:
+            return 200, {'took': 1, 'items': self.bulk(indices, types, body)}
+        if None != endpoint or len(parts) != 3:
+            return 400, {'error': 'No handler found for uri [/%s]' % '/'.join(parts), 'status': 400}
+
+        index, type, id = parts
+        if 'GET' == method:
+            with self.lock:
+                found = self.documents.get((index, type), {}).get(id)
+            if None == found:
+                return 404, {'_index': index, '_type': type, '_id': id, 'exists': False}
+            return 200, {'_index': index, '_type': type, '_id': id, '_version': found[0], 'exists': True, '_source': found[1]}
+        if 'DELETE' == method:
+            found = self.remove(index, type, id)
+            return 200 if found else 404, {'ok': True, 'found': found, '_index': index, '_type': type, '_id': id}
+        version = self.index(index, type, id, json.loads(body))
+        return 200, {'ok': True, '_index': index, '_type': type, '_id': id, '_version': version}
+
+    def bulk(self, indices, types, body):
+        items = []
+        lines = iter(line for line in body.split('\n') if line.strip())
+        for line in lines:
+            action, meta = json.loads(line).items()[0]
+            index = meta.get('_index', indices[0] if indices else None)
+            type = meta.get('_type', types[0] if types else None)
+            id = str(meta.get('_id'))
+            if 'delete' == action:
+                found = self.remove(index, type, id)
+                items.append({action: {'_index': index, '_type': type, '_id': id, 'ok': True, 'found': found}})
+            else:
+                version = self.index(index, type, id, json.loads(lines.next()))
+                items.append({action: {'_index': index, '_type': type, '_id': id, 'ok': True, '_version': version}})
+        return items
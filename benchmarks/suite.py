@@ -0,0 +1,191 @@
+"""
+Benchmark suite of the HTTP paths of rubber, run against StubElasticSearch:
+single document put and get throughput, search round-trips and response
+parsing at several result sizes, data_to_json serialization and django
+signal-driven indexing.
+
+Results are written as JSON, so that two versions can be compared:
+
+    python -m benchmarks.suite --output=before.json
+    python -m benchmarks.suite --output=after.json --compare=before.json
+
+The core benchmarks only use the API of the first releases of rubber (the
+server url comes from the RUBBER_ELASTICSEARCH_URL setting), so that the
+suite runs against older versions too. Benchmarks of later features are
+skipped when the version under test does not have them.
+"""
+import datetime
+import optparse
+import platform
+import sys
+import timeit
+
+from benchmarks import hits, serializers
+from benchmarks.stubserver import StubElasticSearch
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from requests.compat import json
+
+from rubber import ElasticSearch
+from rubber.instanceutils import data_to_json
+from rubber.response import SearchResponse
+from rubber.testutils import ResponseMock
+
+def supports(name, module):
+    """
+    Whether the version under test has module, needed by the benchmark name,
+    which is otherwise reported as skipped.
+    """
+    try:
+        __import__(module)
+    except ImportError:
+        sys.stderr.write('skipped %s: no %s in this version\n' % (name, module))
+        return False
+    return True
+
+def timed(name, size, func, repeat):
+    seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+    return {'name': name, 'size': size, 'seconds': seconds}
+
+def make_document():
+    return hits.make_hits(1, fields=20)[0]['_source']
+
+def bench_documents(server, count, repeat):
+    es = ElasticSearch('bench', 'document')
+    document = make_document()
+    results = [timed('documents.put', count, lambda: [es.put(i, document) for i in xrange(count)], repeat),
+               timed('documents.get', count, lambda: [es.get(i) for i in xrange(count)], repeat)]
+    for i in xrange(count):
+        es.delete(i)
+    return results
+
+def bench_search(server, sizes, repeat):
+    es = ElasticSearch('bench', 'search')
+    document = make_document()
+    for i in xrange(max(sizes)):
+        server.index('bench', 'search', str(i), document)
+
+    def parse(content):
+        response = SearchResponse(ResponseMock(content))
+        for hit in response.results:
+            hit.id
+            hit.source.title
+
+    results = []
+    for size in sizes:
+        query = {'query': {'match_all': {}}, 'size': size}
+        content = es.search(query).content
+        assert size == len(json.loads(content)['hits']['hits'])
+        results.append(timed('search.roundtrip', size, lambda: es.search(query), repeat))
+        results.append(timed('search.parse', size, lambda: parse(content), repeat))
+    results.append(timed('count', 1, lambda: es.count({'query': {'match_all': {}}}), repeat))
+    results.append(timed('mapping', 1, lambda: es.mapping.get(), repeat))
+    return results
+
+def bench_serialization(count, repeat):
+    documents = [make_document() for i in xrange(count)]
+    results = [timed('data_to_json.dict', count, lambda: [data_to_json(d) for d in documents], repeat)]
+    for result in serializers.run(count, repeat):
+        result['name'] = 'data_to_json.model' if result['name'] == 'serializers.data_to_json' else result['name']
+        results.append(result)
+    return results
+
+_models = {}
+
+def signal_model(auto_index):
+    """
+    A model indexed by the post_save signal, with the given auto_index mode.
+    """
+    if auto_index not in _models:
+        name = 'SignalArticle%s' % str(auto_index).capitalize()
+        attrs = {
+            '__module__': __name__,
+            'title': models.CharField(max_length=255),
+            'body': models.TextField(),
+            'count': models.IntegerField(),
+            'elasticsearch': ElasticSearch(index_name='bench', auto_index=auto_index),
+            'Meta': type('Meta', (), {'app_label': 'benchmarks'}),
+        }
+        model = _models[auto_index] = type(name, (models.Model,), attrs)
+        try:
+            with connection.schema_editor() as editor:
+                editor.create_model(model)
+        except AttributeError:
+            from django.core.management.color import no_style
+            cursor = connection.cursor()
+            for statement in connection.creation.sql_create_model(model, no_style())[0]:
+                cursor.execute(statement)
+    return _models[auto_index]
+
+def bench_signals(server, count, repeat):
+    atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+    results = []
+    modes = [True]
+    if supports('signals.batch', 'rubber.autoindex'):
+        modes.append('batch')
+    for auto_index in modes:
+        model = signal_model(auto_index)
+        articles = [model(pk=i, title='title %d' % i, body='some body ' * 50, count=i) for i in xrange(1, count + 1)]
+
+        def save():
+            with atomic():
+                for article in articles:
+                    article.save()
+
+        results.append(timed('signals.%s' % ('sync' if auto_index is True else auto_index), count, save, repeat))
+        assert count == len(server.select(['bench'], [model._meta.module_name]))
+    return results
+
+def run(count=200, sizes=(10, 100, 500), repeat=3):
+    with StubElasticSearch() as server:
+        previous = getattr(settings, 'RUBBER_ELASTICSEARCH_URL', None)
+        settings.RUBBER_ELASTICSEARCH_URL = server.url
+        try:
+            results = bench_documents(server, count, repeat)
+            results.extend(bench_search(server, sizes, repeat))
+            results.extend(bench_signals(server, count, repeat))
+        finally:
+            settings.RUBBER_ELASTICSEARCH_URL = previous
+    results.extend(bench_serialization(count * 5, repeat))
+    results.extend(hits.run(sizes, repeat))
+    if supports('templates', 'rubber.templates'):
+        from benchmarks import templates
+        results.extend(templates.run(sizes, repeat))
+    return results
+
+def report(results, previous=None):
+    baseline = {}
+    for result in (previous or {}).get('results', []):
+        baseline[(result['name'], result['size'])] = result['seconds']
+    for result in results:
+        line = '%(name)-26s %(size)6d: %(seconds).6fs' % result
+        before = baseline.get((result['name'], result['size']))
+        if before:
+            line += '  (%+.1f%%)' % ((result['seconds'] - before) / before * 100)
+        print line
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='python -m benchmarks.suite [options]')
+    parser.add_option('--output', default='bench_output.json', help='file the results are written to')
+    parser.add_option('--compare', help='results of a previous run to compare with')
+    parser.add_option('--count', type='int', default=200, help='documents per throughput benchmark')
+    parser.add_option('--repeat', type='int', default=3, help='runs of each benchmark, the best one is kept')
+    options, args = parser.parse_args(argv)
+
+    previous = None
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)
+
+    results = run(count=options.count, repeat=options.repeat)
+    report(results, previous)
+    with open(options.output, 'w') as f:
+        json.dump({
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'results': results,
+        }, f, indent=2)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,38 @@
+"""
+Micro-benchmark of precompiled query templates against serializing the
+query dict on every call.
+
+    python -m benchmarks.templates
+"""
+import timeit
+
+from requests.compat import json
+
+from rubber.instanceutils import data_to_json
+from rubber.templates import Param, QueryTemplate
+
+def make_query(author, tags, size, clauses):
+    return {
+        'query': {'bool': {
+            'must': [{'term': {'author': author}}, {'terms': {'tags': tags}}],
+            'should': [{'match': {'field%d' % i: {'query': 'value %d' % i, 'boost': i}}} for i in range(clauses)],
+        }},
+        'aggs': dict(('agg%d' % i, {'terms': {'field': 'field%d' % i, 'size': 10}}) for i in range(clauses)),
+        'size': size,
+    }
+
+def run(sizes=(10, 100, 500), repeat=5):
+    results = []
+    for size in sizes:
+        template = QueryTemplate(make_query(Param('author'), Param('tags'), Param('size'), size))
+        dict_call = lambda: data_to_json(make_query('kimchy', ['search', 'java'], 20, size))
+        template_call = lambda: data_to_json(template(author='kimchy', tags=['search', 'java'], size=20))
+        assert json.loads(dict_call()) == json.loads(template_call())
+        for name, call in (('dict', dict_call), ('template', template_call)):
+            seconds = min(timeit.repeat(call, number=100, repeat=repeat)) / 100
+            results.append({'name': 'templates.%s' % name, 'size': size, 'seconds': seconds})
+    return results
+
+if __name__ == '__main__':
+    for result in run():
+        print '%(name)-20s %(size)5d clauses: %(seconds).6fs' % result
@@ -1,13 +1,39 @@
+class _DefaultSettings(object):
+    RUBBER_ELASTICSEARCH_URL = None
+    RUBBER_DISABLE_AUTO_INDEX = False
+    RUBBER_MOCK_HTTP_RESPONSE = None
 
-try:
-    from django.conf import settings
-except:
-    class _settings:
-        RUBBER_ELASTICSEARCH_URL = None
-        RUBBER_DISABLE_AUTO_INDEX = False
-        RUBBER_MOCK_HTTP_RESPONSE = None
+_defaults = _DefaultSettings()
 
-    settings = _settings()
+class _LazySettings(object):
+    """
+    django.conf.settings, or defaults when django is not installed or no
+    project is configured, imported on first use so that importing rubber
+    does not import django.
+    """
+    def _setup(self):
+        try:
+            from django.conf import settings
+        except ImportError:
+            settings = _defaults
+        else:
+            try:
+                from django.core.exceptions import ImproperlyConfigured
+                # configures django, or fails when no project is
+                getattr(settings, 'RUBBER_ELASTICSEARCH_URL', None)
+            except (ImportError, ImproperlyConfigured):
+                # not kept: a project may still be configured later
+                return _defaults
+        self.__dict__['_wrapped'] = settings
+        return settings
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__.get('_wrapped') or self._setup(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.__dict__.get('_wrapped') or self._setup(), name, value)
+
+settings = _LazySettings()
 
 from rubber.resource import Resource
 from rubber.client import ElasticSearch
@@ -0,0 +1,117 @@
+"""
+Non-blocking twins of ElasticSearch, Resource and InstanceResource.
+
+Requests are run by a bounded pool of worker threads sharing the client's
+pooled keep-alive session, so that many requests can be in flight at once
+without one thread per request. get/put/post/delete return an AsyncResult:
+call .get() (optionally with a timeout) to wait for the usual Response or
+SearchResponse.
+
+Searches made within a MultiSearch block are collected by it in the calling
+thread, and their AsyncResult is ready at once, with the pending response.
+
+close() (or leaving a with block) stops the worker threads.
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+
+from rubber.client import ElasticSearch
+from rubber.instanceutils import get_pk
+from rubber.resource import Resource, InstanceResource
+from rubber.response import Response
+
+DEFAULT_WORKERS = 10
+
+class AsyncResource(Resource):
+    def __init__(self, path, base_url=None, executor=None, **kwargs):
+        """
+        executor is a ThreadPool, or a function returning one, so that it is
+        only started once a request is made.
+        """
+        super(AsyncResource, self).__init__(path, base_url, **kwargs)
+        self.executor = executor
+
+    def request(self, method, data=None, callback=None, **kwargs):
+        multisearch = self.collector(method, kwargs)
+        if None != multisearch:
+            # the worker threads cannot see the MultiSearch of this thread
+            return Ready(super(AsyncResource, self).request(method, data, **kwargs), callback)
+        kwargs['data'] = data
+        executor = self.executor
+        if not hasattr(executor, 'apply_async'):
+            executor = executor()
+        return executor.apply_async(super(AsyncResource, self).request, (method,), kwargs, callback)
+
+class Ready(object):
+    """
+    An AsyncResult whose value is already known.
+    """
+    def __init__(self, value, callback=None):
+        self.value = value
+        if None != callback:
+            callback(value)
+
+    def get(self, timeout=None):
+        return self.value
+
+    def wait(self, timeout=None):
+        pass
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return True
+
+class AsyncInstanceResource(InstanceResource, AsyncResource):
+    pass
+
+class AsyncElasticSearch(ElasticSearch):
+    def __init__(self, index_name=None, type=None, workers=DEFAULT_WORKERS, pool_size=None, **kwargs):
+        self.workers = workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        super(AsyncElasticSearch, self).__init__(index_name, type, pool_size=pool_size or workers, **kwargs)
+
+    def getexecutor(self):
+        if None == self._executor:
+            with self._executor_lock:
+                if None == self._executor:
+                    self._executor = ThreadPool(self.workers)
+        return self._executor
+
+    executor = property(getexecutor)
+
+    def close(self, wait=True):
+        """
+        Stops the worker threads, after the queued requests when wait is True.
+        A later request starts new ones.
+        """
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if None != executor:
+            if wait:
+                executor.close()
+            else:
+                executor.terminate()
+            executor.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def makeresource(self, path, wrapper=Response, endpoint=None):
+        return AsyncResource(path, wrapper=wrapper, raise_on_error=self.raise_on_error, pool=self.pool,
+                             endpoint=endpoint, cache=self.cache, executor=self.getexecutor)
+
+    def makeinstanceresource(self, instance):
+        return AsyncInstanceResource(instance,
+                                     self.makepath(get_pk(instance)),
+                                     wrapper=self.wrapsearchresponse,
+                                     raise_on_error=self.raise_on_error,
+                                     pool=self.pool,
+                                     endpoint='document',
+                                     cache=self.cache,
+                                     executor=self.getexecutor)
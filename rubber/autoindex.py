@@ -0,0 +1,195 @@
+"""
+Batched auto-indexing of django models.
+
+Instead of sending one request per post_save / post_delete signal, the
+changes of a transaction are collected per client and primary key, and sent
+as one _bulk request once the transaction commits. Changes made in a
+transaction that is rolled back are never sent.
+"""
+import logging
+import threading
+import Queue
+from collections import OrderedDict
+
+BATCH = 'batch'
+BACKGROUND = 'background'
+
+_local = threading.local()
+
+class Batch(object):
+    """
+    The pending changes of one transaction: for each client, the last instance
+    saved for each primary key, or None if it was deleted.
+    """
+    def __init__(self, background=False):
+        self.background = background
+        self.clients = OrderedDict()
+
+    def add(self, client, pk, instance):
+        if None == pk:
+            return
+        pending = self.clients.setdefault(client, OrderedDict())
+        pending.pop(pk, None)
+        pending[pk] = instance
+
+    def __call__(self):
+        if getattr(_local, 'batch', None) is self:
+            _local.batch = None
+        if self.background:
+            worker.submit(self.flush)
+        else:
+            self.flush()
+
+    def flush(self):
+        for client, pending in self.clients.items():
+            changes = client.changes
+            fingerprints = {}
+            try:
+                with client.bulk() as bulk:
+                    for pk, instance in pending.items():
+                        if None == instance:
+                            if None != changes:
+                                changes.forget(pk)
+                            bulk.delete(pk)
+                        elif None != changes:
+                            change = changes.diff(pk, instance)
+                            if change.action == 'update':
+                                bulk.update(pk, change.fields)
+                            elif change.action == 'index':
+                                bulk.index(pk, change.source)
+                            if change.action != 'skip':
+                                changes.forget(pk)
+                                fingerprints[str(pk)] = (pk, change.fingerprint)
+                        else:
+                            bulk.index(pk, instance)
+            except Exception:
+                if client.raise_on_error and not self.background:
+                    raise
+                logging.exception('Could not index %d documents in %s' % (len(pending), client.makepath(None)))
+                continue
+            for error in bulk.errors:
+                fingerprints.pop(str(error.get('_id')), None)
+                logging.error('Could not %s %s/%s: %s' % (error['action'], client.makepath(None), error.get('_id'), error.get('error')))
+            if len(bulk):
+                logging.error('Could not index %d documents in %s' % (len(bulk), client.makepath(None)))
+            if len(bulk) or any(None == error.get('_id') for error in bulk.errors):
+                # some actions were not sent: their documents will be indexed in full next time
+                continue
+            for pk, fingerprint in fingerprints.values():
+                changes.remember(pk, fingerprint)
+
+def _connection(using):
+    from django.db import DEFAULT_DB_ALIAS, connections
+    return connections[using or DEFAULT_DB_ALIAS]
+
+def _in_transaction(connection):
+    """
+    Tells if the changes made on connection will only be committed later, in
+    a managed transaction (django < 1.6) or an atomic block.
+    """
+    if getattr(connection, 'in_atomic_block', False):
+        return True
+    is_managed = getattr(connection, 'is_managed', None)
+    return None != is_managed and bool(is_managed())
+
+def _on_commit(func, using=None):
+    """
+    transaction.on_commit for django < 1.9: func is run once the current
+    transaction of the 'using' connection commits, and forgotten if it is
+    rolled back. The commit and rollback methods of the connection are
+    wrapped the first time.
+    """
+    connection = _connection(using)
+    hooks = connection.__dict__.get('rubber_on_commit')
+    if None == hooks:
+        hooks = connection.rubber_on_commit = []
+        commit, rollback = connection.commit, connection.rollback
+
+        def commit_and_run(*args, **kwargs):
+            result = commit(*args, **kwargs)
+            funcs = hooks[:]
+            del hooks[:]
+            for func in funcs:
+                func()
+            return result
+
+        def rollback_and_forget(*args, **kwargs):
+            del hooks[:]
+            return rollback(*args, **kwargs)
+
+        connection.commit = commit_and_run
+        connection.rollback = rollback_and_forget
+    hooks.append(func)
+
+def _is_pending(batch, using):
+    """
+    Tells if batch is still registered to run on commit, i.e. its transaction
+    has not been committed or rolled back since.
+    """
+    from django.db import transaction
+    connection = _connection(using)
+    if None == getattr(transaction, 'on_commit', None):
+        return any(hook is batch for hook in connection.__dict__.get('rubber_on_commit', ()))
+    hooks = getattr(connection, 'run_on_commit', None)
+    if None == hooks:
+        return True
+    return any(hook[1] is batch for hook in hooks)
+
+def schedule(client, pk, instance, using=None):
+    """
+    Queues the indexing (or deletion, when instance is None) of a document
+    until the current transaction on the 'using' database commits.
+    """
+    from django.db import transaction
+
+    background = client.auto_index == BACKGROUND
+    batch = getattr(_local, 'batch', None)
+    if None == batch or batch.background != background or not _is_pending(batch, using):
+        batch = Batch(background=background)
+        _local.batch = batch
+        on_commit = getattr(transaction, 'on_commit', None)
+        batch.add(client, pk, instance)
+        if None != on_commit:
+            on_commit(batch, using=using)
+        elif _in_transaction(_connection(using)):
+            _on_commit(batch, using=using)
+        else:
+            # autocommit: the change is already committed
+            batch()
+        return
+    batch.add(client, pk, instance)
+
+class Worker(object):
+    """
+    A daemon thread sending batches in the background.
+    """
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, func):
+        with self._lock:
+            if None == self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='rubber-autoindex')
+                self._thread.daemon = True
+                self._thread.start()
+        self.queue.put(func)
+
+    def join(self):
+        """
+        Blocks until every submitted batch has been sent.
+        """
+        self.queue.join()
+
+    def _run(self):
+        while True:
+            func = self.queue.get()
+            try:
+                func()
+            except Exception:
+                logging.exception('Background indexing failed')
+            finally:
+                self.queue.task_done()
+
+worker = Worker()
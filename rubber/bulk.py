@@ -0,0 +1,146 @@
+import threading
+import time
+
+from requests.compat import json
+from rubber.instanceutils import data_to_json
+from rubber.resource import Resource
+from rubber.response import BulkResponse
+
+class BulkBuffer(object):
+    """
+    Queues index / delete actions for an ElasticSearch client and sends them
+    through its _bulk endpoint, once max_actions actions or max_bytes bytes are
+    queued, or when an action is added while the oldest queued one is older
+    than max_age seconds.
+
+    Actions stay queued when the _bulk request fails or is refused as a whole
+    with a 413, 429 or 5xx status, for at most max_retries more flushes: they
+    are then dropped, with an error. Requests refused with another status are
+    not retried: their actions are dropped, with an error.
+
+    Can be used as a context manager, which flushes on exit.
+    """
+    def __init__(self, client, max_actions=500, max_bytes=5 * 1024 * 1024, max_age=None, max_retries=3):
+        self.client = client
+        self.max_actions = max_actions
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_retries = max_retries
+        self.errors = []
+        self._failures = 0
+
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._chunks = []
+        self._bytes = 0
+        self._started = None
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def index(self, pk, instance):
+        source = data_to_json(instance)
+        if '\n' in source:
+            # NDJSON: a document must fit on one line
+            source = json.dumps(json.loads(source))
+        return self._add({'index': {'_id': pk}}, source)
+
+    def update(self, pk, fields):
+        return self._add({'update': {'_id': pk}}, json.dumps({'doc': fields}))
+
+    def delete(self, pk):
+        return self._add({'delete': {'_id': pk}})
+
+    def _add(self, action, source=None):
+        chunk = json.dumps(action) + '\n'
+        if None != source:
+            chunk += source + '\n'
+
+        with self._lock:
+            if not self._chunks:
+                self._started = time.time()
+            self._chunks.append(chunk)
+            self._bytes += len(chunk)
+            full = (self.max_actions and len(self._chunks) >= self.max_actions) \
+                or (self.max_bytes and self._bytes >= self.max_bytes) \
+                or (self.max_age and time.time() - self._started >= self.max_age)
+
+        if full:
+            return self.flush()
+
+    def flush(self):
+        with self._lock:
+            chunks = self._chunks
+            self._reset()
+
+        if not chunks:
+            return None
+
+        try:
+            response = send(self.client, ''.join(chunks))
+        except Exception, e:
+            self._failed(chunks, None, str(e))
+            raise
+
+        if None == response:
+            self._failed(chunks, None, 'request failed')
+        elif is_transient(response):
+            self._failed(chunks, response.status_code, response.content)
+        else:
+            with self._lock:
+                self._failures = 0
+            self.errors.extend(errors(response))
+        return response
+
+    def _failed(self, chunks, status, error):
+        """
+        Keeps the actions of a failed request for the next flush, or drops them
+        once they failed max_retries + 1 times in a row.
+        """
+        with self._lock:
+            self._failures += 1
+            if self._failures > self.max_retries:
+                self._failures = 0
+                self.errors.append({'action': 'bulk', 'status': status, 'count': len(chunks),
+                                    'error': 'Dropped after %d attempts: %s' % (self.max_retries + 1, error)})
+                return
+            self._chunks = chunks + self._chunks
+            self._bytes += sum(len(chunk) for chunk in chunks)
+            self._started = time.time()
+
+def is_transient(response):
+    """
+    Whether a BulkResponse refuses the whole request with a status that may
+    not be returned next time: 413 (too large), 429 (too many requests) or 5xx.
+    """
+    return not response.items and (response.status_code in (413, 429) or response.status_code >= 500)
+
+def send(client, data):
+    """
+    Posts NDJSON actions to the _bulk endpoint of client. Returns a BulkResponse,
+    or None if the request itself failed.
+    """
+    return Resource(client.makepath('_bulk'),
+                    wrapper=BulkResponse,
+                    raise_on_error=client.raise_on_error,
+                    pool=client.pool,
+                    endpoint='bulk',
+                    cache=client.cache).post(data=data)
+
+def errors(response):
+    """
+    The errors of the actions of a BulkResponse.
+    """
+    found = list(response.errors)
+    if response.status_code >= 300 and not response.items:
+        # the whole request was refused
+        found.append({'action': 'bulk', 'status': response.status_code, 'error': response.content})
+    return found
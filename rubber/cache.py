@@ -0,0 +1,191 @@
+"""
+Caching of search results.
+
+A SearchCache keeps the responses of the search and count endpoints of a
+client, keyed by the resource path, the method and the normalized request
+body. Every write going through the client (put, delete, bulk, mapping
+updates, django auto-indexing) invalidates the cached responses of its
+index, and responses are not cached for refresh_interval seconds after a
+write, as searches may not see it before the index is refreshed.
+"""
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import requests
+from requests.compat import json
+from rubber.instanceutils import _data_to_json
+
+CACHED_ENDPOINTS = ('search', 'count')
+
+# seconds the token of an index is kept, without writes
+TOKEN_TIMEOUT = 24 * 3600
+
+class CachedResponse(requests.models.Response):
+    """
+    A response rebuilt from the status code and body kept in a cache.
+    """
+    def __init__(self, status_code, content):
+        super(CachedResponse, self).__init__()
+        self.status_code = status_code
+        self._content = content
+        self._content_consumed = True
+
+class LRUCache(object):
+    """
+    A thread-safe in-process cache with a maximum size and a default TTL.
+    Its get / set / delete methods follow the django cache API, so django
+    cache backends can be used instead.
+    """
+    def __init__(self, maxsize=1000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if None == item:
+                return default
+            expires, value = item
+            if None != expires and expires < time.time():
+                return default
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, timeout=None):
+        if None == timeout:
+            timeout = self.ttl
+        expires = timeout and time.time() + timeout or None
+        with self._lock:
+            self._set(key, value, expires)
+
+    def add(self, key, value, timeout=None):
+        """
+        Sets key unless it holds a value that has not expired. Returns whether it was set.
+        """
+        if None == timeout:
+            timeout = self.ttl
+        expires = timeout and time.time() + timeout or None
+        with self._lock:
+            item = self._data.get(key)
+            if None != item and (None == item[0] or item[0] >= time.time()):
+                return False
+            self._set(key, value, expires)
+            return True
+
+    def _set(self, key, value, expires):
+        self._data.pop(key, None)
+        self._data[key] = (expires, value)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class SearchCache(object):
+    """
+    Caches responses in 'backend' (an LRUCache by default) for 'ttl' seconds.
+
+    Invalidation works with a token per index, part of every key: invalidating
+    an index replaces its token, so that its previous entries are no longer
+    reachable and expire by themselves. The token also records the time of the
+    write: until refresh_interval seconds later (the refresh interval of the
+    index), responses are not cached, as they may not include the write.
+    """
+    def __init__(self, backend=None, ttl=60, maxsize=1000, refresh_interval=1):
+        self.backend = backend or LRUCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations}
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _index(self, resource):
+        index = resource.path.split('/')[0]
+        if not index or index.startswith('_'):
+            # requests on all indices, like /_search
+            return '_all'
+        return index
+
+    def _tokenkey(self, index):
+        return 'rubber:token:%s' % index
+
+    def _token(self, index):
+        """
+        The token of index and the time of the write that set it (0 if unknown).
+        """
+        key = self._tokenkey(index)
+        token = self.backend.get(key)
+        if None == token:
+            token = (uuid.uuid4().hex, 0)
+            add = getattr(self.backend, 'add', None)
+            if None == add:
+                self.backend.set(key, token, TOKEN_TIMEOUT)
+            elif not add(key, token, TOKEN_TIMEOUT):
+                # set by another thread or process in the meantime
+                token = self.backend.get(key) or token
+        return token
+
+    def invalidate(self, index):
+        now = time.time()
+        self.backend.set(self._tokenkey(index), (uuid.uuid4().hex, now), TOKEN_TIMEOUT)
+        if index != '_all':
+            self.backend.set(self._tokenkey('_all'), (uuid.uuid4().hex, now), TOKEN_TIMEOUT)
+        self._count('invalidations')
+
+    def key(self, resource, method, data, kwargs, token=None):
+        if isinstance(data, dict):
+            body = json.dumps(data, sort_keys=True)
+        else:
+            # not instrumented: the request itself reports its serialization
+            body = _data_to_json(data)
+        extra = json.dumps(kwargs, sort_keys=True, default=repr)
+        digest = hashlib.sha1('\n'.join((method, resource.path, body or '', extra))).hexdigest()
+        if None == token:
+            token = self._token(self._index(resource))[0]
+        return 'rubber:%s:%s' % (token, digest)
+
+    def request(self, resource, method, data=None, **kwargs):
+        """
+        Sends the request of resource, or returns its cached response.
+        Writes invalidate the cached responses of the resource's index.
+        """
+        if resource.endpoint not in CACHED_ENDPOINTS or method not in ('GET', 'POST'):
+            response = resource.send(method, data, **kwargs)
+            if method != 'GET':
+                self.invalidate(self._index(resource))
+            return response
+
+        token, written = self._token(self._index(resource))
+        key = self.key(resource, method, data, kwargs, token)
+        cached = self.backend.get(key)
+        if None != cached:
+            self._count('hits')
+            return CachedResponse(*cached)
+
+        self._count('misses')
+        response = resource.send(method, data, **kwargs)
+        if None != response and 200 <= response.status_code < 300 \
+                and time.time() - written >= self.refresh_interval:
+            self.backend.set(key, (response.status_code, response.content), self.ttl)
+        return response
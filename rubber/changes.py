@@ -0,0 +1,101 @@
+"""
+Change detection for indexing.
+
+A ChangeTracker remembers a fingerprint of the last document indexed for
+each pk: an 8 bytes digest per field. Saving a document identical to the
+last one indexed is then skipped, and a document of which only a few fields
+changed is sent as a partial _update of these fields, unless one of them
+holds objects, which _update would merge with the stored ones. Fingerprints are kept
+in an LRUCache of at most 'maxsize' pks; a pk that has been evicted is simply
+indexed in full again.
+"""
+import hashlib
+import threading
+
+from requests.compat import json
+from rubber.cache import LRUCache
+from rubber.instanceutils import data_to_values
+
+SKIP = 'skip'
+UPDATE = 'update'
+INDEX = 'index'
+
+COUNTERS = {SKIP: 'skipped', UPDATE: 'updated', INDEX: 'indexed'}
+
+class Change(object):
+    """
+    What to send for a document: nothing (SKIP), the changed 'fields' (UPDATE)
+    or its whole JSON 'source' (INDEX).
+    """
+    def __init__(self, action, fields, source, fingerprint):
+        self.action = action
+        self.fields = fields
+        self.source = source
+        self.fingerprint = fingerprint
+
+def _merged(value):
+    """
+    Whether a partial update of value would be merged into the stored one
+    instead of replacing it: _update deep-merges objects.
+    """
+    if isinstance(value, dict):
+        return True
+    if isinstance(value, list):
+        return any(isinstance(item, dict) for item in value)
+    return False
+
+def _digest(value):
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, sort_keys=True)
+    else:
+        value = repr(value)
+    return hashlib.md5(value).digest()[:8]
+
+class ChangeTracker(object):
+    """
+    'partial' is the largest share of changed fields for which a partial
+    update is sent rather than the whole document.
+    """
+    def __init__(self, maxsize=10000, partial=0.5):
+        self.partial = partial
+        self.fingerprints = LRUCache(maxsize=maxsize, ttl=0)
+        # the field names of fingerprints, shared by the documents having the same ones
+        self._names = {}
+        self._lock = threading.Lock()
+        self.skipped = self.updated = self.indexed = 0
+
+    def fingerprint(self, values):
+        names = tuple(sorted(values))
+        names = self._names.setdefault(names, names)
+        return names, ''.join(_digest(values[name]) for name in names)
+
+    def diff(self, pk, data):
+        values, source = data_to_values(data)
+        fingerprint = self.fingerprint(values)
+        previous = self.fingerprints.get(pk)
+        if previous == fingerprint:
+            action, fields = SKIP, None
+        elif None != previous and previous[0] == fingerprint[0]:
+            names, digests = fingerprint
+            changed = [name for i, name in enumerate(names) if digests[i * 8:i * 8 + 8] != previous[1][i * 8:i * 8 + 8]]
+            if len(changed) <= self.partial * len(names) and not any(_merged(values[name]) for name in changed):
+                action, fields = UPDATE, dict((name, values[name]) for name in changed)
+            else:
+                action, fields = INDEX, None
+        else:
+            # new document, or fields added or removed: partial updates cannot remove fields
+            action, fields = INDEX, None
+        counter = COUNTERS[action]
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        return Change(action, fields, source, fingerprint)
+
+    def remember(self, pk, fingerprint):
+        self.fingerprints.set(pk, fingerprint)
+
+    def forget(self, pk):
+        self.fingerprints.delete(pk)
+
+    def stats(self):
+        return {'skipped': self.skipped, 'updated': self.updated, 'indexed': self.indexed,
+                'fingerprints': len(self.fingerprints)}
@@ -1,5 +1,6 @@
-from rubber.resource import Resource
-from rubber.response import Hit, Response
+from rubber.instanceutils import get_pk
+from rubber.resource import Resource, InstanceResource, ConnectionPool
+from rubber.response import Hit, Response, SearchResponse
 from rubber import settings
 
 HANDLERS = {
@@ -9,12 +10,38 @@ HANDLERS = {
 }
 
 class ElasticSearch(object):
-    def __init__(self, index_name=None, type=None, auto_index=True, hit_class=Hit, raise_on_error=False):
+    def __init__(self, index_name=None, type=None, auto_index=True, hit_class=Hit, raise_on_error=False, base_url=None, pool_size=None, cache=None, failover=None, compression=None, transport=None, track_changes=None):
         self.index_name = index_name
         self.type = type
         self.auto_index = auto_index
         self.hit_class = hit_class
         self.raise_on_error = raise_on_error
+        self.model = None
+        if None != transport:
+            self.pool = transport
+        elif failover:
+            from rubber.failover import FailoverPool
+            self.pool = FailoverPool(base_url, pool_size=pool_size, compression=compression,
+                                     **(failover if isinstance(failover, dict) else {}))
+        else:
+            self.pool = ConnectionPool(base_url, pool_size=pool_size, compression=compression)
+
+        if cache:
+            from rubber.cache import SearchCache
+            if cache is True:
+                cache = SearchCache()
+            elif not isinstance(cache, SearchCache):
+                cache = SearchCache(backend=cache)
+        self.cache = cache or None
+
+        if track_changes:
+            from rubber.changes import ChangeTracker
+            if track_changes is True:
+                track_changes = ChangeTracker()
+            elif not isinstance(track_changes, ChangeTracker):
+                track_changes = ChangeTracker(maxsize=track_changes)
+        self.changes = track_changes or None
+        self.makehandlers()
 
     def contribute_to_class(self, model, name):
         if not self.index_name:
@@ -24,6 +51,7 @@ class ElasticSearch(object):
             self.type = model._meta.module_name
 
         self.model = model
+        self.makehandlers()
 
         if self.auto_index and not getattr(settings, 'RUBBER_DISABLE_AUTO_INDEX', False):
             try:
@@ -36,34 +64,151 @@ class ElasticSearch(object):
         setattr(model, name, ElasticSearchDescriptor(self))
 
     def get(self, pk):
-        return Resource(self.makepath(pk), wrapper=Response, raise_on_error=self.raise_on_error).get()
+        return self.makeresource(self.makepath(pk), endpoint='document').get()
+
+    def get_many(self, pks, fields=None, source=None, chunk_size=500, workers=4, **kwargs):
+        """
+        Fetches several documents with _mget, in chunks of chunk_size pks sent
+        concurrently. Returns one hit_class object per pk, in the same order;
+        missing documents have a false 'found' property.
+        """
+        pks = list(pks)
+        params = kwargs.pop('params', {})
+        if None != fields:
+            params['fields'] = ','.join(fields)
+        if isinstance(source, bool):
+            params['_source'] = source and 'true' or 'false'
+        elif None != source:
+            params['_source'] = isinstance(source, basestring) and source or ','.join(source)
+        resource = Resource(self.makepath('_mget'), raise_on_error=self.raise_on_error, pool=self.pool, endpoint='mget')
+
+        def fetch(chunk):
+            response = resource.post(data={'ids': chunk}, params=params, **kwargs)
+            docs = None != response and (response.json or {}).get('docs') or []
+            if len(docs) != len(chunk):
+                return [{'_id': pk, 'found': False, 'error': 'No response from _mget'} for pk in chunk]
+            for doc in docs:
+                doc.setdefault('found', doc.get('exists', False) and 'error' not in doc)
+            return docs
+
+        chunks = [pks[i:i + chunk_size] for i in range(0, len(pks), chunk_size)]
+        if len(chunks) > 1 and workers > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(workers, len(chunks)))
+            try:
+                results = pool.map(fetch, chunks)
+            finally:
+                pool.close()
+        else:
+            results = [fetch(chunk) for chunk in chunks]
+        return [self.hit_class(doc) for docs in results for doc in docs]
 
     def put(self, pk, instance):
-        return Resource(self.makepath(pk), wrapper=Response, raise_on_error=self.raise_on_error).put(data=instance)
+        if None != self.changes:
+            self.changes.forget(pk)
+        return self.makeresource(self.makepath(pk), endpoint='document').put(data=instance)
+
+    def update(self, pk, fields):
+        """
+        Sets some fields of a document with a partial _update.
+        """
+        if None != self.changes:
+            self.changes.forget(pk)
+        return self.makeresource(self.makepath(pk) + '/_update', endpoint='update').post(data={'doc': fields})
+
+    def index(self, pk, instance):
+        """
+        Puts instance, unless changes are tracked: then nothing is sent (and None
+        returned) if it is identical to the last document indexed for pk, and
+        only its changed fields if few of them changed.
+
+        With changes tracked, the responses of asynchronous clients are waited
+        for, since the fingerprint is only recorded once the write succeeded.
+        """
+        if None == self.changes:
+            return self.put(pk, instance)
+        change = self.changes.diff(pk, instance)
+        if change.action == 'skip':
+            return None
+        if change.action == 'update':
+            response = resolve(self.update(pk, change.fields))
+            if None != response and 404 == response.status_code:
+                # deleted behind our back: index it in full
+                response = resolve(self.put(pk, change.source))
+        else:
+            response = resolve(self.put(pk, change.source))
+        if None != response and response.status_code < 300:
+            self.changes.remember(pk, change.fingerprint)
+        return response
 
     def delete(self, pk):
-        return Resource(self.makepath(pk), wrapper=Response, raise_on_error=self.raise_on_error).delete()
+        if None != self.changes:
+            self.changes.forget(pk)
+        return self.makeresource(self.makepath(pk), endpoint='document').delete()
+
+    def stream_search(self, data=None, chunk_size=64 * 1024, **kwargs):
+        """
+        Searches without loading the whole response: the hits of the returned
+        response's results are parsed one at a time while iterating.
+        """
+        from rubber.resource import STREAM_KWARGS
+        from rubber.streaming import StreamingSearchResponse
+        kwargs.update(STREAM_KWARGS)
+        wrapper = lambda response: StreamingSearchResponse(response, hit_class=self.hit_class, chunk_size=chunk_size)
+        return self.makeresource(self.makepath(HANDLERS['search']), wrapper=wrapper, endpoint='stream_search').post(data=data, **kwargs)
+
+    def msearch(self, queries, **params):
+        """
+        Sends several searches as one _msearch request and returns their SearchResponses.
+        """
+        from rubber.multisearch import MultiSearch
+        multisearch = MultiSearch(raise_on_error=self.raise_on_error)
+        for query in queries:
+            multisearch.add(self, query, **params)
+        return multisearch.execute()
+
+    def scan(self, query=None, size=100, scroll='5m', search_type='scan', prefetch=True, **kwargs):
+        from rubber.scroll import scan
+        return scan(self, query, size=size, scroll=scroll, search_type=search_type, prefetch=prefetch, **kwargs)
+
+    def bulk(self, max_actions=500, max_bytes=5 * 1024 * 1024, max_age=None, max_retries=3):
+        from rubber.bulk import BulkBuffer
+        return BulkBuffer(self, max_actions=max_actions, max_bytes=max_bytes, max_age=max_age, max_retries=max_retries)
+
+    def stats(self):
+        """
+        Stats of the connection pool (compression, node health), of the search
+        cache and of the change tracker.
+        """
+        stats = self.pool.stats()
+        if None != self.cache:
+            stats['cache'] = self.cache.stats()
+        if None != self.changes:
+            stats['changes'] = self.changes.stats()
+        return stats
 
     def django_post_delete(self, sender, instance, **kwargs):
-        from rubber.instanceutils import get_pk
-        self.delete(get_pk(instance))
+        if self.auto_index in ('batch', 'background'):
+            from rubber.autoindex import schedule
+            schedule(self, get_pk(instance), None, using=kwargs.get('using'))
+        else:
+            self.delete(get_pk(instance))
 
     def django_post_save(self, sender, instance, created, **kwargs):
-        from rubber.instanceutils import get_pk
-        self.put(get_pk(instance), instance)
-
-    def __getattribute__(self, name):
-        default_impl = super(ElasticSearch, self).__getattribute__
-        try:
-            return default_impl(name)
-        except AttributeError, e:
-            if not name in HANDLERS.keys():
-                raise e
+        if self.auto_index in ('batch', 'background'):
+            from rubber.autoindex import schedule
+            schedule(self, get_pk(instance), instance, using=kwargs.get('using'))
+        else:
+            self.index(get_pk(instance), instance)
+
+    def makehandlers(self):
+        """
+        Builds the search, count and mapping resources, for the current index and type.
+        """
+        for name, path in HANDLERS.items():
             wrapper = Response
             if name == 'search': wrapper=self.wrapsearchresponse
-            setattr(self, name, Resource(self.makepath(HANDLERS.get(name)), wrapper=wrapper, raise_on_error=self.raise_on_error))
-
-            return default_impl(name)
+            setattr(self, name, self.makeresource(self.makepath(path), wrapper=wrapper, endpoint=name))
 
     def makepath(self, name):
         tokens = []
@@ -75,9 +220,28 @@ class ElasticSearch(object):
             tokens.append(str(name))
         return "/".join(tokens)
 
+    def makeresource(self, path, wrapper=Response, endpoint=None):
+        return Resource(path, wrapper=wrapper, raise_on_error=self.raise_on_error, pool=self.pool, endpoint=endpoint, cache=self.cache)
+
+    def makeinstanceresource(self, instance):
+        return InstanceResource(instance,
+                                self.makepath(get_pk(instance)),
+                                wrapper=self.wrapsearchresponse,
+                                raise_on_error=self.raise_on_error,
+                                pool=self.pool,
+                                endpoint='document',
+                                cache=self.cache)
+
     def wrapsearchresponse(self, resp):
-        from rubber.response import SearchResponse
-        return SearchResponse(resp, hit_class=self.hit_class)
+        return SearchResponse(resp, hit_class=self.hit_class, model=self.model)
+
+def resolve(response):
+    """
+    The response of an AsyncResult, or response itself.
+    """
+    if hasattr(response, 'ready') and hasattr(response, 'get'):
+        return response.get()
+    return response
 
 class ElasticSearchDescriptor(object):
 
@@ -85,11 +249,9 @@ class ElasticSearchDescriptor(object):
         self.elasticsearch = elasticsearch
 
     def __get__(self, instance, type=None):
+        # the resource holds the instance: it is not cached, as keeping it in the
+        # instance breaks pickling and deepcopy, and keeping it anywhere else keeps
+        # the instance alive
         if instance != None:
-            from rubber.resource import InstanceResource
-            from rubber.instanceutils import get_pk
-            return InstanceResource(instance,
-                                    self.elasticsearch.makepath(get_pk(instance)),
-                                    wrapper=self.elasticsearch.wrapsearchresponse,
-                                    raise_on_error=self.elasticsearch.raise_on_error)
+            return self.elasticsearch.makeinstanceresource(instance)
         return self.elasticsearch
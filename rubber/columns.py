@@ -0,0 +1,92 @@
+"""
+Columnar access to search hits, for analytics: the values of a few fields
+of every hit are read straight from the parsed response into one array per
+field, without building Hit objects.
+
+Numbers go to numpy arrays when numpy is installed, to array.array otherwise
+(integers as 'l', floats as 'd'), missing values of float columns being NaN. Other
+values go to numpy object arrays, or stay in lists.
+"""
+from array import array
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+META_FIELDS = ('_id', '_score', '_index', '_type', '_version')
+
+NAN = float('nan')
+
+def getter(field):
+    """
+    A function reading field from a hit: a meta field, a requested stored field
+    ('fields' of the hit), or a dotted path in its source.
+    """
+    path = field.split('.')
+    def get(hit):
+        fields = hit.get('fields')
+        if fields and field in fields:
+            value = fields[field]
+            if isinstance(value, list) and len(value) == 1:
+                value = value[0]
+            return value
+        value = hit.get('_source')
+        for name in path:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(name)
+        return value
+    return get
+
+def typecode(values):
+    """
+    'l' when values are all integers, 'd' when they are numbers or None, else None.
+    """
+    code = 'l'
+    for value in values:
+        value_type = type(value)
+        if value_type is int or value_type is long:
+            continue
+        if value_type is float or value is None:
+            code = 'd'
+            continue
+        return None
+    return code
+
+def column(values, code=None, use_numpy=True):
+    """
+    values as an array, of the given typecode or of the one they fit.
+    """
+    if None == code:
+        code = typecode(values)
+    use_numpy = None != numpy and use_numpy
+    if None == code:
+        return numpy.array(values, dtype=object) if use_numpy else values
+    if None in values and _is_float(code, use_numpy):
+        values = [NAN if None == value else value for value in values]
+    if use_numpy:
+        return numpy.array(values, dtype=code)
+    return array(code, values)
+
+def _is_float(code, use_numpy):
+    if use_numpy:
+        return 'f' == numpy.dtype(code).kind
+    return code in ('f', 'd')
+
+def columns(hits, fields, types=None, use_numpy=True):
+    """
+    An OrderedDict of the column of each field for hits, a list of hit dicts.
+    types optionally gives the typecode of some fields.
+    """
+    types = types or {}
+    result = OrderedDict()
+    for field in fields:
+        if field in META_FIELDS:
+            values = [hit.get(field) for hit in hits]
+        else:
+            get = getter(field)
+            values = [get(hit) for hit in hits]
+        result[field] = column(values, types.get(field), use_numpy)
+    return result
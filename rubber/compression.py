@@ -0,0 +1,93 @@
+"""
+Gzip compression of request bodies, and negotiation of compressed responses.
+"""
+import threading
+import zlib
+
+DEFAULT_MIN_SIZE = 1024
+
+class Compression(object):
+    """
+    Compresses request bodies of at least min_size bytes, and asks for gzip
+    encoded responses when 'responses' is set. Keeps the number of bytes
+    before and after compression, in both directions.
+    """
+    def __init__(self, min_size=DEFAULT_MIN_SIZE, level=6, responses=True):
+        self.min_size = min_size
+        self.level = level
+        self.responses = responses
+        self._lock = threading.Lock()
+        self.request_bytes = self.compressed_request_bytes = 0
+        self.response_bytes = self.compressed_response_bytes = 0
+
+    def compress(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        # 16 + MAX_WBITS: gzip container rather than raw zlib
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def prepare(self, kwargs):
+        """
+        The keyword arguments of a request, with its body compressed and the
+        matching headers.
+        """
+        data = kwargs.get('data')
+        compress = isinstance(data, basestring) and len(data) >= self.min_size
+        if not compress and not self.responses:
+            return kwargs
+        kwargs = dict(kwargs)
+        headers = kwargs['headers'] = dict(kwargs.get('headers') or {})
+        if self.responses:
+            headers.setdefault('Accept-Encoding', 'gzip')
+        if compress:
+            kwargs['data'] = self.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+            with self._lock:
+                self.request_bytes += len(data)
+                self.compressed_request_bytes += len(kwargs['data'])
+        return kwargs
+
+    def measure(self, response):
+        """
+        Records the sizes of a gzip encoded response whose body was read.
+        """
+        if 'gzip' != (response.headers.get('content-encoding') or '').lower():
+            return
+        length = response.headers.get('content-length')
+        if not length:
+            return
+        with self._lock:
+            self.response_bytes += len(response.content or '')
+            self.compressed_response_bytes += int(length)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'request_bytes': self.request_bytes,
+                'compressed_request_bytes': self.compressed_request_bytes,
+                'request_ratio': _ratio(self.compressed_request_bytes, self.request_bytes),
+                'response_bytes': self.response_bytes,
+                'compressed_response_bytes': self.compressed_response_bytes,
+                'response_ratio': _ratio(self.compressed_response_bytes, self.response_bytes),
+            }
+
+def _ratio(compressed, uncompressed):
+    if not uncompressed:
+        return None
+    return float(compressed) / uncompressed
+
+def make_compression(option):
+    """
+    A Compression from the compression option of a client: True, a minimum
+    body size, or a dict of Compression arguments.
+    """
+    if not option:
+        return None
+    if isinstance(option, Compression):
+        return option
+    if isinstance(option, dict):
+        return Compression(**option)
+    if option is True:
+        return Compression()
+    return Compression(min_size=option)
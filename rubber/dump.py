@@ -0,0 +1,202 @@
+"""
+Exporting an index to an NDJSON file, and loading such a file into an index.
+
+export streams every document of a client's index (and type) through a scan,
+and writes it as a pair of _bulk lines:
+
+    {"index":{"_id":"1"}}
+    {"title": "foo", ...}
+
+gzip compressed when the file name ends with .gz. load memory-maps the file
+(gzip files are first decompressed to a temporary file), cuts it into chunks
+of about chunk_size bytes at action lines, and posts each chunk as it is to
+the _bulk endpoint, from several threads. Documents are not parsed, but each
+chunk is copied out of the map while it is posted, so that at most 'workers'
+chunks are in memory at once.
+
+The command line only needs --url, not a django project.
+
+    python -m rubber.dump export articles/article articles.ndjson.gz
+    python -m rubber.dump import staging/article articles.ndjson.gz --workers=8
+"""
+import gzip
+import logging
+import mmap
+import optparse
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.compat import json
+from rubber import bulk
+
+# action lines are written without spaces, while sources are written with the
+# default ', ' and ': ' separators: this never appears inside a source line
+ACTION = '\n{"index":{'
+
+GZIP_MAGIC = '\x1f\x8b'
+
+def _rate(stats, started):
+    stats['elapsed'] = time.time() - started
+    stats['rate'] = stats['documents'] / (stats['elapsed'] or 1e-9)
+    return stats
+
+def export(client, path, query=None, size=500, scroll='5m', progress=None):
+    """
+    Writes every document of client's index (and type) matching query to path.
+    The _type of documents is kept when the client has no type. progress, if
+    given, is called with a dict of statistics every 'size' documents.
+
+    Returns the statistics.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    stats = {'documents': 0, 'bytes': 0, 'elapsed': 0.0, 'rate': 0.0}
+    started = time.time()
+    with opener(path, 'wb') as f:
+        for hit in client.scan(query, size=size, scroll=scroll):
+            data = hit.attributes
+            meta = {'_id': data['_id']}
+            if None == client.type:
+                meta['_type'] = data['_type']
+            line = '%s\n%s\n' % (json.dumps({'index': meta}, separators=(',', ':')), json.dumps(data.get('_source', {})))
+            f.write(line)
+            stats['documents'] += 1
+            stats['bytes'] += len(line)
+            if progress and 0 == stats['documents'] % size:
+                progress(dict(_rate(stats, started)))
+    _rate(stats, started)
+    if progress:
+        progress(dict(stats))
+    logging.info('Exported %(documents)d documents (%(rate).0f docs/s)' % stats)
+    return stats
+
+def chunks(data, chunk_size):
+    """
+    Yields the (start, end) offsets of successive chunks of data, of at least
+    chunk_size bytes except for the last one, ending before an action line.
+    """
+    start = 0
+    size = len(data)
+    while start < size:
+        cut = data.find(ACTION, start + max(chunk_size, 1) - 1)
+        end = size if cut < 0 else cut + 1
+        yield start, end
+        start = end
+
+def open_mmap(path):
+    """
+    A read-only memory map of the file at path, decompressed first if it is gzipped,
+    or None if it is empty.
+    """
+    f = open(path, 'rb')
+    try:
+        if GZIP_MAGIC == f.read(2):
+            f.close()
+            f = tempfile.TemporaryFile()
+            source = gzip.open(path, 'rb')
+            try:
+                shutil.copyfileobj(source, f, 1024 * 1024)
+            finally:
+                source.close()
+            f.flush()
+        f.seek(0, 2)
+        if not f.tell():
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        # the map stays valid once the file is closed
+        f.close()
+
+def load(client, path, chunk_size=5 * 1024 * 1024, workers=4, retries=2, backoff=1, progress=None):
+    """
+    Indexes the documents of the file at path, written by export, in client's
+    index (and type), posting chunks of about chunk_size bytes from 'workers'
+    threads. A chunk whose _bulk request fails or is refused as a whole with a
+    413, 429 or 5xx status is posted again up to 'retries' times, after backoff
+    seconds, doubled each time. progress, if given, is called with a dict of
+    statistics after each chunk.
+
+    Returns the statistics, with the errors of the bulk actions.
+    """
+    data = open_mmap(path)
+    stats = {'chunks': 0, 'documents': 0, 'errors': [], 'bytes': 0, 'elapsed': 0.0, 'rate': 0.0}
+    if None == data:
+        return stats
+
+    def post(offsets):
+        # a copy of the chunk: the transports and compression need a str
+        body = data[offsets[0]:offsets[1]]
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(backoff * 2 ** (attempt - 1))
+            try:
+                response = bulk.send(client, body)
+            except requests.exceptions.RequestException, e:
+                response, failure = None, str(e)
+            else:
+                failure = 'request failed'
+            if None == response:
+                found = [{'action': 'bulk', 'status': None, 'error': failure}]
+                continue
+            found = bulk.errors(response)
+            if not bulk.is_transient(response):
+                break
+        return body.count('\n') // 2, len(body), found
+
+    pool = ThreadPool(workers)
+    started = time.time()
+    try:
+        for count, size, errors in pool.imap_unordered(post, chunks(data, chunk_size)):
+            stats['chunks'] += 1
+            stats['documents'] += count
+            stats['bytes'] += size
+            stats['errors'].extend(errors)
+            _rate(stats, started)
+            if progress:
+                progress(dict(stats))
+            logging.info('Loaded %d documents (%d errors, %.0f docs/s)' % (
+                stats['documents'], len(stats['errors']), stats['rate']))
+    finally:
+        pool.terminate()
+        pool.join()
+        data.close()
+    return stats
+
+def main(argv=None):
+    from rubber.client import ElasticSearch
+
+    parser = optparse.OptionParser(usage='%prog export|import index[/type] file [options]')
+    parser.add_option('--url', default=None, help='base url of elasticsearch (settings.RUBBER_ELASTICSEARCH_URL by default)')
+    parser.add_option('--query', default=None, help='JSON query body selecting the exported documents')
+    parser.add_option('--size', type='int', default=500, help='documents per shard fetched by each scroll request')
+    parser.add_option('--chunk-size', dest='chunk_size', type='int', default=5 * 1024 * 1024,
+                      help='bytes posted by each bulk request')
+    parser.add_option('--workers', type='int', default=4, help='concurrent bulk requests')
+    parser.add_option('--retries', type='int', default=2, help='times a failed bulk request is sent again')
+    options, args = parser.parse_args(argv)
+    if len(args) != 3 or args[0] not in ('export', 'import'):
+        parser.error('expected export or import, an index[/type] and a file')
+
+    command, target, path = args
+    index_name, _, type = target.partition('/')
+    client = ElasticSearch(index_name, type or None, auto_index=False, base_url=options.url)
+
+    def report(stats):
+        sys.stdout.write('%d documents, %d errors, %.0f docs/s\n' % (
+            stats['documents'], len(stats.get('errors', ())), stats['rate']))
+
+    if 'export' == command:
+        query = json.loads(options.query) if options.query else None
+        export(client, path, query=query, size=options.size, progress=report)
+        return 0
+    stats = load(client, path, chunk_size=options.chunk_size, workers=options.workers, retries=options.retries,
+                 progress=report)
+    for error in stats['errors'][:10]:
+        sys.stderr.write('%s\n' % json.dumps(error))
+    return 1 if stats['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
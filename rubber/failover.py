@@ -0,0 +1,310 @@
+"""
+A connection pool tracking the health and latency of each elasticsearch node.
+
+Nodes that fail, answer with a 5xx status or answer slower than 'slow'
+seconds are ejected for 'cooldown' seconds once they have done so
+'max_failures' times in a row. Idempotent requests (GET, HEAD, searches,
+counts and multi-gets, but no scroll requests) failing on a node are retried
+on the next healthy one, after a jittered exponential backoff.
+
+With 'hedge' set to a percentile, an idempotent request still unanswered
+after that percentile of the latencies of the last 'hedge_window' to
+2 * 'hedge_window' requests is sent again to another node, and whichever
+response comes first is used. The other one is closed.
+"""
+import os
+import random
+import threading
+import time
+import Queue
+
+import requests
+from rubber.instrumentation import Histogram
+from rubber.resource import ConnectionPool, STREAM_KWARGS
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+IDEMPOTENT_ENDPOINTS = ('_search', '_count', '_msearch', '_mget')
+
+# latencies observed before hedging starts
+HEDGE_MIN_SAMPLES = 20
+
+def is_idempotent(method, path, params=None):
+    """
+    Whether the request can be sent again. Scroll requests cannot: each one
+    moves the scroll forward (or opens a new scroll context).
+    """
+    path, _, query = path.partition('?')
+    if 'scroll' in (params or {}) or 'scroll_id' in (params or {}) \
+            or 'scroll' in path.split('/') or 'scroll=' in query or 'scroll_id=' in query:
+        return False
+    if method.upper() in IDEMPOTENT_METHODS:
+        return True
+    return path.rstrip('/').rsplit('/', 1)[-1] in IDEMPOTENT_ENDPOINTS
+
+class NodeHealth(object):
+    def __init__(self, node):
+        self.node = node
+        self.latency = Histogram()
+        self.failures = 0
+        self.ejected_until = 0
+
+    def snapshot(self, now):
+        return {
+            'node': self.node,
+            'failures': self.failures,
+            'ejected_for': max(0, self.ejected_until - now),
+            'requests': self.latency.count,
+            'p50': self.latency.percentile(50),
+            'p99': self.latency.percentile(99),
+        }
+
+class LatencyWindow(object):
+    """
+    The latencies of the last 'size' to 2 * 'size' requests: observations are
+    kept in two histograms, the older one being dropped when the newer one is
+    full, so that percentiles follow changes of latency.
+    """
+    def __init__(self, size=500):
+        self.size = size
+        self.previous = Histogram()
+        self.current = Histogram()
+
+    @property
+    def count(self):
+        return self.previous.count + self.current.count
+
+    def observe(self, value):
+        self.current.observe(value)
+        if self.current.count >= self.size:
+            self.previous, self.current = self.current, Histogram()
+
+    def percentile(self, q):
+        merged = Histogram()
+        merged.counts = [a + b for a, b in zip(self.previous.counts, self.current.counts)]
+        merged.count = self.count
+        return merged.percentile(q)
+
+class Workers(object):
+    """
+    Daemon threads running functions, reused from one call to the next: a new
+    thread is only started when all of them are busy.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def submit(self, func, *args):
+        with self._lock:
+            if self._pid != os.getpid():
+                # the threads of a parent process are not forked
+                self._jobs = Queue.Queue()
+                self._idle = 0
+                self._pid = os.getpid()
+            spawn = not self._idle
+            if not spawn:
+                self._idle -= 1
+        self._jobs.put((func, args))
+        if spawn:
+            thread = threading.Thread(target=self._run, args=(self._jobs,), name='rubber-hedge')
+            thread.daemon = True
+            thread.start()
+
+    def _run(self, jobs):
+        while True:
+            func, args = jobs.get()
+            try:
+                func(*args)
+            except Exception:
+                pass
+            with self._lock:
+                self._idle += 1
+
+def discard(response, kwargs):
+    """
+    Gives back the connection of a response that will not be used: a
+    streamed body is left on the socket, which is then closed.
+    """
+    if any(key in kwargs for key in STREAM_KWARGS):
+        from rubber.streaming import release
+        release(response, False)
+
+class FailoverPool(ConnectionPool):
+    CONFIGURED = ConnectionPool.CONFIGURED + ('health',)
+
+    def __init__(self, base_url=None, pool_size=None, compression=None, retries=2, timeout=None, slow=None,
+                 max_failures=1, cooldown=30, backoff=0.05, hedge=None, hedge_window=500):
+        super(FailoverPool, self).__init__(base_url, pool_size=pool_size, compression=compression)
+        self.retries = retries
+        self.timeout = timeout
+        self.slow = slow
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.backoff = backoff
+        self.hedge = hedge
+        self.latency = LatencyWindow(hedge_window)
+        self.hedged = 0
+        self.workers = Workers()
+
+    def _configure(self, base_url, pool_size, compression):
+        super(FailoverPool, self)._configure(base_url, pool_size, compression)
+        self.health = dict((node, NodeHealth(node)) for node in self.nodes)
+
+    def next_node(self, exclude=()):
+        """
+        The next node in turn that is neither ejected nor excluded. When there
+        is none, the node whose ejection ends first, so that requests are
+        still attempted.
+        """
+        now = time.time()
+        with self._lock:
+            for i in range(len(self.nodes)):
+                node = self._cycle.next()
+                if node not in exclude and self.health[node].ejected_until <= now:
+                    return node
+            candidates = [health for node, health in self.health.items() if node not in exclude] or self.health.values()
+            return min(candidates, key=lambda health: health.ejected_until).node
+
+    def _succeeded(self, node, seconds):
+        with self._lock:
+            health = self.health[node]
+            health.latency.observe(seconds)
+            self.latency.observe(seconds)
+            if None != self.slow and seconds > self.slow:
+                self._failed(health)
+            else:
+                health.failures = 0
+
+    def _failed(self, health):
+        health.failures += 1
+        if health.failures >= self.max_failures:
+            health.ejected_until = time.time() + self.cooldown
+
+    def failed(self, node):
+        with self._lock:
+            self._failed(self.health[node])
+
+    def send(self, node, method, path, **kwargs):
+        """
+        Sends one request to node, recording its outcome. Returns the response,
+        or raises the exception of the request.
+        """
+        start = time.time()
+        try:
+            response = super(FailoverPool, self).send(node, method, path, **kwargs)
+        except requests.exceptions.RequestException:
+            self.failed(node)
+            raise
+        if response.status_code >= 500:
+            self.failed(node)
+        else:
+            self._succeeded(node, time.time() - start)
+        return response
+
+    def hedge_delay(self):
+        if None == self.hedge:
+            return None
+        with self._lock:
+            if self.latency.count < HEDGE_MIN_SAMPLES:
+                return None
+            return self.latency.percentile(self.hedge)
+
+    def hedged_send(self, node, method, path, delay, tried, **kwargs):
+        """
+        Sends the request to node, and to another node if no response came
+        after delay seconds. Returns the first response, or raises the
+        exception of the last request to fail. The response that comes too
+        late is discarded.
+
+        Both requests run in reused worker threads: the calling thread only
+        waits for the first response.
+        """
+        results = Queue.Queue()
+        lock = threading.Lock()
+        answered = []
+
+        def attempt(node):
+            try:
+                outcome = (True, self.send(node, method, path, **kwargs))
+            except Exception, e:
+                outcome = (False, e)
+            with lock:
+                if not answered:
+                    results.put(outcome)
+                    return
+            if outcome[0]:
+                discard(outcome[1], kwargs)
+
+        def start(node):
+            self.workers.submit(attempt, node)
+
+        start(node)
+        pending = 1
+        try:
+            ok, result = results.get(timeout=delay)
+        except Queue.Empty:
+            other = self.next_node(exclude=tried)
+            if other in tried:
+                ok, result = results.get()
+            else:
+                tried.append(other)
+                with self._lock:
+                    self.hedged += 1
+                start(other)
+                pending = 2
+                ok, result = results.get()
+        pending -= 1
+        while not ok and pending:
+            ok, result = results.get()
+            pending -= 1
+        with lock:
+            answered.append(True)
+        # a response that came in the meantime
+        while True:
+            try:
+                late_ok, late = results.get_nowait()
+            except Queue.Empty:
+                break
+            if late_ok:
+                discard(late, kwargs)
+        if not ok:
+            raise result
+        return result
+
+    def request(self, method, path, **kwargs):
+        kwargs = self.prepare(kwargs)
+        if None != self.timeout:
+            kwargs.setdefault('timeout', self.timeout)
+        idempotent = is_idempotent(method, path, kwargs.get('params'))
+        attempts = 1 + (self.retries if idempotent else 0)
+        delay = self.hedge_delay() if idempotent else None
+        tried = []
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+            node = self.next_node(exclude=tried)
+            tried.append(node)
+            try:
+                if None != delay and len(self.nodes) > 1:
+                    response = self.hedged_send(node, method, path, delay, tried, **kwargs)
+                else:
+                    response = self.send(node, method, path, **kwargs)
+            except requests.exceptions.RequestException:
+                if attempt == attempts - 1:
+                    raise
+                continue
+            if response.status_code < 500 or attempt == attempts - 1:
+                return response
+
+    def stats(self):
+        """
+        The health of each node and the number of hedged requests, along with
+        the stats of ConnectionPool.
+        """
+        now = time.time()
+        stats = super(FailoverPool, self).stats()
+        with self._lock:
+            stats.update({
+                'nodes': [self.health[node].snapshot(now) for node in self.nodes],
+                'hedged': self.hedged,
+            })
+        return stats
@@ -0,0 +1,216 @@
+"""
+Fan-out search: the same query sent concurrently to several indices, with
+their hits merged into one ranking.
+
+    from rubber.fanout import FanOut
+
+    results = FanOut().search([tenant1.elasticsearch, tenant2.elasticsearch, 'archive/article'],
+                              {'query': {'term': {'tag': 'news'}}}, size=20, timeout=0.5)
+    for hit in results:
+        ...
+    if results.partial:
+        logging.warning('No results from %s' % results.errors.keys())
+
+Each target returns its own best from + size hits, which are merged with a
+k-way merge on a heap, by descending _score or by the given sort. Targets that
+fail or do not answer within the timeout are left out of the results and
+listed in 'errors'.
+"""
+import copy
+import heapq
+import operator
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from rubber.columns import META_FIELDS, getter
+from rubber.resource import ConnectionPool, Resource
+from rubber.response import Hit, HitCollection
+
+DEFAULT_WORKERS = 8
+
+class FanOutResults(HitCollection):
+    """
+    The merged hits. 'errors' maps the targets that gave no results to the
+    reason why, 'timed_out' lists the targets that timed out, completely or
+    on some of their shards.
+    """
+    def __init__(self, dict_response, hit_class=Hit, errors=None, timed_out=None):
+        super(FanOutResults, self).__init__(dict_response, hit_class=hit_class)
+        self.errors = errors or {}
+        self.timed_out = timed_out or []
+
+    @property
+    def partial(self):
+        return bool(self.errors or self.timed_out)
+
+class _Descending(object):
+    """
+    Wraps a sort value so that larger values come first.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+def parse_sort(sort):
+    """
+    The [(field, descending)] of a search sort: a field, a list of fields or
+    {field: order} dicts, or None for descending _score.
+    """
+    if None == sort:
+        return [('_score', True)]
+    if isinstance(sort, (basestring, dict)):
+        sort = [sort]
+    fields = []
+    for spec in sort:
+        if isinstance(spec, basestring):
+            fields.append((spec, spec == '_score'))
+        else:
+            field, order = spec.items()[0]
+            if isinstance(order, dict):
+                order = order.get('order')
+            fields.append((field, (order or ('desc' if field == '_score' else 'asc')) == 'desc'))
+    return fields
+
+def sort_key(sort):
+    """
+    The function giving the merge key of a hit: the sort values elasticsearch
+    returned for it, or its _score.
+    """
+    fields = parse_sort(sort)
+    getters = [getter(field) if field not in META_FIELDS else operator.itemgetter(field) for field, descending in fields]
+    def key(hit):
+        values = hit.get('sort')
+        if None == values or len(values) != len(fields):
+            values = [get(hit) for get in getters]
+        return tuple(_Descending(value) if descending else value
+                     for value, (field, descending) in zip(values, fields))
+    return key
+
+def merge(hit_lists, key, limit):
+    """
+    The first 'limit' hits of the already sorted hit_lists, merged by key.
+    """
+    heap = []
+    for i, hits in enumerate(hit_lists):
+        if hits:
+            heap.append((key(hits[0]), i, 0))
+    heapq.heapify(heap)
+    merged = []
+    while heap and len(merged) < limit:
+        k, i, position = heapq.heappop(heap)
+        merged.append(hit_lists[i][position])
+        position += 1
+        if position < len(hit_lists[i]):
+            heapq.heappush(heap, (key(hit_lists[i][position]), i, position))
+    return merged
+
+class FanOut(object):
+    """
+    Runs fan-out searches on a pool of 'workers' threads. Targets given as
+    'index/type' paths are searched through 'pool' (a ConnectionPool by default).
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, pool=None):
+        self.workers = workers
+        self.pool = pool
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if None == self._executor:
+            with self._lock:
+                if None == self._executor:
+                    self._executor = ThreadPool(self.workers)
+        return self._executor
+
+    def resource(self, target):
+        """
+        The search Resource of a client, a Resource, or an 'index/type' path.
+        """
+        if isinstance(target, basestring):
+            if None == self.pool:
+                with self._lock:
+                    if None == self.pool:
+                        self.pool = ConnectionPool()
+            return Resource(target.strip('/') + '/_search', pool=self.pool, endpoint='search')
+        return getattr(target, 'search', target)
+
+    def name(self, target):
+        if isinstance(target, basestring):
+            return target
+        return getattr(target, 'path', None) or target.makepath(None)
+
+    def search(self, targets, query=None, size=10, sort=None, timeout=None, hit_class=Hit, **kwargs):
+        """
+        Searches targets (clients, search Resources or 'index/type' paths) and
+        returns the merged FanOutResults. 'from' can be given in query; sort
+        and size override those of query. timeout (in seconds) bounds the wait
+        for every target, and is also passed to elasticsearch as the search
+        timeout of each shard.
+        """
+        query = copy.deepcopy(query or {})
+        start = query.pop('from', 0)
+        query['size'] = start + size
+        if None != sort:
+            query['sort'] = sort
+        if None != timeout:
+            query['timeout'] = '%dms' % (timeout * 1000)
+            kwargs.setdefault('timeout', timeout)
+
+        targets = [(self.name(target), self.resource(target)) for target in targets]
+        pending = [(name, self.executor.apply_async(resource.post, (), dict(kwargs, data=query)))
+                   for name, resource in targets]
+
+        deadline = None if None == timeout else time.time() + timeout
+        hit_lists, errors, timed_out = [], {}, []
+        total, max_score = 0, None
+        for name, result in pending:
+            try:
+                if None == deadline:
+                    response = result.get()
+                else:
+                    response = result.get(max(0, deadline - time.time()))
+            except TimeoutError:
+                errors[name] = 'timed out'
+                timed_out.append(name)
+                continue
+            except Exception, e:
+                errors[name] = repr(e)
+                continue
+            data = None != response and response.json or None
+            if None == data or response.status_code >= 300 or 'hits' not in data:
+                errors[name] = (data or {}).get('error') or 'No response'
+                continue
+            if data.get('timed_out'):
+                timed_out.append(name)
+            hits = data['hits']
+            total += hits.get('total') or 0
+            if None != hits.get('max_score'):
+                max_score = max(max_score, hits['max_score'])
+            hit_lists.append(hits.get('hits', []))
+
+        merged = merge(hit_lists, sort_key(sort or query.get('sort')), start + size)[start:]
+        return FanOutResults({'total': total, 'max_score': max_score, 'hits': merged},
+                             hit_class=hit_class, errors=errors, timed_out=timed_out)
+
+_default = None
+_default_lock = threading.Lock()
+
+def search(targets, query=None, **kwargs):
+    """
+    FanOut.search on a shared FanOut.
+    """
+    global _default
+    with _default_lock:
+        if None == _default:
+            _default = FanOut()
+    return _default.search(targets, query, **kwargs)
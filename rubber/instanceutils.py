@@ -1,29 +1,227 @@
+import datetime
+import decimal
+import sys
+import time
+
 from requests.compat import json
+from rubber import instrumentation
 
 def data_to_json(data):
+    if not instrumentation.hooks['serialized']:
+        return _data_to_json(data)
+    start = time.time()
+    result = _data_to_json(data)
+    instrumentation.emit('serialized', {
+        'seconds': time.time() - start,
+        'bytes': len(result) if isinstance(result, basestring) else 0,
+    })
+    return result
+
+def _data_to_json(data):
 
     # convert dicts
     if isinstance(data, dict):
         return json.dumps(data)
 
     # convert objects that have a to_indexed_json method
-    if 'to_indexed_json' in dir(data):
-        return data.to_indexed_json()
+    to_indexed_json = getattr(data, 'to_indexed_json', None)
+    if None != to_indexed_json:
+        return to_indexed_json()
 
     # convert django models
-    try:
-        from django.db import models
-        if isinstance(data, models.Model):
-            from django.core import serializers
-            from django.core.serializers.json import DjangoJSONEncoder
-            return json.dumps(serializers.serialize("python", [data])[0]['fields'], cls=DjangoJSONEncoder)
-    except ImportError:
-        pass
+    serializer = _serializers.get(type(data))
+    if None == serializer and _is_model(data):
+        serializer = get_serializer(type(data))
+    if None != serializer:
+        return serializer(data)
 
     return data
 
+_NATIVE_TYPES = frozenset([str, unicode, int, long, float, bool, type(None), list, tuple, dict])
+
+def value_to_json(value):
+    """
+    The JSON of a single value, such as a query parameter: models and objects
+    with a to_indexed_json method the way data_to_json serializes them, other
+    values with json.dumps, dates, times and decimals included.
+    """
+    if type(value) in _NATIVE_TYPES or (None == getattr(value, 'to_indexed_json', None) and not _is_model(value)):
+        return json.dumps(value, default=_json_default)
+    return _data_to_json(value)
+
+_default = None
+
+def _json_default(value):
+    global _default
+    if None == _default:
+        try:
+            from django.core.exceptions import ImproperlyConfigured
+        except ImportError:
+            ImproperlyConfigured = ImportError
+        try:
+            from django.core.serializers.json import DjangoJSONEncoder
+            _default = DjangoJSONEncoder().default
+        except (ImportError, ImproperlyConfigured):
+            _default = _plain_default
+    return _default(value)
+
+def _plain_default(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    raise TypeError('%r is not JSON serializable' % (value,))
+
 def get_pk(instance):
     if hasattr(instance, 'pk'):
         return instance.pk
     return None
 
+_model_class = None
+
+def _is_model(data):
+    global _model_class
+    if None == _model_class:
+        # no model can exist before django.db.models is imported: this avoids
+        # importing it again and again when django is missing or unconfigured
+        models = sys.modules.get('django.db.models')
+        if None == getattr(models, 'Model', None):
+            return False
+        _model_class = models.Model
+    return isinstance(data, _model_class)
+
+_serializers = {}
+
+def get_serializer(model):
+    """
+    Returns the function serializing instances of model, built once per model.
+    """
+    serializer = _serializers.get(model)
+    if None == serializer:
+        serializer = _serializers[model] = ModelSerializer(model)
+    return serializer
+
+def _fast_dumps():
+    """
+    json.dumps, or the dumps function of a faster encoder if RUBBER_FAST_JSON
+    is set and one is installed. Faster encoders may not format the output
+    the same way.
+    """
+    from rubber import settings
+    if getattr(settings, 'RUBBER_FAST_JSON', False):
+        try:
+            import ujson
+            return ujson.dumps
+        except ImportError:
+            pass
+    return json.dumps
+
+class ModelSerializer(object):
+    """
+    Serializes the concrete fields of a django model the way
+    serializers.serialize("python", ...) followed by json.dumps(..., cls=DjangoJSONEncoder)
+    does, without the serialization framework: the fields and the way to
+    convert each of them are looked up once for all.
+    """
+    def __init__(self, model):
+        import django
+        from django.core.serializers.json import DjangoJSONEncoder
+        from django.db.models.fields import Field
+        try:
+            from django.utils.encoding import smart_text
+        except ImportError:
+            from django.utils.encoding import smart_unicode as smart_text
+        from django.utils.encoding import is_protected_type
+
+        self.dumps = _fast_dumps()
+        convert = DjangoJSONEncoder().default
+        native_types = (type(None), bool, int, long, float)
+        # DjangoJSONEncoder output for the most common types, without isinstance checks
+        converters = {
+            datetime.datetime: convert,
+            datetime.date: datetime.date.isoformat,
+            datetime.time: convert,
+            decimal.Decimal: str,
+        }
+        text_types = (str, unicode)
+        base_value_to_string = Field.value_to_string.im_func
+
+        def plain_field(field):
+            attname = field.attname
+            value_to_string = field.value_to_string
+            # Field.value_to_string only coerces to unicode, which json.dumps does too
+            keeps_text = field.value_to_string.im_func is base_value_to_string
+            def get(obj):
+                value = getattr(obj, attname)
+                value_type = type(value)
+                if value_type in native_types:
+                    return value
+                if keeps_text and value_type in text_types:
+                    return value
+                converter = converters.get(value_type)
+                if None != converter:
+                    return converter(value)
+                if is_protected_type(value):
+                    # dates, times and decimals
+                    if isinstance(value, native_types):
+                        return value
+                    return convert(value)
+                return value_to_string(obj)
+            return get
+
+        def fk_field(field):
+            attname = field.attname
+            def get(obj):
+                value = getattr(obj, attname)
+                converter = converters.get(type(value))
+                if None != converter:
+                    return converter(value)
+                if is_protected_type(value) and not isinstance(value, native_types):
+                    return convert(value)
+                return value
+            return get
+
+        def m2m_field(field):
+            name = field.name
+            def get(obj):
+                return [smart_text(related._get_pk_val(), strings_only=True)
+                        for related in getattr(obj, name).iterator()]
+            return get
+
+        meta = getattr(model._meta, 'concrete_model', model)._meta
+        self.fields = []
+        for field in meta.local_fields:
+            if field.serialize:
+                if field.rel is None:
+                    self.fields.append((field.name, plain_field(field)))
+                else:
+                    self.fields.append((field.name, fk_field(field)))
+        if django.VERSION >= (1, 8):
+            many_to_many = meta.local_many_to_many
+        else:
+            many_to_many = meta.many_to_many
+        for field in many_to_many:
+            if field.serialize and field.rel.through._meta.auto_created:
+                self.fields.append((field.name, m2m_field(field)))
+
+    def values(self, obj):
+        values = {}
+        for name, get in self.fields:
+            values[name] = get(obj)
+        return values
+
+    def __call__(self, obj):
+        return self.dumps(self.values(obj))
+
+def data_to_values(data):
+    """
+    The fields of the document indexed for data, along with data_to_json(data).
+    """
+    if isinstance(data, dict):
+        return data, data_to_json(data)
+    if None == getattr(data, 'to_indexed_json', None) and _is_model(data):
+        serializer = get_serializer(type(data))
+        values = serializer.values(data)
+        return values, serializer.dumps(values)
+    source = data_to_json(data)
+    return json.loads(source), source
@@ -0,0 +1,188 @@
+"""
+Instrumentation of the requests made by rubber.
+
+Functions registered for an event are called with a dict describing it:
+
+  - 'pre_request': endpoint, method, path
+  - 'post_request': endpoint, method, path, seconds, request_bytes,
+    response_bytes, status_code, took (as reported by Elasticsearch) and
+    error (the exception, if the request failed)
+  - 'serialized': seconds, bytes (each call to data_to_json)
+  - 'parsed': endpoint, method, seconds (wrapping a response, i.e. parsing its hits)
+
+When nothing is registered, instrumentation costs one dict lookup per event.
+Exceptions raised by registered functions are logged, never propagated to the
+request.
+
+MetricsCollector is an in-process collector keeping per endpoint latency
+histograms and counters, cheap enough to leave on in production:
+
+    collector = MetricsCollector().install()
+    ...
+    export(collector.snapshot())
+"""
+import logging
+import re
+import threading
+from bisect import bisect_left
+
+EVENTS = ('pre_request', 'post_request', 'serialized', 'parsed')
+
+hooks = dict((event, []) for event in EVENTS)
+
+# the hook lists are replaced rather than mutated, so that emit can iterate
+# them without taking the lock
+_hooks_lock = threading.Lock()
+
+def register(event, func):
+    with _hooks_lock:
+        hooks[event] = hooks[event] + [func]
+
+def unregister(event, func):
+    with _hooks_lock:
+        if func in hooks[event]:
+            hooks[event] = [hook for hook in hooks[event] if hook != func]
+
+def emit(event, info):
+    for func in hooks[event]:
+        try:
+            func(info)
+        except Exception:
+            logging.exception('Instrumentation hook %r failed on %s' % (func, event))
+
+_TOOK = re.compile(r'"took"\s*:\s*(\d+)')
+
+def took(content):
+    """
+    The 'took' property of a response body, without parsing the whole of it.
+    """
+    match = _TOOK.search(content[:200])
+    if match:
+        return int(match.group(1))
+    return None
+
+class Histogram(object):
+    """
+    A latency histogram with fixed buckets, in seconds.
+    """
+    BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket holding the q-th percentile (None past the last bound).
+        """
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        buckets = []
+        seen = 0
+        for bound, count in zip(self.BOUNDS + ('+Inf',), self.counts):
+            seen += count
+            buckets.append((bound, seen))
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+class EndpointStats(object):
+    def __init__(self):
+        self.latency = Histogram()
+        self.parsing = Histogram()
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.took = 0
+        self.errors = 0
+        self.status_codes = {}
+
+    def snapshot(self):
+        return {
+            'latency': self.latency.snapshot(),
+            'parsing': self.parsing.snapshot(),
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+            'took': self.took,
+            'errors': self.errors,
+            'status_codes': dict(self.status_codes),
+        }
+
+class MetricsCollector(object):
+    """
+    Collects, per endpoint (the HANDLERS key, 'document', 'bulk'...) and method,
+    latencies, parsing times, payload sizes, status codes and the time reported
+    by Elasticsearch, plus the serialization times of data_to_json.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = {}
+            self.serialization = Histogram()
+            self.serialized_bytes = 0
+
+    def install(self):
+        register('post_request', self.post_request)
+        register('serialized', self.serialized)
+        register('parsed', self.parsed)
+        return self
+
+    def uninstall(self):
+        unregister('post_request', self.post_request)
+        unregister('serialized', self.serialized)
+        unregister('parsed', self.parsed)
+
+    def _stats(self, info):
+        key = '%s.%s' % (info.get('endpoint') or 'other', info.get('method', '').upper())
+        stats = self.endpoints.get(key)
+        if None == stats:
+            stats = self.endpoints[key] = EndpointStats()
+        return stats
+
+    def post_request(self, info):
+        with self._lock:
+            stats = self._stats(info)
+            stats.latency.observe(info['seconds'])
+            stats.request_bytes += info.get('request_bytes') or 0
+            stats.response_bytes += info.get('response_bytes') or 0
+            stats.took += info.get('took') or 0
+            if None != info.get('error'):
+                stats.errors += 1
+            status_code = info.get('status_code')
+            if None != status_code:
+                stats.status_codes[status_code] = stats.status_codes.get(status_code, 0) + 1
+
+    def serialized(self, info):
+        with self._lock:
+            self.serialization.observe(info['seconds'])
+            self.serialized_bytes += info.get('bytes') or 0
+
+    def parsed(self, info):
+        with self._lock:
+            self._stats(info).parsing.observe(info['seconds'])
+
+    def snapshot(self):
+        """
+        The collected metrics, as a dict of plain python types.
+        """
+        with self._lock:
+            return {
+                'endpoints': dict((key, stats.snapshot()) for key, stats in self.endpoints.items()),
+                'serialization': self.serialization.snapshot(),
+                'serialized_bytes': self.serialized_bytes,
+            }
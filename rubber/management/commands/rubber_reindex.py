@@ -0,0 +1,59 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rubber.reindex import get_model, reindex
+
+class Command(BaseCommand):
+    args = '<app_label.ModelName app_label.ModelName ...>'
+    help = 'Indexes every row of the given models in Elasticsearch.'
+
+    option_list = getattr(BaseCommand, 'option_list', ()) + (
+        make_option('--attribute', dest='attribute', default=None,
+                    help='Name of the rubber.ElasticSearch attribute of the models (the first one by default).'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+                    help='Number of rows indexed at once by a worker.'),
+        make_option('--processes', dest='processes', type='int', default=None,
+                    help='Number of worker processes (one per CPU by default, 0 to index in this process).'),
+        make_option('--state-file', dest='state_file', default=None,
+                    help='File recording the last indexed chunk, used to resume an interrupted reindex.'),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='+')
+        parser.add_argument('--attribute', default=None)
+        parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=1000)
+        parser.add_argument('--processes', type=int, default=None)
+        parser.add_argument('--state-file', dest='state_file', default=None)
+
+    def handle(self, *args, **options):
+        labels = args or options.get('models')
+        if not labels:
+            raise CommandError('Enter at least one app_label.ModelName.')
+
+        for label in labels:
+            try:
+                app_label, model_name = label.split('.')
+            except ValueError:
+                raise CommandError('Models must be given as app_label.ModelName, not %r.' % label)
+            try:
+                model = get_model(app_label, model_name)
+            except LookupError:
+                model = None
+            if None == model:
+                raise CommandError('Unknown model: %s' % label)
+
+            state_file = options.get('state_file')
+            if state_file and len(labels) > 1:
+                state_file = '%s.%s' % (state_file, label)
+
+            def progress(stats):
+                self.stdout.write('%s: %d documents, %d errors, %.0f docs/s, last pk %s\n' % (
+                    label, stats['documents'], stats['errors'], stats['rate'], stats['last_pk']))
+
+            reindex(model,
+                    name=options.get('attribute'),
+                    chunk_size=options.get('chunk_size') or 1000,
+                    processes=options.get('processes'),
+                    state_file=state_file,
+                    progress=progress)
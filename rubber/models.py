@@ -1 +1 @@
-from django.db import models
+# rubber has no models: this module only makes it a django app, for its management commands.
@@ -0,0 +1,178 @@
+"""
+Batching of searches with the _msearch endpoint.
+
+    with MultiSearch():
+        articles = Article.elasticsearch.search.post(query1)
+        users = users_client.search(query2)
+    # both searches were sent as one _msearch request
+
+Inside the with block, searches made on the search endpoint of any client
+return a pending SearchResponse right away. They are all sent on exit (or
+as soon as one of the pending responses is used), one _msearch request per
+cluster, and each one is then wrapped by its own client, with its own
+hit_class.
+
+Search parameters go to the header lines when _msearch supports them there
+(search_type, routing, preference...), or into the query when they have a
+body equivalent (size, from...). Searches with other parameters or request
+options (headers, timeout...) are sent directly.
+"""
+from collections import OrderedDict
+
+from requests.compat import json
+from rubber import resource
+from rubber.instanceutils import data_to_json
+from rubber.resource import Resource
+from rubber.response import SearchResponse
+
+# search parameters of the _msearch header lines
+HEADER_PARAMS = ('index', 'type', 'search_type', 'routing', 'preference',
+                 'ignore_unavailable', 'allow_no_indices', 'expand_wildcards')
+
+# search parameters ignored in header lines, moved into the query
+BODY_PARAMS = ('size', 'from', 'timeout', 'explain', 'version', 'track_scores', 'terminate_after')
+
+class SubResponse(object):
+    """
+    The part of a _msearch response answering one search.
+    """
+    def __init__(self, response, data):
+        self.json = data
+        self.headers = getattr(response, 'headers', {})
+        if None == response:
+            self.status_code = None
+        elif 'error' in data:
+            self.status_code = data.get('status', 500)
+        else:
+            self.status_code = 200
+
+    @property
+    def content(self):
+        return json.dumps(self.json)
+
+class PendingSearchResponse(SearchResponse):
+    """
+    The SearchResponse of a search that has not been sent yet: using it
+    sends the pending searches of its MultiSearch.
+    """
+    def __init__(self, multisearch):
+        self._multisearch = multisearch
+
+    def __getattr__(self, attr):
+        if '_response' not in self.__dict__ and not attr.startswith('__'):
+            self._multisearch.execute()
+            if '_response' in self.__dict__:
+                return getattr(self, attr)
+        return super(PendingSearchResponse, self).__getattr__(attr)
+
+    def _resolve(self, response):
+        self.__dict__.update(response.__dict__)
+
+def _cluster(resource):
+    """
+    What identifies the elasticsearch cluster a resource sends its requests to:
+    the nodes of its connection pool, or the transport itself.
+    """
+    nodes = getattr(resource.pool, 'nodes', None)
+    if nodes:
+        return tuple(nodes)
+    if None != resource.pool:
+        return id(resource.pool)
+    return repr(resource.base_url)
+
+class MultiSearch(object):
+    def __init__(self, raise_on_error=False):
+        self.raise_on_error = raise_on_error
+        self._searches = []
+
+    def __len__(self):
+        return len(self._searches)
+
+    def __enter__(self):
+        stack = resource.collecting.__dict__.setdefault('multisearches', [])
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        resource.collecting.multisearches.remove(self)
+        if None == exc_type:
+            self.execute()
+
+    def add(self, client_or_resource, query=None, **params):
+        """
+        Queues a search on a client (or on a search Resource), and returns its pending SearchResponse.
+        params are search parameters of the _msearch header line (search_type, routing, preference...),
+        or of the query (size, from...).
+        """
+        if not self.accepts({'params': params}):
+            raise ValueError('Search parameters not supported by _msearch: %s' % ', '.join(
+                sorted(set(params) - set(HEADER_PARAMS + BODY_PARAMS))))
+        search = getattr(client_or_resource, 'search', client_or_resource)
+        return self.collect(search, query, params)
+
+    def accepts(self, kwargs):
+        """
+        Whether a search made with these request kwargs can be sent through _msearch.
+        """
+        if set(kwargs) - set(['params']):
+            return False
+        return not set(kwargs.get('params') or ()) - set(HEADER_PARAMS + BODY_PARAMS)
+
+    def collect(self, search, query, params=None):
+        params = params or {}
+        header = dict((key, value) for key, value in params.items() if key in HEADER_PARAMS)
+        body = dict((key, value) for key, value in params.items() if key in BODY_PARAMS)
+        if body:
+            if None == query:
+                query = {}
+            elif not isinstance(query, dict):
+                query = json.loads(data_to_json(query))
+            query = dict(query, **body)
+        pending = PendingSearchResponse(self)
+        self._searches.append((search, query, header, pending))
+        return pending
+
+    def execute(self):
+        """
+        Sends the pending searches as one _msearch request per cluster (searches
+        of clients on other elasticsearch nodes are sent apart),
+        and returns their responses in the order they were added.
+        """
+        searches, self._searches = self._searches, []
+        groups = OrderedDict()
+        for search in searches:
+            groups.setdefault(_cluster(search[0]), []).append(search)
+        for group in groups.values():
+            self._send(group)
+        return [pending for search, query, params, pending in searches]
+
+    def _send(self, searches):
+        lines = []
+        for search, query, params, pending in searches:
+            header = dict(params)
+            tokens = search.path.split('/')[:-1]
+            if tokens:
+                header['index'] = tokens[0]
+            if len(tokens) > 1:
+                header['type'] = tokens[1]
+            lines.append(json.dumps(header))
+            body = data_to_json(query or {})
+            if '\n' in body:
+                # NDJSON: a query must fit on one line
+                body = json.dumps(json.loads(body))
+            lines.append(body)
+        first = searches[0][0]
+        response = Resource('_msearch',
+                            base_url=first.base_url,
+                            pool=first.pool,
+                            raise_on_error=self.raise_on_error).post(data='\n'.join(lines) + '\n')
+
+        items = []
+        if None != response:
+            items = (response.json or {}).get('responses', [])
+        for i, (search, query, params, pending) in enumerate(searches):
+            if i < len(items):
+                data = items[i]
+            else:
+                data = {'error': 'No response from _msearch'}
+            pending._resolve(search.wrapper(SubResponse(response, data)))
@@ -0,0 +1,159 @@
+"""
+Rebuilding the index of a django model.
+
+The table is walked in chunks of consecutive primary keys. Each chunk is
+loaded without caching, serialized and sent as one _bulk request by a pool
+of worker processes. The last completed chunk can be recorded in a state
+file, so that an interrupted reindex resumes where it stopped.
+"""
+import logging
+import os
+import time
+from collections import deque
+from itertools import imap
+from multiprocessing import Pool, cpu_count
+
+from requests.compat import json
+
+def find_client_name(model):
+    """
+    Name of the first rubber.ElasticSearch attribute of model.
+    """
+    from rubber.client import ElasticSearchDescriptor
+    for klass in model.__mro__:
+        for name, value in vars(klass).items():
+            if isinstance(value, ElasticSearchDescriptor):
+                return name
+    raise ValueError('%s has no rubber.ElasticSearch attribute' % model.__name__)
+
+def get_model(app_label, model_name):
+    try:
+        from django.apps import apps
+    except ImportError:
+        from django.db.models import get_model
+        return get_model(app_label, model_name)
+    return apps.get_model(app_label, model_name)
+
+def chunks(model, chunk_size, start=None):
+    """
+    Yields (after, last) primary key bounds of successive chunks of at most chunk_size rows.
+    Only the primary keys of one chunk are loaded at a time.
+    """
+    queryset = model._default_manager.order_by('pk').values_list('pk', flat=True)
+    after = start
+    while True:
+        page = queryset
+        if None != after:
+            page = page.filter(pk__gt=after)
+        pks = list(page[:chunk_size])
+        if not pks:
+            return
+        yield after, pks[-1]
+        after = pks[-1]
+
+def index_chunk(task):
+    """
+    Indexes the rows of a chunk. Runs in the worker processes.
+    """
+    model, name, after, last = task
+    from rubber.instanceutils import get_pk
+    if isinstance(model, tuple):
+        model = get_model(*model)
+    client = getattr(model, name)
+    queryset = model._default_manager.order_by('pk').filter(pk__lte=last)
+    if None != after:
+        queryset = queryset.filter(pk__gt=after)
+
+    count = 0
+    with client.bulk(max_actions=None) as bulk:
+        for instance in queryset.iterator():
+            bulk.index(get_pk(instance), instance)
+            count += 1
+    if len(bulk) or any(None == error.get('_id') for error in bulk.errors):
+        # the _bulk request failed: the chunk must not be recorded as done
+        raise IOError('Could not index the rows of pks %s to %s' % (after, last))
+    return last, count, len(bulk.errors)
+
+def _init_worker():
+    # each process needs its own database connection
+    from django.db import connection
+    connection.close()
+
+def read_state(state_file):
+    if not state_file or not os.path.exists(state_file):
+        return None
+    with open(state_file) as f:
+        return json.load(f).get('last_pk')
+
+def write_state(state_file, last_pk):
+    tmp_file = '%s.tmp' % state_file
+    with open(tmp_file, 'w') as f:
+        json.dump({'last_pk': last_pk}, f)
+    os.rename(tmp_file, state_file)
+
+def submit(pool, window, tasks):
+    """
+    Yields the results of index_chunk for tasks in order, with at most 'window'
+    tasks queued. Tasks are read in the calling thread (unlike with pool.imap,
+    which reads them in a thread of its own): the chunk queries use this
+    thread's database connection, and their errors are raised here.
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(index_chunk, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def reindex(model, name=None, chunk_size=1000, processes=None, start=None, state_file=None, progress=None):
+    """
+    Indexes every row of model with its rubber.ElasticSearch attribute 'name'
+    (the first one found by default), using 'processes' worker processes
+    (one per CPU by default, 0 to index in the current process).
+
+    Indexing starts after primary key 'start', or after the last completed chunk
+    recorded in state_file. progress, if given, is called with a dict of statistics
+    after each chunk.
+
+    Returns the statistics of the last chunk. Raises an IOError, after recording
+    the chunks completed before it, if the _bulk request of a chunk fails.
+    """
+    from django.db import connection
+
+    name = name or find_client_name(model)
+    if None == start:
+        start = read_state(state_file)
+
+    pool = None
+    if processes == 0:
+        tasks = ((model, name, after, last) for after, last in chunks(model, chunk_size, start))
+        results = imap(index_chunk, tasks)
+    else:
+        # worker processes look the model up by name
+        label = (model._meta.app_label, model._meta.object_name)
+        connection.close()
+        pool = Pool(processes, initializer=_init_worker)
+        results = submit(pool, 2 * (processes or cpu_count()),
+                         ((label, name, after, last) for after, last in chunks(model, chunk_size, start)))
+
+    stats = {'chunks': 0, 'documents': 0, 'errors': 0, 'last_pk': start, 'elapsed': 0.0, 'rate': 0.0}
+    started = time.time()
+    try:
+        for last, count, errors in results:
+            stats['chunks'] += 1
+            stats['documents'] += count
+            stats['errors'] += errors
+            stats['last_pk'] = last
+            stats['elapsed'] = time.time() - started
+            stats['rate'] = stats['documents'] / (stats['elapsed'] or 1e-9)
+            if state_file:
+                write_state(state_file, last)
+            if progress:
+                progress(dict(stats))
+            logging.info('Indexed %(documents)d documents (%(errors)d errors, %(rate).0f docs/s) up to pk %(last_pk)s' % stats)
+    finally:
+        if None != pool:
+            pool.terminate()
+            pool.join()
+    return stats
@@ -1,41 +1,247 @@
+import itertools
+import os
+import threading
+import time
+
 import requests
-from rubber import settings
+from rubber import instrumentation, settings
 from rubber.testutils import ResponseMock
+from compression import make_compression
 from instanceutils import data_to_json
+from transport import Transport
+
+DEFAULT_POOL_SIZE = 10
+
+# requests keyword argument that leaves the response body on the socket
+if requests.__version__.split('.')[0] == '0':
+    STREAM_KWARGS = {'prefetch': False}
+else:
+    STREAM_KWARGS = {'stream': True}
+
+# searches collected by the active rubber.multisearch.MultiSearch, per thread
+collecting = threading.local()
+
+def default_base_url():
+    base_url = getattr(settings, 'RUBBER_ELASTICSEARCH_URL', None)
+    if None == base_url:
+        base_url = 'http://localhost:9200/'
+    return base_url
+
+class ConnectionPool(Transport):
+    """
+    A keep-alive HTTP session shared by several resources, spreading
+    requests round-robin over one or more elasticsearch nodes.
+
+    The settings giving the defaults of base_url, pool_size and compression
+    are only read on first use, not when the pool is created.
+    """
+    # attributes set by _configure
+    CONFIGURED = ('base_url', 'nodes', 'pool_size', 'compression', '_cycle')
+
+    def __init__(self, base_url=None, pool_size=None, compression=None):
+        if None != base_url and not isinstance(base_url, basestring):
+            base_url = list(base_url)
+            if not base_url:
+                raise ValueError('At least one elasticsearch node is required')
+
+        self._options = (base_url, pool_size, compression)
+        self._configure_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    def __getattr__(self, name):
+        if name not in self.CONFIGURED or '_options' not in self.__dict__:
+            raise AttributeError(name)
+        with self._configure_lock:
+            if name not in self.__dict__:
+                self._configure(*self._options)
+        return self.__dict__[name]
+
+    def _configure(self, base_url, pool_size, compression):
+        if None == base_url:
+            base_url = default_base_url()
+        if isinstance(base_url, basestring):
+            nodes = [base_url]
+        else:
+            nodes = list(base_url)
+
+        if None == pool_size:
+            pool_size = getattr(settings, 'RUBBER_POOL_SIZE', None) or DEFAULT_POOL_SIZE
+
+        if None == compression:
+            compression = getattr(settings, 'RUBBER_COMPRESSION', None)
+
+        self.nodes = nodes
+        self.pool_size = pool_size
+        self.compression = make_compression(compression)
+        self._cycle = itertools.cycle(nodes)
+        self.base_url = base_url
+
+    def _makesession(self):
+        try:
+            # requests < 1.0 configures pooling on the session itself
+            return requests.session(config={
+                'keep_alive': True,
+                'pool_connections': len(self.nodes),
+                'pool_maxsize': self.pool_size,
+            })
+        except TypeError:
+            pass
+        from requests.adapters import HTTPAdapter
+        session = requests.session()
+        adapter = HTTPAdapter(pool_connections=len(self.nodes), pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @property
+    def session(self):
+        # a forked process must not share the connections of its parent
+        if None == self._session or self._pid != os.getpid():
+            with self._lock:
+                if None == self._session or self._pid != os.getpid():
+                    self._session = self._makesession()
+                    self._pid = os.getpid()
+        return self._session
+
+    def reset(self):
+        """
+        Drops the current session, so that the next request opens new connections.
+        """
+        with self._lock:
+            self._session = None
+
+    def next_node(self):
+        with self._lock:
+            return self._cycle.next()
+
+    def prepare(self, kwargs):
+        if None == self.compression:
+            return kwargs
+        return self.compression.prepare(kwargs)
+
+    def send(self, node, method, path, **kwargs):
+        response = self.session.request(method, node + path, **kwargs)
+        # streamed bodies are left on the socket for the caller
+        if None != self.compression and not any(key in kwargs for key in STREAM_KWARGS):
+            self.compression.measure(response)
+        return response
+
+    def request(self, method, path, **kwargs):
+        return self.send(self.next_node(), method, path, **self.prepare(kwargs))
+
+    def stats(self):
+        stats = {}
+        if None != self.compression:
+            stats['compression'] = self.compression.stats()
+        return stats
 
 class Resource(object):
-    def __init__(self, path, base_url=None, wrapper=None, raise_on_error=False):
+    def __init__(self, path, base_url=None, wrapper=None, raise_on_error=False, pool=None, endpoint=None, cache=None):
         self.path = path
         self.wrapper = wrapper or self._defaultwrapper
+        self.endpoint = endpoint
+        self.cache = cache
 
-        if None == base_url:
-            try:
-                base_url = settings.RUBBER_ELASTICSEARCH_URL
-            except AttributeError:
-                pass
+        if None == base_url and None != pool:
+            base_url = pool.base_url
 
         if None == base_url:
-            base_url = 'http://localhost:9200/'
+            base_url = default_base_url()
+
+        if None == pool and not isinstance(base_url, basestring):
+            pool = ConnectionPool(base_url)
 
         self.base_url = base_url
+        self.pool = pool
         self.raise_on_error = raise_on_error
 
     def _defaultwrapper(self, response):
         return response
 
+    def collector(self, method, kwargs):
+        """
+        The MultiSearch of the calling thread that collects this request, if any.
+        """
+        multisearches = getattr(collecting, 'multisearches', None)
+        if self.endpoint == 'search' and multisearches and method in ('GET', 'POST') \
+                and multisearches[-1].accepts(kwargs):
+            return multisearches[-1]
+        return None
+
     def request(self, method, data=None, **kwargs):
+        multisearch = self.collector(method, kwargs)
+        if None != multisearch:
+            return multisearch.collect(self, data, kwargs.get('params'))
+        if None != self.cache:
+            response = self.cache.request(self, method, data, **kwargs)
+        else:
+            response = self.send(method, data, **kwargs)
+        if None == response:
+            return None
+        if not instrumentation.hooks['parsed']:
+            return self.wrapper(response)
+        start = time.time()
+        wrapped = self.wrapper(response)
+        instrumentation.emit('parsed', {'endpoint': self.endpoint, 'method': method, 'seconds': time.time() - start})
+        return wrapped
+
+    def send(self, method, data=None, **kwargs):
+        """
+        Performs the request, returning the unwrapped response.
+        """
         if getattr(settings, 'RUBBER_MOCK_HTTP_RESPONSE', False):
-            return self.wrapper(ResponseMock(settings.RUBBER_MOCK_HTTP_RESPONSE))
-        path = self.base_url + self.path
+            return ResponseMock(settings.RUBBER_MOCK_HTTP_RESPONSE)
+        transport = getattr(settings, 'RUBBER_TRANSPORT', None) or self.pool
+        if None != transport:
+            path = self.path
+        else:
+            path = self.base_url + self.path
+        if instrumentation.hooks['pre_request'] or instrumentation.hooks['post_request']:
+            return self._instrumentedsend(transport, method, path, data, **kwargs)
+        return self._send(transport, method, path, data_to_json(data), **kwargs)
+
+    def _send(self, transport, method, path, body, **kwargs):
+        if None != transport:
+            send = transport.request
+        else:
+            send = requests.request
         try:
-            response = requests.request(method, path, data=data_to_json(data), **kwargs)
+            return send(method, path, data=body, **kwargs)
         except Exception, e:
             if self.raise_on_error:
                 raise
             import logging
             logging.exception('Could not perform %s %s' % (method.upper(), path))
             return None
-        return self.wrapper(response)
+
+    def _instrumentedsend(self, transport, method, path, data, **kwargs):
+        info = {'endpoint': self.endpoint, 'method': method, 'path': path}
+        instrumentation.emit('pre_request', info)
+        body = data_to_json(data)
+        info['request_bytes'] = len(body) if isinstance(body, basestring) else 0
+        response = None
+        start = time.time()
+        try:
+            response = self._send(transport, method, path, body, **kwargs)
+        except Exception, e:
+            info['error'] = e
+            raise
+        finally:
+            info['seconds'] = time.time() - start
+            if None != response:
+                info['status_code'] = response.status_code
+                info['response_bytes'] = int(response.headers.get('content-length') or 0)
+                # streamed bodies are left on the socket for the caller
+                if not any(key in kwargs for key in STREAM_KWARGS):
+                    content = response.content or ''
+                    info['response_bytes'] = len(content)
+                    info['took'] = instrumentation.took(content)
+            elif 'error' not in info:
+                info['error'] = 'request failed'
+            instrumentation.emit('post_request', info)
+        return response
 
     def get(self, data=None, **kwargs):
         return self.request('GET', data=data, **kwargs)
@@ -1,30 +1,58 @@
+_MISSING = object()
+
+def _wrap(val):
+    if isinstance(val, dict):
+        return Hit(val)
+    if isinstance(val, list):
+        return [_wrap(o) for o in val]
+    return val
+
 class Hit(object):
+    """
+    Object notation over a JSON hit. '_' properties are also available without
+    the underscore (hit.source is hit._source).
+
+    Nested dicts and lists are only wrapped when they are accessed, and the
+    wrappers are cached.
+    """
+    __slots__ = ('_data', '_cache')
+
     def __init__(self, dict_response):
-        self.attributes = {}
-        for key, val in dict_response.items():
-            if isinstance(val, dict):
-                self.attributes[key] = self._hit_or_val(val)
-            elif isinstance(val, list):
-                self.attributes[key] = [self._hit_or_val(o) for o in val]
-            else:
-                self.attributes[key] = val
+        self._data = dict_response
+        self._cache = {}
+
+    @property
+    def attributes(self):
+        return self._data
+
+    def __getattr__(self, name):
+        if name in Hit.__slots__:
+            raise AttributeError(name)
+        cache = self._cache
+        val = cache.get(name, _MISSING)
+        if val is not _MISSING:
+            return val
 
-    def _hit_or_val(self, val):
-        if isinstance(val, dict):
-            return Hit(val)
-        elif isinstance(val, list):
-            return Hit(val)
+        data = self._data
+        key = name
+        val = data.get(key, _MISSING)
+        if val is _MISSING:
+            if name[:1] == '_':
+                raise AttributeError(name)
+            key = '_' + name
+            val = cache.get(key, _MISSING)
+            if val is not _MISSING:
+                cache[name] = val
+                return val
+            val = data.get(key, _MISSING)
+            if val is _MISSING:
+                raise AttributeError(name)
+
+        if isinstance(val, (dict, list)):
+            val = _wrap(val)
+        cache[name] = cache[key] = val
         return val
 
-    def __getattribute__(self, name):
-        default_impl = super(Hit, self).__getattribute__
-        attributes = default_impl('attributes')
-        if attributes.has_key(name):
-            return attributes.get(name)
-        if not name.startswith('_') and attributes.has_key("_%s"%name):
-            return attributes.get("_%s"%name)
-        return default_impl(name)
-    
 import requests
 class Response(object):
     """
@@ -33,31 +61,107 @@ class Response(object):
     def __init__(self, response):
         self._response = response
 
-    def __getattribute__(self, attr):
-        if attr in ('_response', 'results'):
-            return super(Response, self).__getattribute__(attr)
-        return getattr(self._response, attr)
+    def __getattr__(self, attr):
+        # only called for the attributes missing from the proxy itself
+        if '_response' == attr:
+            raise AttributeError(attr)
+        value = getattr(self._response, attr)
+        if 'json' == attr and not callable(value):
+            # requests < 1.0 parses the body on each access of its json property
+            self.json = value
+        return value
 
 class SearchResponse(Response):
-    def __init__(self, response, hit_class=Hit):
+    def __init__(self, response, hit_class=Hit, model=None):
         super(SearchResponse, self).__init__(response)
+        self._hit_class = hit_class
+        self._model = model
+        # parsed right away, the hits are only wrapped when results is used
+        self.json
 
-        if self._response.json:
-            self.results = HitCollection(self._response.json.get('hits'), hit_class=hit_class)
-        else:
-            self.results = HitCollection({})
+    @property
+    def results(self):
+        results = self.__dict__.get('_results')
+        if None == results:
+            if self.json:
+                results = HitCollection(self.json.get('hits'), hit_class=self._hit_class, model=self._model)
+            else:
+                results = HitCollection({}, model=self._model)
+            self.__dict__['_results'] = results
+        return results
+
+    @results.setter
+    def results(self, value):
+        self.__dict__['_results'] = value
+
+    def columns(self, fields, types=None, use_numpy=True):
+        """
+        The values of fields (such as '_id', '_score', a stored field or a dotted
+        path in the source) for every hit, as an OrderedDict of one array per
+        field, without building any Hit object. See rubber.columns.
+        """
+        from rubber.columns import columns
+        return columns(((self.json or {}).get('hits') or {}).get('hits', []), fields, types, use_numpy)
+
+class BulkResponse(Response):
+    """
+    Response of a _bulk request. Failed actions are listed in 'errors',
+    so that one bad document does not hide the outcome of the others.
+    """
+    def __init__(self, response):
+        super(BulkResponse, self).__init__(response)
+
+        self.items = []
+        self.errors = []
+        for item in (self.json or {}).get('items', []):
+            for action, result in item.items():
+                result = dict(result, action=action)
+                self.items.append(result)
+                if result.get('error') or result.get('status', 200) >= 300:
+                    self.errors.append(result)
 
 class HitCollection(object):
-    def __init__(self, dict_response, hit_class=Hit):
+    def __init__(self, dict_response, hit_class=Hit, model=None):
         dict_response = dict_response or {}
         self.total = dict_response.get('total')
         self.max_score = dict_response.get('max_score')
+        self.model = model
+        self.ids = []
         self.hits = []
         for hit_dict in dict_response.get('hits', []):
+            self.ids.append(hit_dict.get('_id'))
             self.hits.append(hit_class(hit_dict))
+        self._instances = {}
 
     def __len__(self):
         return len(self.hits)
 
     def __getitem__(self, i):
         return self.hits[i]
+
+    def instances(self, select_related=None, only=None):
+        """
+        The django model instances of the hits, in the order of the hits, loaded
+        with one query. Hits without a matching row are skipped.
+        select_related (True or a list of fields) and only (a list of fields) are
+        applied to the queryset. The result is cached.
+        """
+        key = (select_related is True or tuple(select_related or ()), tuple(only or ()))
+        if key in self._instances:
+            return self._instances[key]
+        if None == self.model:
+            raise ValueError('These hits are not bound to a django model')
+
+        queryset = self.model._default_manager.all()
+        if select_related is True:
+            queryset = queryset.select_related()
+        elif select_related:
+            queryset = queryset.select_related(*select_related)
+        if only:
+            queryset = queryset.only(*only)
+
+        to_python = self.model._meta.pk.to_python
+        pks = [to_python(pk) for pk in self.ids]
+        rows = queryset.in_bulk(pks)
+        instances = self._instances[key] = [rows[pk] for pk in pks if pk in rows]
+        return instances
@@ -0,0 +1,96 @@
+"""
+Iteration over every hit of a search, using the scroll API.
+
+While the caller consumes a page of hits, the next page is fetched on a
+background thread. The scroll context is cleared once iteration stops,
+including when the generator is closed early.
+"""
+import threading
+
+from rubber.resource import Resource
+
+class _Fetch(threading.Thread):
+    def __init__(self, func, *args):
+        super(_Fetch, self).__init__(name='rubber-scroll')
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception, e:
+            self.error = e
+
+    def get(self):
+        self.join()
+        if None != self.error:
+            raise self.error
+        return self.result
+
+class _NowFetch(object):
+    """
+    Same interface as _Fetch, without a thread.
+    """
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def start(self):
+        pass
+
+    def get(self):
+        return self.func(*self.args)
+
+def scan(client, query=None, size=100, scroll='5m', search_type='scan', prefetch=True, **kwargs):
+    """
+    Yields client.hit_class objects for every hit matching query, 'size' hits
+    per shard and per request. Errors are raised, as silently stopping would
+    truncate the results.
+    """
+    def request(resource, method, data, **params):
+        response = Resource(resource, raise_on_error=True, pool=client.pool).request(method, data=data, params=params, **kwargs)
+        response.raise_for_status()
+        return response.json or {}
+
+    def next_page(scroll_id):
+        return request('_search/scroll', 'GET', scroll_id, scroll=scroll)
+
+    params = {'scroll': scroll, 'size': size}
+    if search_type:
+        params['search_type'] = search_type
+    page = request(client.makepath('_search'), 'POST', query, **params)
+    # a scan search returns no hits, only a scroll id
+    expect_hits = search_type != 'scan'
+    fetch_class = prefetch and _Fetch or _NowFetch
+    hit_class = client.hit_class
+    scroll_id = None
+    fetch = None
+    try:
+        while True:
+            scroll_id = page.get('_scroll_id', scroll_id)
+            hits = page.get('hits', {}).get('hits', [])
+            if expect_hits and not hits:
+                break
+            expect_hits = True
+
+            if scroll_id:
+                fetch = fetch_class(next_page, scroll_id)
+                fetch.start()
+            for hit in hits:
+                yield hit_class(hit)
+            if None == fetch:
+                break
+
+            page = fetch.get()
+            fetch = None
+    finally:
+        if None != fetch:
+            try:
+                scroll_id = fetch.get().get('_scroll_id', scroll_id)
+            except Exception:
+                pass
+        if scroll_id:
+            Resource('_search/scroll', pool=client.pool).delete(data=scroll_id)
@@ -0,0 +1,272 @@
+"""
+Incremental parsing of search responses.
+
+The response body is read chunk by chunk from the socket, and hits are
+decoded one at a time, so memory stays bounded by the size of one hit
+whatever the number of hits in the response.
+"""
+import re
+from collections import deque
+
+from requests.compat import json
+from rubber.response import Hit, Response
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.S)
+_STRUCTURE = re.compile(r'["\[\]{}]')
+_SCALAR_END = re.compile(r'[,\]}: \t\n\r]')
+
+_decode = json.JSONDecoder().raw_decode
+
+_QUOTE = ord('"')
+_OPENING = (ord('['), ord('{'))
+
+class JSONStream(object):
+    """
+    Reads JSON tokens and values from an iterable of string chunks.
+
+    The buffer is a bytearray that chunks are appended to in place. What has
+    been consumed is only dropped when a chunk is appended. Values within the
+    buffer are decoded from a string copy of it, made at most once per chunk;
+    values spanning several chunks are scanned once to find their end.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = bytearray()
+        self._text = None
+        self._pos = 0
+
+    def _fill(self):
+        """
+        Appends the next chunk to the buffer, after dropping the bytes before
+        self._pos. Returns the number of bytes dropped, by which positions in
+        the buffer move back, or None at the end of the stream.
+        """
+        for chunk in self._chunks:
+            if chunk:
+                dropped = self._pos
+                if dropped:
+                    del self._buf[:dropped]
+                    self._pos = 0
+                self._buf += chunk
+                self._text = None
+                return dropped
+        return None
+
+    def peek(self):
+        """
+        Returns the next non-whitespace character, or '' at the end of the stream.
+        """
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return chr(self._buf[self._pos])
+            if None == self._fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expected one of %r, got %r' % (chars, char))
+        self._pos += 1
+        return char
+
+    def _value_end(self):
+        """
+        Index in the buffer where the value starting at self._pos ends, reading
+        more chunks as needed. Scanning resumes where it stopped after each chunk.
+        """
+        buf = self._buf
+        i = self._pos
+        if buf[i] != _QUOTE and buf[i] not in _OPENING:
+            while True:
+                match = _SCALAR_END.search(buf, i)
+                if match:
+                    return match.start()
+                i = len(buf)
+                dropped = self._fill()
+                if None == dropped:
+                    return len(buf)
+                i -= dropped
+
+        depth = 0
+        in_string = False
+        while True:
+            if in_string:
+                # stops at the closing quote, or at the end of the buffer (before a trailing backslash)
+                i = _STRING_BODY.match(buf, i).end()
+                if i < len(buf) and buf[i] == _QUOTE:
+                    i += 1
+                    in_string = False
+                    if depth == 0:
+                        return i
+                    continue
+            else:
+                match = _STRUCTURE.search(buf, i)
+                if match:
+                    i = match.start()
+                    char = buf[i]
+                    i += 1
+                    if char == _QUOTE:
+                        in_string = True
+                    elif char in _OPENING:
+                        depth += 1
+                    else:
+                        depth -= 1
+                        if depth == 0:
+                            return i
+                    continue
+                i = len(buf)
+            dropped = self._fill()
+            if None == dropped:
+                raise ValueError('Unexpected end of JSON stream')
+            i -= dropped
+
+    def read_value(self):
+        if not self.peek():
+            raise ValueError('Unexpected end of JSON stream')
+        if None == self._text:
+            self._text = str(self._buf)
+        text = self._text
+        try:
+            value, end = _decode(text, self._pos)
+        except ValueError:
+            # the value goes on in the next chunks (or is invalid)
+            end = None
+        if None == end or (text[self._pos] not in '"[{' and not _SCALAR_END.match(text, end)):
+            # a number may go on too, unless followed by a delimiter
+            end = self._value_end()
+            value = json.loads(str(buffer(self._buf, self._pos, end - self._pos)))
+        self._pos = end
+        return value
+
+    def iter_keys(self):
+        """
+        Iterates over the keys of the object starting at the current position.
+        The caller must consume each value before asking for the next key.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def iter_items(self):
+        """
+        Iterates over the values of the array starting at the current position.
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.read_value()
+            if self.expect(',]') == ']':
+                return
+
+class StreamingHitCollection(object):
+    """
+    A HitCollection that builds hits one at a time while reading the response.
+    total and max_score are available as soon as they have been read. The hits
+    can only be iterated over once.
+
+    The top-level properties of the response (took, timed_out, facets...) are
+    collected in 'meta' as they are read.
+    """
+    def __init__(self, chunks, hit_class=Hit, response=None):
+        self.hit_class = hit_class
+        self.response = response
+        self.finished = False
+        self.meta = {}
+        self._hits_info = {}
+        self._pending = deque()
+        self._events = self._parse(JSONStream(chunks))
+        self._consumed = False
+
+    def _parse(self, stream):
+        """
+        Generator walking the response: it yields 'hit' once positioned at a
+        hit, after reading total / max_score when they come first.
+        """
+        if not stream.peek():
+            return
+        for key in stream.iter_keys():
+            if key != 'hits':
+                self.meta[key] = stream.read_value()
+                continue
+            for hits_key in stream.iter_keys():
+                if hits_key != 'hits':
+                    self._hits_info[hits_key] = stream.read_value()
+                    continue
+                for hit_dict in stream.iter_items():
+                    yield hit_dict
+        self.finished = True
+
+    def _read_info(self, name):
+        # Advance until 'name' is known, keeping the hits read on the way
+        while name not in self._hits_info:
+            try:
+                self._pending.append(self._events.next())
+            except StopIteration:
+                break
+        return self._hits_info.get(name)
+
+    @property
+    def total(self):
+        return self._read_info('total')
+
+    @property
+    def max_score(self):
+        return self._read_info('max_score')
+
+    def __iter__(self):
+        if self._consumed:
+            raise RuntimeError('The hits of a streaming response can only be iterated over once')
+        self._consumed = True
+        hit_class = self.hit_class
+        pending = self._pending
+        while True:
+            if pending:
+                yield hit_class(pending.popleft())
+                continue
+            try:
+                hit_dict = self._events.next()
+            except StopIteration:
+                return
+            yield hit_class(hit_dict)
+
+    def close(self):
+        """
+        Stops reading the response, and releases it.
+        """
+        self._events.close()
+        if None != self.response:
+            release(self.response, self.finished)
+
+def release(response, finished):
+    """
+    Gives the connection of a streamed response back to its pool, after closing
+    it if the body has not been read to the end, as it could not be reused.
+    """
+    raw = getattr(response, 'raw', None)
+    if not finished:
+        for name in ('_fp', '_connection'):
+            closing = getattr(raw, name, None)
+            if None != closing:
+                closing.close()
+    if hasattr(raw, 'release_conn'):
+        raw.release_conn()
+
+class StreamingSearchResponse(Response):
+    def __init__(self, response, hit_class=Hit, chunk_size=64 * 1024):
+        super(StreamingSearchResponse, self).__init__(response)
+        self.results = StreamingHitCollection(self._response.iter_content(chunk_size), hit_class=hit_class,
+                                              response=self._response)
+
+    def close(self):
+        self.results.close()
@@ -0,0 +1,112 @@
+"""
+Precompiled query templates.
+
+A QueryTemplate serializes a query body once, with Param placeholders for
+the values that change between searches. Binding it only serializes these
+values and splices them into the precomputed JSON:
+
+    from rubber.templates import Param, QueryTemplate
+
+    by_author = QueryTemplate({
+        'query': {'bool': {'must': [{'term': {'author': Param('author')}}, ...]}},
+        'size': Param('size', 10),
+    })
+
+    response = es.search.post(by_author(author='kimchy'))
+
+Bound templates have a to_indexed_json method, so every Resource method
+accepts them as data. Params stand for whole values (a string, a number, a
+date, a model, a list...), not for dict keys or parts of strings. A name
+can be used in several places, by Params with the same default.
+"""
+import uuid
+
+from requests.compat import json
+from rubber.instanceutils import value_to_json
+
+_MISSING = object()
+
+class Param(object):
+    def __init__(self, name, default=_MISSING):
+        self.name = name
+        self.default = default
+
+    def __repr__(self):
+        return 'Param(%r)' % self.name
+
+class QueryTemplate(object):
+    def __init__(self, body, dumps=value_to_json):
+        self.dumps = dumps
+        self.params = {}
+        # a marker that cannot appear in the JSON of body, standing for each param
+        marker = uuid.uuid4().hex
+        markers = {}
+
+        def substitute(value):
+            if isinstance(value, Param):
+                param = self.params.setdefault(value.name, value)
+                if param is not value and param.default != value.default:
+                    raise ValueError('Template parameter %s is defined twice, with different defaults' % value.name)
+                markers.setdefault(value.name, '%s:%d' % (marker, len(markers)))
+                return markers[value.name]
+            if isinstance(value, dict):
+                return dict((key, substitute(item)) for key, item in value.items())
+            if isinstance(value, (list, tuple)):
+                return [substitute(item) for item in value]
+            return value
+
+        serialized = dumps(substitute(body))
+        names = dict((json.dumps(token), name) for name, token in markers.items())
+
+        # alternate literal JSON chunks and param names
+        self.chunks = []
+        self.names = []
+        position = 0
+        while True:
+            start = serialized.find('"%s:' % marker, position)
+            if start < 0:
+                break
+            end = serialized.index('"', start + 1) + 1
+            self.chunks.append(serialized[position:start])
+            self.names.append(names[serialized[start:end]])
+            position = end
+        self.chunks.append(serialized[position:])
+
+    def render(self, **params):
+        """
+        The JSON of the body, with params in place of the placeholders.
+        """
+        unknown = set(params) - set(self.params)
+        if unknown:
+            raise TypeError('Unknown template parameters: %s' % ', '.join(sorted(unknown)))
+        dumps = self.dumps
+        parts = [self.chunks[0]]
+        for name, chunk in zip(self.names, self.chunks[1:]):
+            value = params.get(name, _MISSING)
+            if value is _MISSING:
+                value = self.params[name].default
+                if value is _MISSING:
+                    raise TypeError('Missing template parameter: %s' % name)
+            parts.append(dumps(value))
+            parts.append(chunk)
+        return ''.join(parts)
+
+    def __call__(self, **params):
+        return BoundQuery(self, params)
+
+    def to_indexed_json(self):
+        return self.render()
+
+class BoundQuery(object):
+    """
+    A template bound to parameter values, rendered once.
+    """
+    __slots__ = ('template', 'params', '_json')
+
+    def __init__(self, template, params):
+        self.template = template
+        self.params = params
+        self._json = template.render(**params)
+
+    def to_indexed_json(self):
+        return self._json
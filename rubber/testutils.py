@@ -1,4 +1,11 @@
+import itertools
+import threading
+import urlparse
+from collections import OrderedDict
+
 import requests
+from requests.compat import json
+from rubber.transport import Transport
 
 class ResponseMock(requests.models.Response):
     def __init__(self, content='{}'):
@@ -8,3 +15,331 @@ class ResponseMock(requests.models.Response):
         self.raw = StringIO(content)
         self.status_code = 200
         self._content = content
+
+SHARDS = {'total': 1, 'successful': 1, 'failed': 0}
+
+class FakeError(Exception):
+    def __init__(self, status, message):
+        super(FakeError, self).__init__(message)
+        self.status = status
+
+class FakeElasticSearch(Transport):
+    """
+    An in-memory elasticsearch, to be used as the transport of clients in tests:
+
+        fake = FakeElasticSearch()
+        es = ElasticSearch('articles', 'article', transport=fake)
+
+    or of every client, with settings.RUBBER_TRANSPORT = fake.
+
+    It stores documents per index and type and answers the document, _update,
+    _count, _mapping, _bulk, _mget and _msearch endpoints, and _search for match_all,
+    term, terms and ids queries with from, size, sort and scroll. Every request is
+    recorded in 'requests'. Instances share no state, so that tests running
+    in parallel can each use their own.
+    """
+    base_url = 'memory://'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """
+        Forgets every document, mapping and request. (reset, which drops the
+        connections of a transport, keeps them.)
+        """
+        with self._lock:
+            self.indices = {}
+            self.mappings = {}
+            self.requests = []
+            self.scrolls = {}
+            self._ids = itertools.count(1)
+
+    def documents(self, index, type=None):
+        """
+        The sources of the documents stored in index (and type), by id.
+        """
+        with self._lock:
+            documents = OrderedDict()
+            for doc_type, docs in self.indices.get(index, {}).items():
+                if None == type or doc_type == type:
+                    documents.update((id, source) for id, (version, source) in docs.items())
+            return documents
+
+    def request(self, method, path, data=None, params=None, **kwargs):
+        url = urlparse.urlparse(path)
+        params = dict(urlparse.parse_qsl(url.query), **(params or {}))
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        with self._lock:
+            body = data
+            try:
+                if data and not url.path.endswith(('_bulk', '_msearch', '_search/scroll')):
+                    try:
+                        body = json.loads(data)
+                    except ValueError:
+                        raise FakeError(400, 'ElasticSearchParseException[Failed to derive xcontent]')
+                status, result = 200, self.dispatch(method.upper(), url.path, params, body)
+            except FakeError, e:
+                status, result = e.status, {'error': str(e), 'status': e.status}
+            self.requests.append({'method': method.upper(), 'path': url.path, 'params': params, 'body': body})
+        response = ResponseMock(json.dumps(result))
+        response.status_code = status
+        response.url = path
+        response.headers['content-type'] = 'application/json; charset=UTF-8'
+        return response
+
+    def dispatch(self, method, path, params, body):
+        parts = [part for part in path.split('/') if part]
+        endpoint = None
+        for i, part in enumerate(parts):
+            if part.startswith('_'):
+                endpoint = parts[i:]
+                parts = parts[:i]
+                break
+        indices = parts[0].split(',') if parts and parts[0] != '_all' else []
+        types = parts[1].split(',') if len(parts) > 1 else []
+
+        if None == endpoint:
+            if len(parts) == 3:
+                return self.document(method, parts[0], parts[1], parts[2], body, params)
+            if len(parts) == 2 and method == 'POST':
+                return self.document('PUT', parts[0], parts[1], str(self._ids.next()), body, params)
+            if len(parts) == 1 and method == 'DELETE':
+                found = self.indices.pop(parts[0], None)
+                self.mappings.pop(parts[0], None)
+                if None == found:
+                    raise FakeError(404, 'IndexMissingException[[%s] missing]' % parts[0])
+                return {'ok': True, 'acknowledged': True}
+        elif ['_update'] == endpoint and len(parts) == 3 and method == 'POST':
+            index, type, id = parts
+            return {'ok': True, '_index': index, '_type': type, '_id': id,
+                    '_version': self.update(index, type, id, (body or {}).get('doc', {}))}
+        elif ['_search'] == endpoint:
+            return self.search(indices, types, body or {}, params)
+        elif ['_search', 'scroll'] == endpoint:
+            return self.scroll(method, body or params.get('scroll_id'))
+        elif ['_count'] == endpoint:
+            query = (body or {}).get('query', body) or {'match_all': {}}
+            return {'count': len(self.select(indices, types, query)), '_shards': SHARDS}
+        elif ['_mapping'] == endpoint:
+            return self.mapping(method, indices, types, body)
+        elif ['_bulk'] == endpoint:
+            return self.bulk(indices, types, body or '')
+        elif ['_mget'] == endpoint:
+            return self.mget(indices, types, body or {})
+        elif ['_msearch'] == endpoint:
+            return self.msearch(indices, types, body or '', params)
+        raise FakeError(400, 'No handler found for uri [%s] and method [%s]' % (path, method))
+
+    def document(self, method, index, type, id, body, params):
+        docs = self.indices.get(index, {}).get(type, {})
+        meta = {'_index': index, '_type': type, '_id': id}
+        if 'GET' == method:
+            if id not in docs:
+                raise FakeError(404, 'document [%s/%s/%s] missing' % (index, type, id))
+            version, source = docs[id]
+            return dict(meta, _version=version, exists=True, _source=source)
+        if 'DELETE' == method:
+            if docs.pop(id, None) is None:
+                raise FakeError(404, 'document [%s/%s/%s] missing' % (index, type, id))
+            return dict(meta, ok=True, found=True)
+        if not isinstance(body, dict):
+            raise FakeError(400, 'MapperParsingException[failed to parse]')
+        return dict(meta, ok=True, _version=self.store(index, type, id, body))
+
+    def store(self, index, type, id, source):
+        docs = self.indices.setdefault(index, {}).setdefault(type, OrderedDict())
+        version = docs[id][0] + 1 if id in docs else 1
+        docs[id] = (version, source)
+        return version
+
+    def update(self, index, type, id, fields):
+        found = self.indices.get(index, {}).get(type, {}).get(id)
+        if None == found:
+            raise FakeError(404, 'DocumentMissingException[[%s][0] [%s][%s]: document missing]' % (index, type, id))
+        return self.store(index, type, id, merge(found[1], fields))
+
+    def select(self, indices, types, query):
+        hits = []
+        for index in indices or sorted(self.indices):
+            for type, docs in sorted(self.indices.get(index, {}).items()):
+                if types and type not in types:
+                    continue
+                for id, (version, source) in docs.items():
+                    hit = {'_index': index, '_type': type, '_id': id, '_score': 1.0, '_source': source}
+                    if matches(hit, query):
+                        hits.append(hit)
+        return hits
+
+    def search(self, indices, types, body, params):
+        hits = self.select(indices, types, body.get('query') or {'match_all': {}})
+        sort = parse_sort(body.get('sort', params.get('sort')))
+        for field, reverse in reversed(sort):
+            present = [hit for hit in hits if None != value(hit, field)]
+            missing = [hit for hit in hits if None == value(hit, field)]
+            hits = sorted(present, key=lambda hit: value(hit, field), reverse=reverse) + missing
+        for hit in hits if sort else ():
+            hit['sort'] = [value(hit, field) for field, reverse in sort]
+        start = int(body.get('from', params.get('from', 0)))
+        size = int(body.get('size', params.get('size', 10)))
+        if 'count' == params.get('search_type'):
+            size = 0
+        result = {'took': 1, 'timed_out': False, '_shards': SHARDS, 'hits': {
+            'total': len(hits), 'max_score': 1.0 if hits else None, 'hits': hits[start:start + size],
+        }}
+        if params.get('scroll'):
+            # a scan search returns its first hits on the first scroll request
+            position = start if 'scan' == params.get('search_type') else start + size
+            if 'scan' == params.get('search_type'):
+                result['hits']['hits'] = []
+            result['_scroll_id'] = scroll_id = 'scroll%d' % self._ids.next()
+            self.scrolls[scroll_id] = (hits, position, size)
+        return result
+
+    def scroll(self, method, scroll_id):
+        if 'DELETE' == method:
+            for id in (scroll_id or '').split(','):
+                self.scrolls.pop(id, None)
+            return {'ok': True}
+        if scroll_id not in self.scrolls:
+            raise FakeError(404, 'SearchContextMissingException[No search context found for id [%s]]' % scroll_id)
+        hits, position, size = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (hits, position + size, size)
+        return {'_scroll_id': scroll_id, 'took': 1, 'timed_out': False, '_shards': SHARDS, 'hits': {
+            'total': len(hits), 'max_score': 1.0 if hits else None, 'hits': hits[position:position + size],
+        }}
+
+    def mapping(self, method, indices, types, body):
+        if method in ('PUT', 'POST'):
+            if not indices or not isinstance(body, dict):
+                raise FakeError(400, 'MapperParsingException[malformed mapping]')
+            for index in indices:
+                self.mappings.setdefault(index, {}).update(body)
+            return {'ok': True, 'acknowledged': True}
+        result = {}
+        for index in indices or sorted(self.mappings):
+            mappings = self.mappings.get(index, {})
+            result[index] = dict((type, mapping) for type, mapping in mappings.items() if not types or type in types)
+        return result
+
+    def bulk(self, indices, types, body):
+        items = []
+        lines = iter([line for line in body.split('\n') if line.strip()])
+        for line in lines:
+            action, meta = json.loads(line).items()[0]
+            index = meta.get('_index', indices[0] if indices else None)
+            type = meta.get('_type', types[0] if types else None)
+            id = str(meta['_id']) if None != meta.get('_id') else str(self._ids.next())
+            item = {'_index': index, '_type': type, '_id': id}
+            if 'delete' == action:
+                found = None != self.indices.get(index, {}).get(type, {}).pop(id, None)
+                item.update(ok=True, found=found)
+            elif 'update' == action:
+                fields = json.loads(lines.next()).get('doc', {})
+                try:
+                    item.update(ok=True, _version=self.update(index, type, id, fields))
+                except FakeError, e:
+                    item.update(error=str(e), status=e.status)
+            else:
+                source = json.loads(lines.next())
+                item.update(ok=True, _version=self.store(index, type, id, source))
+            items.append({action: item})
+        return {'took': 1, 'items': items}
+
+    def mget(self, indices, types, body):
+        docs = []
+        requested = body.get('docs') or [{'_id': id} for id in body.get('ids', [])]
+        for doc in requested:
+            index = doc.get('_index', indices[0] if indices else None)
+            type = doc.get('_type', types[0] if types else None)
+            id = str(doc['_id'])
+            found = self.indices.get(index, {}).get(type, {}).get(id)
+            meta = {'_index': index, '_type': type, '_id': id, 'exists': None != found}
+            if None != found:
+                meta.update(_version=found[0], _source=found[1])
+            docs.append(meta)
+        return {'docs': docs}
+
+    def msearch(self, indices, types, body, params):
+        responses = []
+        lines = iter([line for line in body.split('\n') if line.strip()])
+        for line in lines:
+            header = json.loads(line)
+            query = json.loads(lines.next())
+            index = header.get('index', indices)
+            type = header.get('type', types)
+            search_params = dict(params, **dict((key, header[key]) for key in ('search_type',) if key in header))
+            try:
+                responses.append(self.search(as_list(index), as_list(type), query, search_params))
+            except FakeError, e:
+                responses.append({'error': str(e)})
+        return {'responses': responses}
+
+def merge(source, fields):
+    """
+    source updated with fields, objects being merged recursively like _update does.
+    """
+    merged = dict(source)
+    for name, field in fields.items():
+        if isinstance(field, dict) and isinstance(merged.get(name), dict):
+            field = merge(merged[name], field)
+        merged[name] = field
+    return merged
+
+def as_list(value):
+    if isinstance(value, basestring):
+        return value.split(',')
+    return list(value or [])
+
+def value(hit, field):
+    """
+    The value of a (dotted) field of a hit.
+    """
+    if field in ('_id', '_score', '_type', '_index'):
+        return hit[field]
+    current = hit['_source']
+    for name in field.split('.'):
+        if not isinstance(current, dict):
+            return None
+        current = current.get(name)
+    return current
+
+def parse_sort(sort):
+    """
+    The [(field, reverse)] of the sort of a search.
+    """
+    if not sort:
+        return []
+    if isinstance(sort, basestring):
+        sort = sort.split(',')
+    if isinstance(sort, dict):
+        sort = [sort]
+    fields = []
+    for spec in sort:
+        if isinstance(spec, basestring):
+            field, _, order = spec.partition(':')
+        else:
+            field, order = spec.items()[0]
+            if isinstance(order, dict):
+                order = order.get('order')
+        fields.append((field, (order or ('desc' if field == '_score' else 'asc')) == 'desc'))
+    return fields
+
+def matches(hit, query):
+    kind, spec = query.items()[0]
+    if 'match_all' == kind:
+        return True
+    if 'ids' == kind:
+        return hit['_id'] in [str(id) for id in spec.get('values', [])]
+    if kind in ('term', 'terms'):
+        field, expected = spec.items()[0]
+        if 'term' == kind:
+            expected = [expected.get('value') if isinstance(expected, dict) else expected]
+        actual = value(hit, field)
+        actual = actual if isinstance(actual, list) else [actual]
+        if '_id' == field:
+            expected = [str(id) for id in expected]
+        return any(item in expected for item in actual)
+    raise FakeError(400, 'SearchPhaseExecutionException[unsupported query [%s]]' % kind)
@@ -0,0 +1,36 @@
+"""
+What resources send their requests through.
+
+A transport takes a method, a path relative to the elasticsearch root
+('articles/article/_search') and the keyword arguments of requests.request,
+and returns a requests.models.Response. ConnectionPool sends the requests
+over HTTP; rubber.testutils.FakeElasticSearch answers them from memory.
+
+A transport is given to a client with its 'transport' argument, or to every
+resource with the RUBBER_TRANSPORT setting.
+"""
+import abc
+
+class Transport(object):
+    """
+    Base class of transports: subclasses must implement request, and can
+    override reset and stats.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    base_url = None
+
+    @abc.abstractmethod
+    def request(self, method, path, **kwargs):
+        """
+        Sends the request and returns its response.
+        """
+
+    def reset(self):
+        """
+        Drops any connection, so that the next request opens new ones.
+        """
+        pass
+
+    def stats(self):
+        return {}
@@ -12,6 +12,8 @@ setup(
     url='https://github.com/cantinasoftware/rubber',
     packages=[
         'rubber',
+        'rubber.management',
+        'rubber.management.commands',
         'tests'
     ],
     requires=[
@@ -5,6 +5,7 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+from contextlib import contextmanager
 from unittest import TestCase
 from rubber import Resource
 
@@ -15,9 +16,13 @@ from rubber.testutils import ResponseMock
 class RequestMock(object):
     def __init__(self):
         self.stack = []
+        self.sessions = []
     def request(self, method, url, **kwargs):
         self.stack.append({'method': method, 'url':url, 'kwargs': kwargs})
         return ResponseMock()
+    def session(self, **kwargs):
+        self.sessions.append(kwargs)
+        return self
 
 
 
@@ -77,6 +82,1114 @@ class ResourceTest(TestCase):
         except ImportError:
             pass
 
+class ScriptedRequestMock(RequestMock):
+    """
+    A RequestMock returning the given response bodies in turn, then '{}'
+    """
+    def __init__(self, *bodies):
+        super(ScriptedRequestMock, self).__init__()
+        self.bodies = list(bodies)
+    def request(self, method, url, **kwargs):
+        super(ScriptedRequestMock, self).request(method, url, **kwargs)
+        if self.bodies:
+            return ResponseMock(self.bodies.pop(0))
+        return ResponseMock()
+
+class ConnectionPoolTest(TestCase):
+    def setUp(self):
+        from rubber import settings, resource
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+        self.requestmock = RequestMock()
+        resource.requests = self.requestmock
+
+    def test_shared_session(self):
+        """
+        All the resources of a client should share one pooled session
+        """
+        from rubber import ElasticSearch
+        client = ElasticSearch('foo', 'bar', base_url='http://example.com:9200/', pool_size=42)
+        client.search({})
+        client.count()
+        client.get(1)
+        client.put(1, {})
+
+        self.assertEquals(4, len(self.requestmock.stack))
+        self.assertEquals(1, len(self.requestmock.sessions))
+        self.assertEquals(42, self.requestmock.sessions[0]['config']['pool_maxsize'])
+        self.assertEquals('http://example.com:9200/foo/bar/1', self.requestmock.stack[2]['url'])
+
+    def test_round_robin(self):
+        """
+        When given a list of nodes, requests should be spread over all of them
+        """
+        import rubber
+        rubber.settings.RUBBER_ELASTICSEARCH_URL = ['http://node1:9200/', 'http://node2:9200/']
+        try:
+            client = rubber.ElasticSearch('foo', 'bar')
+            for i in range(4):
+                client.search({})
+        finally:
+            rubber.settings.RUBBER_ELASTICSEARCH_URL = None
+
+        self.assertEquals(['http://node1:9200/foo/bar/_search', 'http://node2:9200/foo/bar/_search'] * 2,
+                          [call['url'] for call in self.requestmock.stack])
+
+class NodeRequestMock(RequestMock):
+    """
+    Fails or delays the requests sent to some nodes.
+    """
+    def __init__(self, down=(), delays=None, statuses=None):
+        super(NodeRequestMock, self).__init__()
+        self.down = down
+        self.delays = delays or {}
+        self.statuses = statuses or {}
+    def request(self, method, url, **kwargs):
+        super(NodeRequestMock, self).request(method, url, **kwargs)
+        import time
+        import requests
+        node = url.split('/')[2]
+        if node in self.down:
+            raise requests.exceptions.ConnectionError('%s is down' % node)
+        time.sleep(self.delays.get(node, 0))
+        response = ResponseMock('{"node": "%s"}' % node)
+        response.status_code = self.statuses.get(node, 200)
+        return response
+
+@contextmanager
+def unconfigured_django():
+    """
+    Runs the block as if django was installed without a configured project.
+    """
+    import os
+    import django.conf
+    import rubber
+    wrapped = rubber.settings.__dict__.pop('_wrapped', None)
+    django_settings = django.conf.settings
+    module = os.environ.pop('DJANGO_SETTINGS_MODULE', None)
+    django.conf.settings = django.conf.LazySettings()
+    try:
+        yield
+    finally:
+        if None != module:
+            os.environ['DJANGO_SETTINGS_MODULE'] = module
+        django.conf.settings = django_settings
+        if None != wrapped:
+            rubber.settings.__dict__['_wrapped'] = wrapped
+
+class SettingsTest(TestCase):
+    def test_lazy_base_url(self):
+        """
+        The default base url should be read from the settings on the first request, not when the client is created
+        """
+        from rubber import settings, resource, ElasticSearch
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+        resource.requests = RequestMock()
+        client = ElasticSearch('foo', 'bar', failover=True)
+        previous = getattr(settings, 'RUBBER_ELASTICSEARCH_URL', None)
+        settings.RUBBER_ELASTICSEARCH_URL = 'http://late.com:9200/'
+        try:
+            client.get(1)
+        finally:
+            settings.RUBBER_ELASTICSEARCH_URL = previous
+        self.assertEquals('http://late.com:9200/foo/bar/1', resource.requests.stack[0]['url'])
+        self.assertEquals(['http://late.com:9200/'], client.pool.health.keys())
+
+    def test_unconfigured_django(self):
+        """
+        Clients should work with defaults when django is installed but no project is configured
+        """
+        import rubber
+        from rubber import resource, ElasticSearch
+        with unconfigured_django():
+            client = ElasticSearch('foo', 'bar')
+            self.assertFalse(rubber.settings.RUBBER_MOCK_HTTP_RESPONSE)
+            resource.requests = RequestMock()
+            client.get(1)
+        self.assertEquals('http://localhost:9200/foo/bar/1', resource.requests.stack[0]['url'])
+
+class FailoverPoolTest(TestCase):
+    def setUp(self):
+        from rubber import settings
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+
+    def client(self, requestmock, **failover):
+        from rubber import resource, ElasticSearch
+        resource.requests = requestmock
+        return ElasticSearch('foo', 'bar', base_url=['http://node1:9200/', 'http://node2:9200/'], failover=failover or True)
+
+    def test_eject(self):
+        """
+        Idempotent requests failing on a node should be retried on another one, which is then the only one used
+        """
+        requestmock = NodeRequestMock(down=['node1:9200'])
+        client = self.client(requestmock, backoff=0)
+        for i in range(3):
+            self.assertEquals('node2:9200', client.search({}).json['node'])
+        self.assertEquals(['node1:9200', 'node2:9200', 'node2:9200', 'node2:9200'],
+                          [call['url'].split('/')[2] for call in requestmock.stack])
+
+        stats = client.pool.stats()
+        self.assertTrue(stats['nodes'][0]['ejected_for'] > 0)
+        self.assertEquals(0, stats['nodes'][1]['ejected_for'])
+
+    def test_cooldown(self):
+        """
+        Ejected nodes should be tried again after the cool-down
+        """
+        requestmock = NodeRequestMock(statuses={'node1:9200': 503})
+        client = self.client(requestmock, backoff=0, cooldown=0)
+        self.assertEquals(200, client.count({}).status_code)
+        requestmock.statuses = {}
+        client.count({})
+        client.count({})
+        self.assertEquals(['node1:9200', 'node2:9200', 'node1:9200', 'node2:9200'],
+                          [call['url'].split('/')[2] for call in requestmock.stack])
+
+    def test_not_idempotent(self):
+        """
+        Writes should not be retried
+        """
+        requestmock = NodeRequestMock(down=['node1:9200'])
+        client = self.client(requestmock, backoff=0)
+        self.assertEquals(None, client.put(1, {}))
+        self.assertEquals(1, len(requestmock.stack))
+
+    def test_hedge(self):
+        """
+        Idempotent requests slower than the latency percentile should be sent to another node, the late response discarded
+        """
+        import threading
+        import time
+        requestmock = NodeRequestMock()
+        client = self.client(requestmock, hedge=90)
+        for i in range(20):
+            client.search({})
+
+        requestmock.delays = {'node1:9200': 0.5}
+        del requestmock.stack[:]
+        from rubber import failover
+        discarded = []
+        discard = failover.discard
+        failover.discard = lambda response, kwargs: discarded.append(response.json['node'])
+        try:
+            response = client.search({})
+            self.assertEquals('node2:9200', response.json['node'])
+            self.assertEquals(['node1:9200', 'node2:9200'], [call['url'].split('/')[2] for call in requestmock.stack])
+            self.assertEquals(1, client.pool.stats()['hedged'])
+            time.sleep(0.6)
+        finally:
+            failover.discard = discard
+        self.assertEquals(['node1:9200'], discarded)
+
+        # worker threads are reused
+        requestmock.delays = {}
+        for i in range(20):
+            client.search({})
+        self.assertTrue(len([thread for thread in threading.enumerate() if thread.name == 'rubber-hedge']) <= 3)
+
+    def test_latency_window(self):
+        """
+        The hedge delay should follow the latencies of the last requests
+        """
+        from rubber.failover import LatencyWindow
+        window = LatencyWindow(10)
+        for i in range(20):
+            window.observe(0.001)
+        self.assertEquals(0.001, window.percentile(90))
+        for i in range(20):
+            window.observe(1)
+        self.assertEquals(1.0, window.percentile(50))
+        self.assertTrue(10 <= window.count < 20)
+
+    def test_scroll(self):
+        """
+        Scroll requests should be neither retried nor hedged, as each one moves the scroll forward
+        """
+        from rubber.failover import is_idempotent
+        from rubber.resource import Resource
+        self.assertFalse(is_idempotent('GET', '_search/scroll'))
+        self.assertFalse(is_idempotent('GET', '_search/scroll?scroll=5m'))
+        self.assertFalse(is_idempotent('POST', 'foo/bar/_search', {'scroll': '5m', 'search_type': 'scan'}))
+        self.assertTrue(is_idempotent('POST', 'foo/bar/_search', {'size': 10}))
+
+        requestmock = NodeRequestMock(down=['node1:9200'])
+        client = self.client(requestmock, backoff=0)
+        self.assertEquals(None, Resource('_search/scroll', pool=client.pool).get(data='c2Nhbjs1', params={'scroll': '5m'}))
+        self.assertEquals(1, len(requestmock.stack))
+
+        requestmock = NodeRequestMock()
+        client = self.client(requestmock, hedge=90)
+        for i in range(20):
+            client.search({})
+        requestmock.delays = {'node1:9200': 0.2}
+        del requestmock.stack[:]
+        Resource('_search/scroll', pool=client.pool).get(data='c2Nhbjs1', params={'scroll': '5m'})
+        self.assertEquals(['node1:9200'], [call['url'].split('/')[2] for call in requestmock.stack])
+        self.assertEquals(0, client.pool.stats()['hedged'])
+
+class CompressionTest(TestCase):
+    def setUp(self):
+        from rubber import settings, resource
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+        self.requestmock = RequestMock()
+        resource.requests = self.requestmock
+
+    def test_request(self):
+        """
+        Request bodies above the threshold should be sent gzipped, and the ratio reported in the client stats
+        """
+        import zlib
+        from rubber import ElasticSearch
+        client = ElasticSearch('foo', 'bar', base_url='http://example.com:9200/', compression=100)
+        client.put(1, {'title': 'foo'})
+        client.put(2, {'title': 'foo ' * 100})
+
+        small, big = self.requestmock.stack
+        self.assertEquals('{"title": "foo"}', small['kwargs']['data'])
+        self.assertFalse('Content-Encoding' in small['kwargs']['headers'])
+        self.assertEquals('gzip', big['kwargs']['headers']['Content-Encoding'])
+        self.assertEquals('gzip', big['kwargs']['headers']['Accept-Encoding'])
+        self.assertEquals(json.dumps({'title': 'foo ' * 100}), zlib.decompress(big['kwargs']['data'], 16 + zlib.MAX_WBITS))
+
+        stats = client.stats()['compression']
+        self.assertEquals(len(json.dumps({'title': 'foo ' * 100})), stats['request_bytes'])
+        self.assertEquals(len(big['kwargs']['data']), stats['compressed_request_bytes'])
+        self.assertTrue(stats['request_ratio'] < 0.1)
+        self.assertEquals(None, stats['response_ratio'])
+
+    def test_response(self):
+        """
+        Sizes of gzip encoded responses should be recorded
+        """
+        from rubber import ElasticSearch
+        from rubber.testutils import ResponseMock
+        content = '{"hits": {"total": 0, "hits": []}}'
+        def request(method, url, **kwargs):
+            response = ResponseMock(content)
+            response.headers['content-encoding'] = 'gzip'
+            response.headers['content-length'] = '10'
+            return response
+        self.requestmock.request = request
+        client = ElasticSearch('foo', 'bar', base_url='http://example.com:9200/', compression={'min_size': 10 ** 6})
+        client.search({})
+        stats = client.stats()['compression']
+        self.assertEquals(len(content), stats['response_bytes'])
+        self.assertEquals(10.0 / len(content), stats['response_ratio'])
+        self.assertEquals(0, stats['request_bytes'])
+
+    def test_disabled(self):
+        """
+        Without compression, requests should be left untouched
+        """
+        from rubber import ElasticSearch
+        client = ElasticSearch('foo', 'bar', base_url='http://example.com:9200/')
+        client.put(2, {'title': 'foo ' * 1000})
+        self.assertFalse('headers' in self.requestmock.stack[0]['kwargs'])
+        self.assertEquals({}, client.stats())
+
+class FakeElasticSearchTest(TestCase):
+    def setUp(self):
+        from rubber import settings, ElasticSearch
+        from rubber.testutils import FakeElasticSearch
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+        self.fake = FakeElasticSearch()
+        self.client = ElasticSearch('foo', 'bar', transport=self.fake)
+        for pk, user, tags, age in ((1, 'kimchy', ['a', 'b'], 30), (2, 'bob', ['b'], 25), (3, 'alice', [], 35)):
+            self.client.put(pk, {'user': user, 'tags': tags, 'profile': {'age': age}})
+
+    def tearDown(self):
+        from rubber import settings
+        settings.RUBBER_TRANSPORT = None
+
+    def search(self, query, **body):
+        body['query'] = query
+        return [hit.id for hit in self.client.search(body).results]
+
+    def test_reset(self):
+        """
+        Resetting the connections of a client should keep the documents, which clear() forgets
+        """
+        from rubber.transport import Transport
+        self.assertRaises(TypeError, Transport)
+        self.client.pool.reset()
+        self.assertEquals(3, len(self.fake.documents('foo', 'bar')))
+        self.fake.clear()
+        self.assertEquals({}, self.fake.documents('foo', 'bar'))
+
+    def test_documents(self):
+        """
+        Documents should be stored, fetched, versioned and deleted per index and type
+        """
+        self.assertEquals({'user': 'bob', 'tags': ['b'], 'profile': {'age': 25}}, self.client.get(2).json['_source'])
+        self.assertEquals(2, self.client.put(2, {'user': 'bobby'}).json['_version'])
+        self.assertEquals(['1', '2', '3'], self.fake.documents('foo', 'bar').keys())
+        self.assertEquals(200, self.client.delete(2).status_code)
+        self.assertEquals(404, self.client.get(2).status_code)
+        self.assertEquals(404, self.client.delete(2).status_code)
+        self.assertEquals({}, self.fake.documents('foo', 'baz'))
+
+        self.assertEquals(['PUT', 'PUT', 'PUT', 'GET', 'PUT', 'DELETE', 'GET', 'DELETE'],
+                          [request['method'] for request in self.fake.requests])
+        self.assertEquals({'user': 'bobby'}, self.fake.requests[4]['body'])
+        self.assertEquals('foo/bar/2', self.fake.requests[4]['path'])
+
+    def test_search(self):
+        """
+        match_all, term, terms and ids queries should be supported, along with from, size and sort
+        """
+        self.assertEquals(['1', '2', '3'], self.search({'match_all': {}}))
+        self.assertEquals(['1'], self.search({'term': {'user': 'kimchy'}}))
+        self.assertEquals(['1', '2'], self.search({'term': {'tags': 'b'}}))
+        self.assertEquals(['2', '3'], self.search({'terms': {'user': ['bob', 'alice', 'eve']}}))
+        self.assertEquals(['3', '1'], self.search({'ids': {'values': [3, 1]}}, sort='_id:desc'))
+        self.assertEquals(['3', '1', '2'], self.search({'match_all': {}}, sort=[{'profile.age': 'desc'}]))
+        self.assertEquals(['1'], self.search({'match_all': {}}, sort=['profile.age'], size=1, **{'from': 1}))
+
+        response = self.client.search({'query': {'term': {'tags': 'b'}}, 'size': 1})
+        self.assertEquals(2, response.results.total)
+        self.assertEquals(2, self.client.count({'term': {'tags': 'b'}}).json['count'])
+
+        response = self.client.search({'query': {'fuzzy': {'user': 'kimchi'}}})
+        self.assertEquals(400, response.status_code)
+
+    def test_endpoints(self):
+        """
+        _mapping, _bulk, _mget and _msearch requests should be answered from memory
+        """
+        self.client.mapping.put({'bar': {'properties': {'user': {'type': 'string'}}}})
+        self.assertEquals({'foo': {'bar': {'properties': {'user': {'type': 'string'}}}}}, self.client.mapping.get().json)
+
+        with self.client.bulk() as bulk:
+            bulk.index(4, {'user': 'eve'})
+            bulk.delete(1)
+        self.assertEquals([], bulk.errors)
+        self.assertEquals(['2', '3', '4'], self.fake.documents('foo').keys())
+
+        self.assertEquals([False, True], [hit.found for hit in self.client.get_many([1, 4])])
+        first, second = self.client.msearch([{'query': {'term': {'user': 'eve'}}}, {'query': {'match_all': {}}}])
+        self.assertEquals(['4'], [hit.id for hit in first.results])
+        self.assertEquals(3, second.results.total)
+
+    def test_setting(self):
+        """
+        RUBBER_TRANSPORT should be used by every client
+        """
+        from rubber import settings, ElasticSearch
+        settings.RUBBER_TRANSPORT = self.fake
+        client = ElasticSearch('foo', 'bar', base_url='http://example.com:9200/')
+        self.assertEquals('kimchy', client.get(1).json['_source']['user'])
+
+class ChangeTrackerTest(TestCase):
+    def setUp(self):
+        from rubber import settings, ElasticSearch
+        from rubber.testutils import FakeElasticSearch
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+        self.fake = FakeElasticSearch()
+        self.client = ElasticSearch('foo', 'bar', transport=self.fake, track_changes=True)
+        self.doc = {'user': 'kimchy', 'age': 30, 'tags': ['a'], 'profile': {'city': 'Paris'}}
+
+    def requests(self):
+        return [(request['method'], request['path'], request['body']) for request in self.fake.requests]
+
+    def test_index(self):
+        """
+        Unchanged documents should be skipped, and documents with few changed fields partially updated
+        """
+        self.assertEquals(200, self.client.index(1, self.doc).status_code)
+        self.assertEquals(None, self.client.index(1, dict(self.doc)))
+        self.client.index(1, dict(self.doc, age=31))
+        self.client.index(1, dict(self.doc, age=32, user='bob', tags=[]))
+        self.client.index(1, dict(self.doc, age=32, user='bob', tags=[], extra=True))
+
+        self.assertEquals([('PUT', 'foo/bar/1', self.doc),
+                           ('POST', 'foo/bar/1/_update', {'doc': {'age': 31}}),
+                           ('PUT', 'foo/bar/1', dict(self.doc, age=32, user='bob', tags=[])),
+                           ('PUT', 'foo/bar/1', dict(self.doc, age=32, user='bob', tags=[], extra=True))], self.requests())
+        self.assertEquals({'skipped': 1, 'updated': 1, 'indexed': 3, 'fingerprints': 1}, self.client.stats()['changes'])
+
+    def test_objects(self):
+        """
+        Changed fields holding objects should be indexed in full, as _update would merge them
+        """
+        doc = dict(self.doc, profile={'city': 'Paris', 'zip': '75001'})
+        self.client.index(1, doc)
+        self.client.index(1, dict(doc, profile={'city': 'Paris'}))
+        self.client.index(1, dict(doc, profile={'city': 'Paris'}, tags=[{'name': 'a'}]))
+        self.assertEquals(['PUT', 'PUT', 'PUT'], [request['method'] for request in self.fake.requests])
+        self.assertEquals({'city': 'Paris'}, self.fake.documents('foo', 'bar')['1']['profile'])
+
+    def test_async(self):
+        """
+        Asynchronous clients should index with change tracking too
+        """
+        from rubber.asyncclient import AsyncElasticSearch
+        client = AsyncElasticSearch('foo', 'bar', transport=self.fake, track_changes=True, workers=2)
+        self.assertEquals(200, client.index(1, self.doc).status_code)
+        self.assertEquals(None, client.index(1, dict(self.doc)))
+        self.assertEquals(200, client.index(1, dict(self.doc, age=31)).status_code)
+        self.assertEquals(['PUT', 'POST'], [request['method'] for request in self.fake.requests])
+
+    def test_missing(self):
+        """
+        Partial updates of documents missing from the index should fall back on indexing them in full
+        """
+        self.client.index(1, self.doc)
+        self.fake.clear()
+        self.client.index(1, dict(self.doc, age=31))
+        self.assertEquals(['POST', 'PUT'], [request['method'] for request in self.fake.requests])
+        self.assertEquals(dict(self.doc, age=31), self.fake.documents('foo', 'bar')['1'])
+
+    def test_forget(self):
+        """
+        Fingerprints should be forgotten on delete and on direct puts, and evicted beyond maxsize
+        """
+        from rubber import ElasticSearch
+        from rubber.changes import ChangeTracker
+        self.client.index(1, self.doc)
+        self.client.delete(1)
+        self.client.index(1, self.doc)
+        self.client.put(1, {'user': 'bob'})
+        self.client.index(1, self.doc)
+        self.assertEquals(['PUT', 'DELETE', 'PUT', 'PUT', 'PUT'], [request['method'] for request in self.fake.requests])
+
+        client = ElasticSearch('foo', 'bar', transport=self.fake, track_changes=ChangeTracker(maxsize=2))
+        for pk in (1, 2, 3, 1):
+            client.index(pk, self.doc)
+        self.assertEquals(4, client.stats()['changes']['indexed'])
+
+    def test_batch(self):
+        """
+        Batches should skip unchanged documents and send changed fields as bulk updates
+        """
+        from rubber.autoindex import Batch
+        for doc in (self.doc, dict(self.doc), dict(self.doc, age=31)):
+            batch = Batch()
+            batch.add(self.client, 1, doc)
+            batch.add(self.client, 2, self.doc)
+            batch.flush()
+
+        bodies = [request['body'].splitlines() for request in self.fake.requests]
+        self.assertEquals(2, len(bodies))
+        self.assertEquals(['{"index": {"_id": 1}}', '{"index": {"_id": 2}}'], bodies[0][::2])
+        self.assertEquals(['{"update": {"_id": 1}}', '{"doc": {"age": 31}}'], bodies[1])
+        self.assertEquals(31, self.fake.documents('foo', 'bar')['1']['age'])
+
+class ScoresTransport(object):
+    """
+    Answers searches with the given scores for each index, after its delay.
+    """
+    base_url = 'memory://'
+    def __init__(self, scores, delays=None):
+        self.scores = scores
+        self.delays = delays or {}
+        self.requests = []
+    def request(self, method, path, data=None, **kwargs):
+        import time
+        index = path.split('/')[0]
+        self.requests.append((path, json.loads(data), kwargs))
+        time.sleep(self.delays.get(index, 0))
+        if index not in self.scores:
+            response = ResponseMock('{"error": "IndexMissingException[[%s] missing]"}' % index)
+            response.status_code = 404
+            return response
+        hits = [{'_index': index, '_id': '%s-%d' % (index, i), '_score': score} for i, score in enumerate(self.scores[index])]
+        return ResponseMock(json.dumps({'hits': {'total': len(hits) * 10, 'max_score': max(self.scores[index]), 'hits': hits}}))
+    def stats(self):
+        return {}
+
+class FanOutTest(TestCase):
+    def setUp(self):
+        from rubber import settings
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+
+    def test_score(self):
+        """
+        Hits of every target should be merged by descending score
+        """
+        from rubber import ElasticSearch
+        from rubber.fanout import FanOut
+        transport = ScoresTransport({'a': [3.0, 1.0, 0.5], 'b': [2.5, 2.0, 0.1], 'c': [1.5]})
+        clients = [ElasticSearch(name, transport=transport) for name in 'ab']
+        results = FanOut(pool=transport).search(clients + ['c'], {'query': {'match_all': {}}, 'from': 1}, size=4)
+
+        self.assertEquals(['b-0', 'b-1', 'c-0', 'a-1'], [hit.id for hit in results])
+        self.assertEquals(70, results.total)
+        self.assertEquals(3.0, results.max_score)
+        self.assertFalse(results.partial)
+        self.assertEquals([{'query': {'match_all': {}}, 'size': 5}] * 3, [request[1] for request in transport.requests])
+
+    def test_partial(self):
+        """
+        Targets failing or timing out should be reported, and the others merged
+        """
+        from rubber.fanout import FanOut
+        transport = ScoresTransport({'a': [1.0], 'slow': [5.0]}, delays={'slow': 0.5})
+        results = FanOut(pool=transport).search(['a', 'slow', 'missing'], timeout=0.2)
+
+        self.assertEquals(['a-0'], [hit.id for hit in results])
+        self.assertTrue(results.partial)
+        self.assertEquals(['slow'], results.timed_out)
+        self.assertEquals(['missing', 'slow'], sorted(results.errors))
+        self.assertEquals('200ms', transport.requests[0][1]['timeout'])
+        self.assertEquals(0.2, transport.requests[0][2]['timeout'])
+
+    def test_sort(self):
+        """
+        Hits should be merged by the given sort
+        """
+        from rubber import ElasticSearch
+        from rubber.fanout import FanOut
+        from rubber.testutils import FakeElasticSearch
+        fake = FakeElasticSearch()
+        for index, ages in (('a', [30, 20]), ('b', [25, 40]), ('c', [])):
+            client = ElasticSearch(index, 'user', transport=fake)
+            for i, age in enumerate(ages):
+                client.put(i + 1, {'age': age, 'name': '%s%d' % (index, i)})
+
+        results = FanOut(pool=fake).search(['a', 'b', 'c'], sort=[{'age': 'desc'}], size=3)
+        self.assertEquals(['b1', 'a0', 'b0'], [hit.source.name for hit in results])
+        results = FanOut(pool=fake).search(['a', 'b'], sort='age', size=10)
+        self.assertEquals([20, 25, 30, 40], [hit.source.age for hit in results])
+
+class ScanTest(TestCase):
+    def setUp(self):
+        from rubber import settings, resource
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+        self.requestmock = ScriptedRequestMock(
+            '{"_scroll_id":"s1","hits":{"total":3,"hits":[]}}',
+            '{"_scroll_id":"s2","hits":{"total":3,"hits":[{"_id":"1"},{"_id":"2"}]}}',
+            '{"_scroll_id":"s3","hits":{"total":3,"hits":[{"_id":"3"}]}}',
+            '{"_scroll_id":"s4","hits":{"total":3,"hits":[]}}')
+        resource.requests = self.requestmock
+
+        from rubber import ElasticSearch
+        self.client = ElasticSearch('foo', 'bar', base_url='http://example.com:9200/')
+
+    def test_scan(self):
+        """
+        scan should yield every hit across pages then clear the scroll context
+        """
+        for prefetch in (True, False):
+            self.setUp()
+            hits = list(self.client.scan({'query': {'match_all': {}}}, size=2, prefetch=prefetch))
+            self.assertEquals(['1', '2', '3'], [hit.id for hit in hits])
+
+            stack = self.requestmock.stack
+            self.assertEquals(5, len(stack))
+            self.assertEquals('http://example.com:9200/foo/bar/_search', stack[0]['url'])
+            self.assertEquals({'search_type': 'scan', 'scroll': '5m', 'size': 2}, stack[0]['kwargs']['params'])
+            self.assertEquals(['s1', 's2', 's3'], [call['kwargs']['data'] for call in stack[1:4]])
+            self.assertEquals(('DELETE', 'http://example.com:9200/_search/scroll', 's4'),
+                              (stack[4]['method'], stack[4]['url'], stack[4]['kwargs']['data']))
+
+    def test_close(self):
+        """
+        Closing the generator early should clear the scroll context
+        """
+        hits = self.client.scan()
+        self.assertEquals('1', hits.next().id)
+        hits.close()
+        self.assertEquals('DELETE', self.requestmock.stack[-1]['method'])
+        self.assertEquals('s3', self.requestmock.stack[-1]['kwargs']['data'])
+
+class SearchCacheTest(TestCase):
+    def setUp(self):
+        from rubber import settings, resource
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+        self.requestmock = ScriptedRequestMock(*['{"hits": {"total": %d, "hits": []}}' % i for i in range(10)])
+        resource.requests = self.requestmock
+
+        from rubber import ElasticSearch
+        self.client = ElasticSearch('foo', 'bar', base_url='http://example.com:9200/', cache=True)
+
+    def test_cache(self):
+        """
+        Identical searches should be served from the cache, until a write on the index
+        """
+        first = self.client.search.post({'query': {'term': {'user': 'kimchy'}}, 'size': 10})
+        second = self.client.search.post({'size': 10, 'query': {'term': {'user': 'kimchy'}}})
+        self.assertEquals(1, len(self.requestmock.stack))
+        self.assertEquals(0, second.results.total)
+        self.assertEquals(first.json, second.json)
+        self.assertEquals(first.content, ''.join(second.iter_content(4)))
+
+        self.client.search.post({'query': {'match_all': {}}})
+        self.client.count()
+        self.client.mapping.get()
+        self.client.mapping.get()
+        self.assertEquals(5, len(self.requestmock.stack))
+        self.assertEquals({'hits': 1, 'misses': 3, 'invalidations': 0}, self.client.cache.stats())
+
+        # writes invalidate the index
+        self.client.put(1, {'user': 'kimchy'})
+        self.client.search.post({'query': {'term': {'user': 'kimchy'}}, 'size': 10})
+        self.assertEquals(7, len(self.requestmock.stack))
+
+        with self.client.bulk() as bulk:
+            bulk.delete(1)
+        self.client.search.post({'query': {'term': {'user': 'kimchy'}}, 'size': 10})
+        self.assertEquals(9, len(self.requestmock.stack))
+        self.assertEquals(2, self.client.cache.stats()['invalidations'])
+
+    def test_refresh_interval(self):
+        """
+        Responses should not be cached until the index is refreshed after a write
+        """
+        import time
+        from rubber.cache import TOKEN_TIMEOUT
+        self.client.search.post({})
+        self.client.put(1, {'user': 'kimchy'})
+        self.client.search.post({})
+        self.client.search.post({})
+        self.assertEquals(4, len(self.requestmock.stack))
+
+        self.client.cache.refresh_interval = 0
+        self.client.search.post({})
+        self.client.search.post({})
+        self.assertEquals(5, len(self.requestmock.stack))
+
+        expires = self.client.cache.backend._data['rubber:token:foo'][0]
+        self.assertTrue(expires - time.time() > TOKEN_TIMEOUT - 10)
+
+    def test_lru(self):
+        """
+        LRUCache should evict the least recently used entries, and expired ones
+        """
+        from rubber.cache import LRUCache
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEquals([1, None, 3], [cache.get(key) for key in 'abc'])
+        cache.set('d', 4, -1)
+        self.assertEquals(None, cache.get('d'))
+        self.assertFalse(cache.add('c', 5))
+        self.assertTrue(cache.add('d', 5))
+        self.assertEquals(5, cache.get('d'))
+
+class MultiSearchTest(TestCase):
+    def setUp(self):
+        from rubber import settings, resource
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+        self.requestmock = ScriptedRequestMock("""{"responses": [{"took": 1, "hits": {"total": 1, "hits": [{"_id": "1"}]}}, {"took": 2, "hits": {"total": 2, "hits": [{"_id": "2"}, {"_id": "3"}]}}, {"error": "IndexMissingException[[baz] missing]"}]}""")
+        resource.requests = self.requestmock
+
+        from rubber import ElasticSearch
+        class MyHit(object):
+            def __init__(self, d):
+                self.data = d
+        self.MyHit = MyHit
+        self.foo = ElasticSearch('foo', 'bar', base_url='http://example.com:9200/')
+        self.baz = ElasticSearch('baz', hit_class=MyHit, base_url='http://example.com:9200/')
+
+    def test_implicit(self):
+        """
+        Searches made within a MultiSearch block should be sent as one _msearch request on exit
+        """
+        from rubber.multisearch import MultiSearch
+        from rubber.response import SearchResponse
+        with MultiSearch():
+            first = self.foo.search.post({'query': {'match_all': {}}})
+            second = self.foo.search({'size': 2}, params={'search_type': 'count'})
+            third = self.baz.search.post({})
+            self.assertEquals(0, len(self.requestmock.stack))
+            self.assertTrue(isinstance(first, SearchResponse))
+
+        self.assertEquals(1, len(self.requestmock.stack))
+        self.assertEquals('http://example.com:9200/_msearch', self.requestmock.stack[0]['url'])
+        lines = [json.loads(line) for line in self.requestmock.stack[0]['kwargs']['data'].split('\n') if line]
+        self.assertEquals([{'index': 'foo', 'type': 'bar'}, {'query': {'match_all': {}}},
+                           {'index': 'foo', 'type': 'bar', 'search_type': 'count'}, {'size': 2},
+                           {'index': 'baz'}, {}], lines)
+
+        self.assertEquals(['1'], [hit.id for hit in first.results])
+        self.assertEquals(2, second.results.total)
+        self.assertEquals(2, second.json['took'])
+        self.assertEquals(500, third.status_code)
+        self.assertEquals(0, len(third.results))
+
+    def test_explicit(self):
+        """
+        Pending responses should send their MultiSearch when used, with each client's hit_class
+        """
+        from rubber.multisearch import MultiSearch
+        multisearch = MultiSearch()
+        first = multisearch.add(self.foo, {})
+        second = multisearch.add(self.baz, {})
+        self.assertEquals(2, len(multisearch))
+        self.assertEquals(1, first.results.total)
+        self.assertEquals(1, len(self.requestmock.stack))
+        self.assertTrue(isinstance(second.results[0], self.MyHit))
+
+        responses = self.foo.msearch([{}, {}])
+        self.assertEquals(2, len(responses))
+        self.assertEquals(2, len(self.requestmock.stack))
+
+    def test_params(self):
+        """
+        Body parameters should go into the query, and searches with other options should be sent directly
+        """
+        from rubber.multisearch import MultiSearch
+        from rubber.templates import QueryTemplate
+        with MultiSearch():
+            first = self.foo.search.get(params={'size': 2, 'routing': 'a'})
+            second = self.foo.search.post('{\n  "query": {"match_all": {}}\n}', params={'from': 5})
+            third = self.foo.search.post(QueryTemplate({'size': 1})(), params={'size': 3})
+            direct = self.foo.search.post({}, params={'q': 'title:foo'})
+            self.assertEquals(1, len(self.requestmock.stack))
+            self.assertEquals('http://example.com:9200/foo/bar/_search', self.requestmock.stack[0]['url'])
+            timed = self.foo.search.post({}, timeout=5)
+            self.assertEquals(2, len(self.requestmock.stack))
+
+        lines = self.requestmock.stack[2]['kwargs']['data'].split('\n')
+        self.assertEquals([{'index': 'foo', 'type': 'bar', 'routing': 'a'}, {'size': 2},
+                           {'index': 'foo', 'type': 'bar'}, {'query': {'match_all': {}}, 'from': 5},
+                           {'index': 'foo', 'type': 'bar'}, {'size': 3}], [json.loads(line) for line in lines if line])
+        self.assertEquals(7, len(lines))
+        self.assertRaises(ValueError, MultiSearch().add, self.foo, {}, q='title:foo')
+
+    def test_clusters(self):
+        """
+        Searches on clients of different clusters should be sent to their own cluster
+        """
+        from rubber import ElasticSearch
+        from rubber.multisearch import MultiSearch
+        other = ElasticSearch('foo', 'bar', base_url='http://other.com:9200/')
+        multisearch = MultiSearch()
+        first = multisearch.add(self.foo, {})
+        second = multisearch.add(other, {})
+        third = multisearch.add(self.baz, {})
+        self.assertEquals([first, second, third], multisearch.execute())
+        self.assertEquals(['http://example.com:9200/_msearch', 'http://other.com:9200/_msearch'],
+                          [call['url'] for call in self.requestmock.stack])
+        self.assertEquals(2, len([line for line in self.requestmock.stack[1]['kwargs']['data'].split('\n') if line]))
+        self.assertEquals(['1'], [hit.id for hit in first.results])
+        self.assertEquals(2, third.results.total)
+        self.assertEquals(500, second.status_code)
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        from rubber import settings, resource
+        from rubber.instrumentation import MetricsCollector
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+        self.requestmock = ScriptedRequestMock('{"took": 7, "hits": {"total": 1, "hits": [{"_id": "1"}]}}', '{"ok": true}')
+        resource.requests = self.requestmock
+
+        from rubber import ElasticSearch
+        self.client = ElasticSearch('foo', 'bar', base_url='http://example.com:9200/')
+        self.collector = MetricsCollector().install()
+
+    def tearDown(self):
+        self.collector.uninstall()
+
+    def test_collector(self):
+        """
+        The collector should record latencies, sizes, status codes and took per endpoint and method
+        """
+        self.client.search.post({'query': {'match_all': {}}})
+        self.client.put(1, {'title': 'foo'})
+
+        snapshot = self.collector.snapshot()
+        self.assertEquals(['document.PUT', 'search.POST'], sorted(snapshot['endpoints'].keys()))
+
+        search = snapshot['endpoints']['search.POST']
+        self.assertEquals(1, search['latency']['count'])
+        self.assertEquals(1, search['latency']['buckets'][-1][1])
+        self.assertEquals(1, search['parsing']['count'])
+        self.assertEquals(7, search['took'])
+        self.assertEquals({200: 1}, search['status_codes'])
+        self.assertEquals(len('{"query": {"match_all": {}}}'), search['request_bytes'])
+        self.assertTrue(search['response_bytes'] > 0)
+
+        self.assertEquals(0, snapshot['endpoints']['document.PUT']['took'])
+        self.assertEquals(2, snapshot['serialization']['count'])
+        json.dumps(snapshot)
+
+    def test_hooks(self):
+        """
+        Registered functions should be called before and after each request, and not once unregistered
+        """
+        from rubber import instrumentation
+        events = []
+        pre = lambda info: events.append(('pre', info['endpoint'], info['method']))
+        post = lambda info: events.append(('post', info['endpoint'], info['status_code']))
+        instrumentation.register('pre_request', pre)
+        instrumentation.register('post_request', post)
+        try:
+            self.client.count({})
+        finally:
+            instrumentation.unregister('pre_request', pre)
+            instrumentation.unregister('post_request', post)
+        self.client.count({})
+        self.assertEquals([('pre', 'count', 'GET'), ('post', 'count', 200)], events)
+
+    def test_failing_hook(self):
+        """
+        An exception raised by a hook should be logged, not propagated to the request
+        """
+        import logging
+        from rubber import instrumentation
+        def fail(info):
+            raise ValueError('broken hook')
+        instrumentation.register('pre_request', fail)
+        logger = logging.getLogger()
+        level = logger.level
+        logger.setLevel(logging.CRITICAL)
+        try:
+            response = self.client.count({})
+        finally:
+            logger.setLevel(level)
+            instrumentation.unregister('pre_request', fail)
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(1, self.collector.snapshot()['endpoints']['count.GET']['latency']['count'])
+
+    def test_cached_serialization(self):
+        """
+        A cached search should report its serialization once
+        """
+        from rubber import ElasticSearch
+        from rubber.cache import SearchCache
+        from rubber.templates import QueryTemplate, Param
+        client = ElasticSearch('foo', 'bar', base_url='http://example.com:9200/', cache=SearchCache())
+        client.search.post(QueryTemplate({'query': {'term': {'title': Param('title')}}})(title='foo'))
+        self.assertEquals(1, self.collector.snapshot()['serialization']['count'])
+
+    def test_percentile(self):
+        """
+        Histogram percentiles should be the upper bound of the matching bucket
+        """
+        from rubber.instrumentation import Histogram
+        histogram = Histogram()
+        self.assertEquals(None, histogram.percentile(50))
+        for value in [0.0005] * 9 + [0.3]:
+            histogram.observe(value)
+        self.assertEquals(0.001, histogram.percentile(50))
+        self.assertEquals(0.5, histogram.percentile(99))
+
+
+class GetManyTest(TestCase):
+    def setUp(self):
+        from rubber import settings, resource
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+        self.requestmock = ScriptedRequestMock(
+            '{"docs": [{"_id": "1", "exists": true, "_source": {"title": "foo"}}, {"_id": "2", "exists": false}]}',
+            '{"docs": [{"_id": "3", "found": true, "_source": {"title": "bar"}}]}')
+        resource.requests = self.requestmock
+
+        from rubber import ElasticSearch
+        self.client = ElasticSearch('foo', 'bar', base_url='http://example.com:9200/')
+
+    def test_get_many(self):
+        """
+        get_many should fetch documents by chunks with _mget, in order, marking missing ones
+        """
+        hits = self.client.get_many([1, 2, 3], chunk_size=2, workers=1, fields=['title'], source=['title'])
+        self.assertEquals(['1', '2', '3'], [hit.id for hit in hits])
+        self.assertEquals([True, False, True], [hit.found for hit in hits])
+        self.assertEquals('bar', hits[2].source.title)
+
+        self.assertEquals(2, len(self.requestmock.stack))
+        self.assertEquals('http://example.com:9200/foo/bar/_mget', self.requestmock.stack[0]['url'])
+        self.assertEquals({'ids': [1, 2]}, json.loads(self.requestmock.stack[0]['kwargs']['data']))
+        self.assertEquals({'fields': 'title', '_source': 'title'}, self.requestmock.stack[0]['kwargs']['params'])
+
+    def test_concurrent_chunks(self):
+        """
+        Chunks sent concurrently should keep the order of the pks
+        """
+        from rubber import resource
+        class MGetMock(RequestMock):
+            def request(self, method, url, **kwargs):
+                super(MGetMock, self).request(method, url, **kwargs)
+                ids = json.loads(kwargs['data'])['ids']
+                return ResponseMock(json.dumps({'docs': [{'_id': str(pk), 'found': pk % 2 == 0} for pk in ids]}))
+        requestmock = MGetMock()
+        resource.requests = requestmock
+
+        hits = self.client.get_many(range(1, 10), chunk_size=2, workers=3)
+        self.assertEquals(5, len(requestmock.stack))
+        self.assertEquals([str(pk) for pk in range(1, 10)], [hit.id for hit in hits])
+        self.assertEquals([pk % 2 == 0 for pk in range(1, 10)], [hit.found for hit in hits])
+
+class BulkTest(TestCase):
+    def setUp(self):
+        from rubber import settings, resource
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+        self.requestmock = RequestMock()
+        resource.requests = self.requestmock
+
+        from rubber import ElasticSearch
+        self.client = ElasticSearch('foo', 'bar', base_url='http://example.com:9200/')
+
+    def test_ndjson(self):
+        """
+        Queued actions should be sent as NDJSON to the _bulk endpoint when the buffer is flushed
+        """
+        with self.client.bulk() as bulk:
+            bulk.index(1, {'title': 'foo'})
+            bulk.delete(2)
+            self.assertEquals(2, len(bulk))
+            self.assertEquals(0, len(self.requestmock.stack))
+
+        self.assertEquals(1, len(self.requestmock.stack))
+        self.assertEquals('POST', self.requestmock.stack[0]['method'])
+        self.assertEquals('http://example.com:9200/foo/bar/_bulk', self.requestmock.stack[0]['url'])
+        lines = self.requestmock.stack[0]['kwargs']['data'].split('\n')
+        self.assertEquals([{'index': {'_id': 1}}, {'title': 'foo'}, {'delete': {'_id': 2}}],
+                          [json.loads(line) for line in lines if line])
+
+    def test_auto_flush(self):
+        """
+        The buffer should flush by itself once max_actions or max_bytes is reached
+        """
+        bulk = self.client.bulk(max_actions=3)
+        for pk in range(7):
+            bulk.index(pk, {'title': 'foo'})
+        self.assertEquals(2, len(self.requestmock.stack))
+        self.assertEquals(1, len(bulk))
+
+        bulk = self.client.bulk(max_bytes=10)
+        bulk.delete(1)
+        self.assertEquals(3, len(self.requestmock.stack))
+
+    def test_errors(self):
+        """
+        Per-item failures should be reported without discarding the rest of the batch
+        """
+        from rubber import settings
+        settings.RUBBER_MOCK_HTTP_RESPONSE = """{"took":3,"items":[{"index":{"_index":"foo","_type":"bar","_id":"1","_version":1,"ok":true}},{"index":{"_index":"foo","_type":"bar","_id":"2","error":"MapperParsingException[failed to parse]"}}]}"""
+        try:
+            bulk = self.client.bulk()
+            bulk.index(1, {'title': 'foo'})
+            bulk.index(2, {'title': []})
+            response = bulk.flush()
+        finally:
+            settings.RUBBER_MOCK_HTTP_RESPONSE = None
+
+        self.assertEquals(2, len(response.items))
+        self.assertEquals(1, len(bulk.errors))
+        self.assertEquals('2', bulk.errors[0]['_id'])
+        self.assertEquals('index', bulk.errors[0]['action'])
+
+    def test_requeue(self):
+        """
+        Actions should stay queued when the _bulk request fails, raises or is refused as a whole
+        """
+        import requests
+        from rubber import ElasticSearch, resource
+        resource.requests = NodeRequestMock(statuses={'example.com:9200': 503})
+        bulk = self.client.bulk()
+        bulk.index(1, {'title': 'foo'})
+        self.assertEquals(503, bulk.flush().status_code)
+        self.assertEquals(1, len(bulk))
+
+        resource.requests = NodeRequestMock(down=['example.com:9200'])
+        self.client.pool.reset()
+        self.assertEquals(None, bulk.flush())
+        client = ElasticSearch('foo', 'bar', base_url='http://example.com:9200/', raise_on_error=True)
+        bulk = client.bulk()
+        bulk.index(1, {'title': 'foo'})
+        self.assertRaises(requests.exceptions.ConnectionError, bulk.flush)
+        self.assertEquals(1, len(bulk))
+
+        resource.requests = self.requestmock
+        client.pool.reset()
+        self.assertEquals(200, bulk.flush().status_code)
+        self.assertEquals(0, len(bulk))
+        self.assertEquals([], bulk.errors)
+
+    def test_refused(self):
+        """
+        Actions refused with a permanent status should be dropped, and transient failures retried a few times
+        """
+        from rubber import resource
+        resource.requests = NodeRequestMock(statuses={'example.com:9200': 404})
+        self.client.pool.reset()
+        bulk = self.client.bulk(max_actions=2)
+        for pk in range(50):
+            bulk.index(pk, {'title': 'foo'})
+        self.assertEquals(0, len(bulk))
+        self.assertEquals(25, len(resource.requests.stack))
+        self.assertEquals([404] * 25, [error['status'] for error in bulk.errors])
+
+        resource.requests = NodeRequestMock(statuses={'example.com:9200': 503})
+        self.client.pool.reset()
+        bulk = self.client.bulk(max_actions=None, max_retries=2)
+        bulk.index(1, {'title': 'foo'})
+        bulk.flush()
+        bulk.flush()
+        self.assertEquals(1, len(bulk))
+        self.assertEquals([], bulk.errors)
+        bulk.flush()
+        self.assertEquals(0, len(bulk))
+        self.assertEquals([('bulk', 503, 1)], [(error['action'], error['status'], error['count']) for error in bulk.errors])
+
+class AsyncElasticSearchTest(TestCase):
+    def setUp(self):
+        from rubber import settings, resource
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+        self.requestmock = RequestMock()
+        resource.requests = self.requestmock
+
+    def test_async_requests(self):
+        """
+        Requests should return AsyncResults resolving to the usual response objects
+        """
+        from rubber.asyncclient import AsyncElasticSearch
+        from rubber.response import Response, SearchResponse
+        client = AsyncElasticSearch('foo', 'bar', base_url='http://example.com:9200/', workers=4)
+
+        pending = [client.search.post({'query': {'match_all': {}}}) for i in range(10)]
+        pending.append(client.get(1))
+        pending.append(client.count())
+        responses = [result.get(5) for result in pending]
+
+        self.assertEquals(12, len(self.requestmock.stack))
+        self.assertEquals(1, len(self.requestmock.sessions))
+        self.assertTrue(all(isinstance(response, SearchResponse) for response in responses[:10]))
+        self.assertTrue(isinstance(responses[10], Response))
+        self.assertEquals('http://example.com:9200/foo/bar/1', [call['url'] for call in self.requestmock.stack if call['url'].endswith('/1')][0])
+
+        # callbacks are called with the response
+        received = []
+        client.mapping.get(callback=received.append).wait(5)
+        self.assertEquals(1, len(received))
+        client.close()
+
+    def test_close(self):
+        """
+        Closing the client should stop its worker threads, and a with block should close it
+        """
+        import threading
+        from rubber.asyncclient import AsyncElasticSearch
+        with AsyncElasticSearch('foo', 'bar', base_url='http://example.com:9200/', workers=3) as client:
+            result = client.get(1)
+            workers = client.executor._pool
+        self.assertTrue(result.ready())
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+        self.assertEquals(None, client._executor)
+        self.assertEquals(200, client.get(1).get(5).status_code)
+        client.close(wait=False)
+
+    def test_multisearch(self):
+        """
+        Searches within a MultiSearch block should be collected by it rather than sent from the workers
+        """
+        from rubber.asyncclient import AsyncElasticSearch
+        from rubber.multisearch import MultiSearch
+        from rubber import resource
+        resource.requests = ScriptedRequestMock('{"responses": [{"hits": {"total": 3, "hits": []}}]}')
+        received = []
+        with AsyncElasticSearch('foo', 'bar', base_url='http://example.com:9200/') as client:
+            with MultiSearch():
+                result = client.search.post({}, callback=received.append)
+                self.assertTrue(result.ready())
+                self.assertEquals(0, len(resource.requests.stack))
+            self.assertEquals(3, result.get().results.total)
+            self.assertEquals([result.get()], received)
+        self.assertEquals(['http://example.com:9200/_msearch'], [call['url'] for call in resource.requests.stack])
+
 try:
     import django
     class ElasticSearchTest(TestCase):
@@ -91,6 +1204,8 @@ try:
                 elasticsearch = ElasticSearch(auto_index=True)
 
             self.Article = Article
+            # django caches model classes: drop the session bound to a previous test's mock
+            self.Article.elasticsearch.pool.reset()
             rubber.settings.RUBBER_MOCK_HTTP_RESPONSE = None
 
         def test_contribute_to_class(self):
@@ -101,6 +1216,52 @@ try:
             self.assertEquals('tests', self.Article.elasticsearch.index_name)
             self.assertEquals('article', self.Article.elasticsearch.type)
 
+        def test_instance_resource(self):
+            """
+            The resource bound to an instance should follow its pk, and leave it picklable and copyable
+            """
+            import copy
+            import pickle
+            from rubber.resource import InstanceResource
+            article = self.Article()
+            resource = article.elasticsearch
+            self.assertTrue(isinstance(resource, InstanceResource))
+            self.assertTrue(resource.instance is article)
+
+            article.pk = 42
+            self.assertEquals('tests/article/42', article.elasticsearch.path)
+
+            # pickle finds model classes by module and name
+            globals()['Article'] = self.Article
+            try:
+                self.assertEquals(42, pickle.loads(pickle.dumps(article, 2)).pk)
+            finally:
+                del globals()['Article']
+            self.assertEquals('tests/article/42', copy.deepcopy(article).elasticsearch.path)
+
+        def test_track_changes(self):
+            """
+            Saving a model without changing its indexed fields should not send anything
+            """
+            from django.db import models
+            from django.db.models.signals import post_save
+            from rubber import ElasticSearch, settings
+            from rubber.testutils import FakeElasticSearch
+
+            class TrackedArticle(models.Model):
+                elasticsearch = ElasticSearch(track_changes=True)
+                title = models.CharField(max_length=3)
+                body = models.TextField()
+
+            settings.RUBBER_TRANSPORT = fake = FakeElasticSearch()
+            try:
+                for title in ('foo', 'foo', 'bar'):
+                    post_save.send(sender=TrackedArticle, instance=TrackedArticle(pk=1, title=title, body='body'), created=False)
+            finally:
+                settings.RUBBER_TRANSPORT = None
+            self.assertEquals([('PUT', {'title': 'foo', 'body': 'body'}), ('POST', {'doc': {'title': 'bar'}})],
+                              [(request['method'], request['body']) for request in fake.requests])
+
         def test_search(self):
             """
             Checks that we call the right elasticsearch endpoint for searching
@@ -140,6 +1301,286 @@ try:
                         found = True
                 self.assertTrue(found)
 
+        def _send_signals(self, model, on_commit):
+            """
+            Sends post_save signals for pks 1, 2, 1 then a post_delete for pk 2,
+            with on_commit standing for django.db.transaction.on_commit
+            """
+            from django.db import transaction
+            from django.db.models.signals import post_save, post_delete
+            original = getattr(transaction, 'on_commit', None)
+            transaction.on_commit = on_commit
+            try:
+                for pk, title in ((1, 'foo'), (2, 'bar'), (1, 'baz')):
+                    post_save.send(sender=model, instance=model(pk=pk, title=title), created=False, using='default')
+                post_delete.send(sender=model, instance=model(pk=2), using='default')
+            finally:
+                if None == original:
+                    del transaction.on_commit
+                else:
+                    transaction.on_commit = original
+
+        def test_batch_auto_index(self):
+            """
+            In batch mode, the changes of a transaction should be collapsed and sent in one _bulk request on commit
+            """
+            from django.db import models
+            from rubber import ElasticSearch, resource
+
+            class BatchArticle(models.Model):
+                elasticsearch = ElasticSearch(auto_index='batch')
+                title = models.CharField(max_length=3)
+            BatchArticle.elasticsearch.pool.reset()
+
+            requestmock = RequestMock()
+            resource.requests = requestmock
+
+            hooks = []
+            self._send_signals(BatchArticle, lambda func, using=None: hooks.append(func))
+            self.assertEquals(0, len(requestmock.stack))
+            self.assertEquals(1, len(hooks))
+
+            hooks[0]()
+            self.assertEquals(1, len(requestmock.stack))
+            self.assertEquals('http://example.com:9200/tests/batcharticle/_bulk', requestmock.stack[0]['url'])
+            lines = requestmock.stack[0]['kwargs']['data'].split('\n')
+            self.assertEquals([{'index': {'_id': 1}}, {'title': 'baz'}, {'delete': {'_id': 2}}],
+                              [json.loads(line) for line in lines if line])
+
+        def test_batch_transaction(self):
+            """
+            In batch mode, the changes of a real transaction should be sent once it commits, and never if it is rolled back
+            """
+            from django.db import models, transaction
+            from rubber import ElasticSearch, resource
+
+            class TransactionArticle(models.Model):
+                elasticsearch = ElasticSearch(auto_index='batch')
+                title = models.CharField(max_length=3)
+            self._create_tables(TransactionArticle)
+            TransactionArticle.elasticsearch.pool.reset()
+            atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+
+            requestmock = RequestMock()
+            resource.requests = requestmock
+            with atomic():
+                article = TransactionArticle.objects.create(title='a')
+                article.title = 'b'
+                article.save()
+                TransactionArticle.objects.create(title='c')
+                self.assertEquals(0, len(requestmock.stack))
+            self.assertEquals(1, len(requestmock.stack))
+            lines = requestmock.stack[0]['kwargs']['data'].split('\n')
+            self.assertEquals([{'index': {'_id': article.pk}}, {'title': 'b'}, {'index': {'_id': article.pk + 1}}, {'title': 'c'}],
+                              [json.loads(line) for line in lines if line])
+
+            try:
+                with atomic():
+                    TransactionArticle.objects.create(title='d')
+                    raise ValueError
+            except ValueError:
+                pass
+            pk = article.pk
+            with atomic():
+                article.delete()
+            self.assertEquals(2, len(requestmock.stack))
+            lines = requestmock.stack[1]['kwargs']['data'].split('\n')
+            self.assertEquals([{'delete': {'_id': pk}}], [json.loads(line) for line in lines if line])
+
+            # outside of a transaction, changes are committed at once
+            TransactionArticle.objects.create(title='e')
+            self.assertEquals(3, len(requestmock.stack))
+
+        def test_background_auto_index(self):
+            """
+            In background mode, batches should be sent by a worker thread
+            """
+            from django.db import models
+            from rubber import ElasticSearch, resource
+            from rubber.autoindex import worker
+
+            class BackgroundArticle(models.Model):
+                elasticsearch = ElasticSearch(auto_index='background')
+                title = models.CharField(max_length=3)
+            BackgroundArticle.elasticsearch.pool.reset()
+
+            requestmock = RequestMock()
+            resource.requests = requestmock
+
+            self._send_signals(BackgroundArticle, lambda func, using=None: func())
+            worker.join()
+            self.assertEquals(4, len(requestmock.stack))
+            self.assertEquals('http://example.com:9200/tests/backgroundarticle/_bulk', requestmock.stack[0]['url'])
+
+        def _create_tables(self, *models):
+            from django.db import connection
+            try:
+                with connection.schema_editor() as editor:
+                    for model in models:
+                        editor.create_model(model)
+            except AttributeError:
+                from django.core.management.color import no_style
+                cursor = connection.cursor()
+                for model in models:
+                    statements = connection.creation.sql_create_model(model, no_style())[0]
+                    for field in model._meta.local_many_to_many:
+                        statements += connection.creation.sql_create_model(field.rel.through, no_style())[0]
+                    for sql in statements:
+                        cursor.execute(sql)
+
+        def test_model_serializer(self):
+            """
+            Compiled model serializers should give the same json as the django serialization framework
+            """
+            import datetime, decimal
+            from django.db import models
+            from django.core import serializers
+            from django.core.serializers.json import DjangoJSONEncoder
+            from rubber.instanceutils import data_to_json
+
+            class SerializedTag(models.Model):
+                name = models.CharField(max_length=10)
+
+            class SerializedArticle(models.Model):
+                title = models.CharField(max_length=20)
+                body = models.TextField(null=True)
+                count = models.IntegerField(default=0)
+                price = models.DecimalField(max_digits=6, decimal_places=2, null=True)
+                published = models.DateTimeField(null=True)
+                day = models.DateField(null=True)
+                at = models.TimeField(null=True)
+                ratio = models.FloatField(null=True)
+                active = models.BooleanField(default=False)
+                attachment = models.FileField(upload_to='files', null=True)
+                main_tag = models.ForeignKey(SerializedTag, null=True, related_name='+')
+                tags = models.ManyToManyField(SerializedTag)
+
+            self._create_tables(SerializedTag, SerializedArticle)
+            tags = [SerializedTag.objects.create(name=name) for name in ('foo', 'bar')]
+            articles = [
+                SerializedArticle(title=u'caf\xe9 "quoted"', body='multi\nline', count=3, price=decimal.Decimal('12.30'),
+                                  published=datetime.datetime(2012, 8, 2, 8, 30, 11, 562000), day=datetime.date(2012, 8, 2),
+                                  at=datetime.time(8, 30, 11, 5), ratio=0.5, active=True, attachment='files/a.txt', main_tag=tags[0]),
+                SerializedArticle(title='empty'),
+            ]
+            for article in articles:
+                article.save()
+            articles[0].tags.add(*tags)
+
+            for article in articles:
+                expected = json.dumps(serializers.serialize("python", [article])[0]['fields'], cls=DjangoJSONEncoder)
+                self.assertEquals(expected, data_to_json(article))
+
+        def test_instances(self):
+            """
+            Hits should be loaded into model instances with one query, in the order of the hits
+            """
+            from django.db import models
+            from rubber import ElasticSearch, settings
+
+            class HydratedArticle(models.Model):
+                elasticsearch = ElasticSearch(auto_index=False)
+                title = models.CharField(max_length=3)
+            self._create_tables(HydratedArticle)
+            for title in ('a', 'b', 'c'):
+                HydratedArticle.objects.create(title=title)
+
+            settings.RUBBER_MOCK_HTTP_RESPONSE = '{"hits": {"total": 3, "hits": [{"_id": "3"}, {"_id": "1"}, {"_id": "99"}]}}'
+            results = HydratedArticle.elasticsearch.search({}).results
+            instances = results.instances(only=['title'])
+            self.assertEquals(['c', 'a'], [article.title for article in instances])
+            self.assertTrue(instances is results.instances(only=['title']))
+            self.assertEquals([3, 1], [article.pk for article in results.instances(select_related=True)])
+
+            from rubber.response import HitCollection
+            self.assertRaises(ValueError, HitCollection({}).instances)
+
+        def test_reindex(self):
+            """
+            reindex should send one _bulk request per chunk of rows and record its progress
+            """
+            from django.db import connection, models
+            from rubber import ElasticSearch, resource
+            from rubber.reindex import reindex, get_model
+            import os, tempfile
+
+            class ReindexArticle(models.Model):
+                elasticsearch = ElasticSearch(auto_index=False)
+                title = models.CharField(max_length=3)
+            self._create_tables(ReindexArticle)
+            for title in ('a', 'b', 'c', 'd', 'e'):
+                ReindexArticle.objects.create(title=title)
+            ReindexArticle.elasticsearch.pool.reset()
+
+            requestmock = RequestMock()
+            resource.requests = requestmock
+            state_file = tempfile.mktemp()
+            reports = []
+            try:
+                stats = reindex(ReindexArticle, chunk_size=2, processes=0, state_file=state_file, progress=reports.append)
+                self.assertEquals(3, len(requestmock.stack))
+                self.assertEquals('http://example.com:9200/tests/reindexarticle/_bulk', requestmock.stack[0]['url'])
+                lines = requestmock.stack[2]['kwargs']['data'].split('\n')
+                self.assertEquals([{'index': {'_id': 5}}, {'title': 'e'}], [json.loads(line) for line in lines if line])
+                self.assertEquals(5, stats['documents'])
+                self.assertEquals([2, 4, 5], [report['documents'] for report in reports])
+
+                # resuming from the state file: nothing left to index
+                stats = reindex(ReindexArticle, chunk_size=2, processes=0, state_file=state_file)
+                self.assertEquals(0, stats['documents'])
+                self.assertEquals(3, len(requestmock.stack))
+
+                stats = reindex(ReindexArticle, chunk_size=2, processes=0, start=3)
+                self.assertEquals(2, stats['documents'])
+
+                # worker processes look the model up by name, which the tests app cannot register
+                from rubber import reindex as reindex_module
+                reindex_module.get_model = lambda app_label, model_name: ReindexArticle
+                try:
+                    stats = reindex(ReindexArticle, chunk_size=2, processes=2)
+                finally:
+                    reindex_module.get_model = get_model
+                self.assertEquals(5, stats['documents'])
+                self.assertEquals(3, stats['chunks'])
+            finally:
+                if os.path.exists(state_file):
+                    os.remove(state_file)
+
+        def test_reindex_failure(self):
+            """
+            A chunk whose _bulk request failed should stop the reindex without being recorded as done
+            """
+            from django.db import models
+            from rubber import ElasticSearch, resource
+            from rubber.reindex import reindex, read_state, write_state
+            import os, tempfile
+
+            class FailingArticle(models.Model):
+                elasticsearch = ElasticSearch(auto_index=False)
+                title = models.CharField(max_length=3)
+            self._create_tables(FailingArticle)
+            for title in ('a', 'b', 'c'):
+                FailingArticle.objects.create(title=title)
+            FailingArticle.elasticsearch.pool.reset()
+
+            requestmock = NodeRequestMock(down=['example.com:9200'])
+            resource.requests = requestmock
+            state_file = tempfile.mktemp()
+            try:
+                write_state(state_file, 1)
+                self.assertRaises(IOError, reindex, FailingArticle, chunk_size=2, processes=0, state_file=state_file)
+                self.assertEquals(1, read_state(state_file))
+            finally:
+                os.remove(state_file)
+
+        def test_reindex_command(self):
+            """
+            Unknown models should be reported as command errors
+            """
+            from django.core.management import call_command
+            from django.core.management.base import CommandError
+            self.assertRaises(CommandError, call_command, 'rubber_reindex', 'tests.Missing')
+
         def test_instance(self):
             """
             Checks the .elasticsearch property of a model instance
@@ -233,6 +1674,330 @@ class HitCollectionTest(TestCase):
         self.assertEquals('guillaume', collection[0].source.username)
         self.assertEquals(['guillaume', 'stephane'], [hit.source.username for hit in collection])
 
+class ColumnsTest(TestCase):
+    def setUp(self):
+        from rubber.response import SearchResponse
+        content = json.dumps({'hits': {'total': 3, 'hits': [
+            {'_id': '1', '_score': 1.5, '_source': {'price': 10, 'name': 'foo', 'stock': {'count': 3}}},
+            {'_id': '2', '_score': 1.0, '_source': {'price': 12.5, 'name': 'bar'}},
+            {'_id': '3', '_score': 0.5, 'fields': {'price': [7], 'name': ['baz']}},
+        ]}})
+        self.response = SearchResponse(ResponseMock(content))
+
+    def test_array(self):
+        """
+        Columns should be stdlib arrays for numbers and lists otherwise, without building hits
+        """
+        import math
+        from array import array
+        columns = self.response.columns(['_id', '_score', 'price', 'name', 'stock.count'], use_numpy=False)
+        self.assertEquals(['_id', '_score', 'price', 'name', 'stock.count'], columns.keys())
+        self.assertEquals(['1', '2', '3'], columns['_id'])
+        self.assertEquals(array('d', [1.5, 1.0, 0.5]), columns['_score'])
+        self.assertEquals(array('d', [10, 12.5, 7]), columns['price'])
+        self.assertEquals(['foo', 'bar', 'baz'], columns['name'])
+        self.assertEquals(3, columns['stock.count'][0])
+        self.assertTrue(all(math.isnan(value) for value in columns['stock.count'][1:]))
+        self.assertEquals(array('f', [1.5, 1.0, 0.5]), self.response.columns(['_score'], types={'_score': 'f'}, use_numpy=False)['_score'])
+        floats = self.response.columns(['stock.count'], types={'stock.count': 'f'}, use_numpy=False)['stock.count']
+        self.assertEquals('f', floats.typecode)
+        self.assertTrue(all(math.isnan(value) for value in floats[1:]))
+        self.assertFalse('_results' in self.response.__dict__)
+
+    def test_numpy(self):
+        """
+        Columns should be numpy arrays when numpy is installed
+        """
+        from rubber import columns
+        if None == columns.numpy:
+            return
+        result = self.response.columns(['_id', '_score', 'stock.count'])
+        self.assertEquals(object, result['_id'].dtype)
+        self.assertEquals('float64', str(result['_score'].dtype))
+        self.assertEquals([1.5, 1.0, 0.5], list(result['_score']))
+        self.assertEquals(2, columns.numpy.isnan(result['stock.count']).sum())
+        result = self.response.columns(['stock.count'], types={'stock.count': 'f'})
+        self.assertEquals('float32', str(result['stock.count'].dtype))
+        self.assertEquals(2, columns.numpy.isnan(result['stock.count']).sum())
+
+    def test_results_setter(self):
+        """
+        Results should still be assignable
+        """
+        self.response.results = ['foo']
+        self.assertEquals(['foo'], self.response.results)
+
+class QueryTemplateTest(TestCase):
+    def setUp(self):
+        from rubber.templates import Param, QueryTemplate
+        self.template = QueryTemplate({'query': {'bool': {'must': [{'term': {'user': Param('user')}},
+                                                                   {'terms': {'tags': Param('tags', ['a'])}}]}},
+                                       'size': Param('size', 10), 'from': 0})
+
+    def test_render(self):
+        """
+        A template should splice escaped parameter values, or their defaults, into its precomputed JSON
+        """
+        query = self.template(user=u'k"im\u00e9\nchy', tags=['a', 'b'])
+        self.assertEquals({'query': {'bool': {'must': [{'term': {'user': u'k"im\u00e9\nchy'}}, {'terms': {'tags': ['a', 'b']}}]}},
+                           'size': 10, 'from': 0}, json.loads(query.to_indexed_json()))
+        self.assertEquals(5, json.loads(self.template.render(user=None, size=5))['size'])
+        self.assertEquals(None, json.loads(self.template.render(user=None, size=5))['query']['bool']['must'][0]['term']['user'])
+        self.assertRaises(TypeError, self.template, tags=['a'])
+        self.assertRaises(TypeError, self.template, user='kimchy', other=1)
+
+    def test_send(self):
+        """
+        Resource methods should send the bytes of a bound template
+        """
+        from rubber import settings, ElasticSearch
+        from rubber.testutils import FakeElasticSearch
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+        fake = FakeElasticSearch()
+        client = ElasticSearch('foo', 'bar', transport=fake)
+        for pk, user in ((1, 'kimchy'), (2, 'bob')):
+            client.put(pk, {'user': user, 'tags': ['a']})
+        from rubber.templates import Param, QueryTemplate
+        query = QueryTemplate({'query': {'term': {'user': Param('user')}}, 'size': Param('size', 10)})(user='bob')
+        response = client.search.post(query)
+        self.assertEquals(['2'], [hit.id for hit in response.results])
+        self.assertEquals(json.loads(query.to_indexed_json()), fake.requests[-1]['body'])
+
+    def test_values(self):
+        """
+        Parameters should be serialized like documents: dates and decimals included
+        """
+        import datetime, decimal
+        from rubber.templates import Param, QueryTemplate
+        template = QueryTemplate({'query': {'range': {'date': {'gte': Param('since')}}}, 'min_score': Param('score')})
+        data = json.loads(template.render(since=datetime.date(2013, 1, 2), score=decimal.Decimal('0.5')))
+        self.assertEquals('2013-01-02', data['query']['range']['date']['gte'])
+        self.assertEquals('0.5', data['min_score'])
+
+    def test_native_values(self):
+        """
+        Native parameter values should be serialized without looking for models
+        """
+        from rubber import instanceutils
+        def is_model(value):
+            raise AssertionError('%r checked for a model' % (value,))
+        is_model_func = instanceutils._is_model
+        instanceutils._is_model = is_model
+        try:
+            self.assertEquals(['"a"', '1', '[1, null]', 'true'],
+                              [instanceutils.value_to_json(value) for value in ('a', 1, [1, None], True)])
+        finally:
+            instanceutils._is_model = is_model_func
+
+    def test_repeated_param(self):
+        """
+        A name should be usable by several Params with the same default, not with different ones
+        """
+        from rubber.templates import Param, QueryTemplate
+        template = QueryTemplate({'query': {'bool': {'should': [{'term': {'user': Param('user')}},
+                                                                {'term': {'author': Param('user')}}]}}})
+        should = json.loads(template.render(user='kimchy'))['query']['bool']['should']
+        self.assertEquals(['kimchy', 'kimchy'], [clause['term'].values()[0] for clause in should])
+        self.assertRaises(ValueError, QueryTemplate, [Param('size', 10), Param('size', 20)])
+
+class DumpTest(TestCase):
+    def setUp(self):
+        import tempfile
+        from rubber import settings, ElasticSearch
+        from rubber.testutils import FakeElasticSearch
+        settings.RUBBER_MOCK_HTTP_RESPONSE = None
+        self.fake = FakeElasticSearch()
+        self.client = ElasticSearch('foo', 'bar', transport=self.fake)
+        for pk in range(1, 21):
+            # a source containing an action line must not be cut
+            self.client.put(pk, {'n': pk, 'text': u'caf\u00e9\n{"index":{"_id":"0"}}\n'})
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        """
+        Exported documents should be loaded in another index by concurrent bulk requests
+        """
+        import os
+        from rubber import dump, ElasticSearch
+        path = os.path.join(self.directory, 'foo.ndjson.gz')
+        progress = []
+        self.assertEquals(20, dump.export(self.client, path, size=7, progress=progress.append)['documents'])
+        self.assertEquals([7, 14, 20], [stats['documents'] for stats in progress])
+
+        stats = dump.load(ElasticSearch('baz', 'bar', transport=self.fake), path, chunk_size=200, workers=3)
+        self.assertEquals(20, stats['documents'])
+        self.assertEquals([], stats['errors'])
+        self.assertTrue(stats['chunks'] > 3)
+        self.assertEquals(dict(self.fake.documents('foo', 'bar')), dict(self.fake.documents('baz', 'bar')))
+
+    def test_retry(self):
+        """
+        Chunks refused as a whole should be posted again
+        """
+        import os
+        from rubber import dump, ElasticSearch
+        from rubber.testutils import FakeElasticSearch, ResponseMock
+        class Overloaded(FakeElasticSearch):
+            refusals = 2
+            def request(self, method, path, **kwargs):
+                if path.endswith('_bulk') and self.refusals:
+                    self.refusals -= 1
+                    response = ResponseMock('{"error": "EsRejectedExecutionException", "status": 503}')
+                    response.status_code = 503
+                    return response
+                return super(Overloaded, self).request(method, path, **kwargs)
+
+        path = os.path.join(self.directory, 'foo.ndjson')
+        dump.export(self.client, path)
+        fake = Overloaded()
+        stats = dump.load(ElasticSearch('baz', 'bar', transport=fake), path, workers=1, backoff=0)
+        self.assertEquals([], stats['errors'])
+        self.assertEquals(20, len(fake.documents('baz', 'bar')))
+
+        fake = Overloaded()
+        stats = dump.load(ElasticSearch('baz', 'bar', transport=fake), path, workers=1, retries=1, backoff=0)
+        self.assertEquals([503], [error['status'] for error in stats['errors']])
+        self.assertEquals(0, len(fake.documents('baz', 'bar')))
+
+    def test_chunks(self):
+        """
+        Files should be cut before action lines only, and empty files should load nothing
+        """
+        import os
+        from rubber import dump
+        path = os.path.join(self.directory, 'foo.ndjson')
+        dump.export(self.client, path)
+        data = dump.open_mmap(path)
+        offsets = list(dump.chunks(data, 100))
+        self.assertEquals(0, offsets[0][0])
+        self.assertEquals(len(data), offsets[-1][1])
+        for (start, end), (next_start, next_end) in zip(offsets, offsets[1:]):
+            self.assertEquals(end, next_start)
+            self.assertTrue(data[next_start:].startswith('{"index":{'))
+            self.assertEquals(0, data[start:end].count('\n') % 2)
+        data.close()
+
+        open(path, 'w').close()
+        self.assertEquals(0, dump.load(self.client, path)['documents'])
+
+    def test_main(self):
+        """
+        The command line should export and import with --url, without a django project
+        """
+        import os
+        import sys
+        from StringIO import StringIO
+        from rubber import dump, resource
+        requestmock = ScriptedRequestMock(
+            '{"_scroll_id": "a", "hits": {"total": 1, "hits": []}}',
+            '{"_scroll_id": "b", "hits": {"total": 1, "hits": [{"_id": "1", "_type": "bar", "_source": {"n": 1}}]}}',
+            '{"_scroll_id": "c", "hits": {"total": 1, "hits": []}}')
+        resource.requests = requestmock
+        path = os.path.join(self.directory, 'foo.ndjson')
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            with unconfigured_django():
+                self.assertEquals(0, dump.main(['export', 'foo/bar', path, '--url=http://example.com:9200/']))
+                self.assertEquals(0, dump.main(['import', 'baz/bar', path, '--url=http://example.com:9200/']))
+        finally:
+            sys.stdout = stdout
+        self.assertEquals('http://example.com:9200/foo/bar/_search', requestmock.stack[0]['url'])
+        self.assertEquals('http://example.com:9200/baz/bar/_bulk', requestmock.stack[-1]['url'])
+        self.assertEquals('{"index":{"_id":"1"}}\n{"n": 1}\n', requestmock.stack[-1]['kwargs']['data'])
+
+class StreamingTest(TestCase):
+    response = """{"took":2,"timed_out":false,"_shards":{"total":5,"successful":5,"failed":0},"hits":{"total":2,"max_score":1.0,"hits":[{"_index":"auth","_type":"user","_id":"6","_score":1.0, "_source" : {"username": "guil\\"la[ume}", "tags": [1, [2, {"a": null}], -3.5e2], "is_active": true, "groups": []}},{"_index":"auth","_type":"user","_id":"8","_score":1.0, "_source" : {"username": "st\\u00e9phane", "groups": []}}]}, "facets": {"tags": {"terms": []}}}"""
+
+    def test_chunks(self):
+        """
+        Hits should be parsed one by one whatever the chunk boundaries
+        """
+        from rubber.streaming import StreamingHitCollection
+        expected = json.loads(self.response)
+        for size in (1, 2, 3, 7, 64, 4096):
+            chunks = [self.response[i:i + size] for i in range(0, len(self.response), size)]
+            collection = StreamingHitCollection(chunks)
+            self.assertEquals(2, collection.total)
+            self.assertEquals(1.0, collection.max_score)
+            self.assertEquals([hit['_source'] for hit in expected['hits']['hits']],
+                              [hit.attributes['_source'] for hit in collection])
+            self.assertEquals(expected['facets'], collection.meta['facets'])
+            self.assertEquals(2, collection.meta['took'])
+
+    def test_large_field(self):
+        """
+        A hit with a field spanning many chunks should be parsed in linear time
+        """
+        import time
+        from rubber.streaming import StreamingHitCollection
+        response = json.dumps({'hits': {'total': 1, 'hits': [{'_id': '1', '_source': {'text': 'a\\"b' * 500000}}]}})
+        chunks = [response[i:i + 1024] for i in range(0, len(response), 1024)]
+        start = time.time()
+        hits = list(StreamingHitCollection(chunks))
+        self.assertTrue(time.time() - start < 2)
+        self.assertEquals('a\\"b' * 500000, hits[0].source.text)
+
+    def test_close(self):
+        """
+        Closing the hits before the end of the response should close its connection
+        """
+        from rubber.streaming import StreamingHitCollection
+        class Closing(object):
+            closed = False
+            def close(self):
+                self.closed = True
+        class Raw(object):
+            released = False
+            def __init__(self):
+                self._fp = Closing()
+                self._connection = Closing()
+            def release_conn(self):
+                self.released = True
+
+        response = ResponseMock(self.response)
+        response.raw = Raw()
+        collection = StreamingHitCollection([self.response], response=response)
+        self.assertEquals('6', iter(collection).next().id)
+        collection.close()
+        self.assertTrue(response.raw._fp.closed and response.raw._connection.closed and response.raw.released)
+
+        response.raw = Raw()
+        collection = StreamingHitCollection([self.response], response=response)
+        list(collection)
+        collection.close()
+        self.assertFalse(response.raw._connection.closed)
+        self.assertTrue(response.raw.released)
+
+    def test_total_after_hits(self):
+        """
+        total should still be available when it comes after the hits
+        """
+        from rubber.streaming import StreamingHitCollection
+        collection = StreamingHitCollection(['{"hits": {"hits": [{"_id": "1"}, {"_id": "2"}], "total": 2}}'])
+        self.assertEquals(2, collection.total)
+        self.assertEquals(['1', '2'], [hit.id for hit in collection])
+        self.assertRaises(RuntimeError, iter(collection).next)
+
+    def test_stream_search(self):
+        """
+        client.stream_search should return a StreamingSearchResponse
+        """
+        from rubber import settings, ElasticSearch
+        from rubber.streaming import StreamingSearchResponse
+        settings.RUBBER_MOCK_HTTP_RESPONSE = self.response
+        try:
+            response = ElasticSearch('foo', 'bar').stream_search({}, chunk_size=16)
+            self.assertTrue(isinstance(response, StreamingSearchResponse))
+            self.assertEquals(2, response.results.total)
+            self.assertEquals(['6', '8'], [hit.id for hit in response.results])
+        finally:
+            settings.RUBBER_MOCK_HTTP_RESPONSE = None
+
 class HitTest(TestCase):
     def test_init(self):
         from rubber.response import Hit
@@ -252,6 +2017,21 @@ class HitTest(TestCase):
         self.assertEquals('6', hit.id)
         self.assertEquals('guillaume', hit.source.username)
 
+    def test_lazy_nested(self):
+        """
+        Nested dicts and lists should be wrapped on access, once
+        """
+        from rubber.response import Hit
+        hit = Hit({"_id": "6", "_score": 0.5, "_source": {"tags": [{"name": "foo"}, "bar", [1, 2]], "author": {"name": "guillaume"}}})
+        self.assertEquals(0.5, hit.score)
+        self.assertTrue(hit.source is hit._source)
+        self.assertTrue(hit.source.author is hit.source.author)
+        self.assertEquals('guillaume', hit.source.author.name)
+        self.assertEquals('foo', hit.source.tags[0].name)
+        self.assertEquals(['bar', [1, 2]], hit.source.tags[1:])
+        self.assertFalse(hasattr(hit, 'missing'))
+        self.assertFalse(hasattr(hit, '_missing'))
+
 class ResponseTest(TestCase):
     def setUp(self):
         # Setup a mock response
@@ -295,3 +2075,12 @@ class ResponseTest(TestCase):
             
         response = self.client.search()
         self.assertIsNone(response.json)
+
+    def test_response_proxy(self):
+        """
+        Responses should proxy the attributes of the requests response, parsing its json once
+        """
+        response = self.client.search()
+        self.assertEquals(200, response.status_code)
+        self.assertTrue(response.json is response.json)
+        self.assertRaises(AttributeError, getattr, response, 'nonexistent')